@@ -0,0 +1 @@
+"""AIA 前端共享的对话管线组件"""
@@ -0,0 +1,115 @@
+"""
+对话消息缓冲区
+
+每轮请求都重建 [system] + history + [user] 会复制整个历史，
+而且只要前缀有一个字节不同，服务端的前缀缓存（KV Cache）就会失效。
+MessageBuffer 把消息保存在一个原地追加的列表中：
+- 系统提示词固定在第 0 条，只有内容真正变化时才替换
+- 已完成的轮次永远不再改写，保证跨请求字节一致
+- 本轮的请求内容（例如带分析结果的模板）只出现在最后一条，提交时替换为原始输入
+
+历史本身保存在 TurnLog 中（见 aia.history），SF 和 BA 的缓冲区共享同一份记录、各读一列。
+消息列表只是按需生成的缓存：会话空闲时可以 release() 释放，下次使用时再生成。
+"""
+from aia.history import TurnLog
+
+
+class MessageBuffer:
+    def __init__(self, system_prompt, log=None, stage="ba"):
+        self.log = log if log is not None else TurnLog()
+        self.stage = stage
+        self._system = {"role": "system", "content": system_prompt}
+        self._pending = None
+        self._messages = None
+        self._version = None
+
+    @property
+    def messages(self):
+        """发送给接口的消息列表；历史被清空或裁剪后重新生成"""
+        if self._messages is None or self._version != self.log.version:
+            messages = [self._system]
+            for user, reply in self.log.pairs(self.stage):
+                messages.append({"role": "user", "content": user})
+                messages.append({"role": "assistant", "content": reply})
+            if self._pending is not None:
+                messages.append({"role": "user", "content": self._pending})
+            self._messages = messages
+            self._version = self.log.version
+        return self._messages
+
+    @property
+    def materialized(self):
+        """当前缓存的消息条数（未生成时为0）"""
+        return len(self._messages) if self._messages is not None else 0
+
+    def release(self):
+        """释放消息列表缓存，历史仍保留在 TurnLog 中"""
+        if self._pending is None:
+            self._messages = None
+
+    @property
+    def system_prompt(self):
+        return self._system["content"]
+
+    def set_system_prompt(self, system_prompt):
+        """更新系统提示词，内容未变化时保持原对象不动"""
+        if self._system["content"] != system_prompt:
+            self._system = {"role": "system", "content": system_prompt}
+            if self._messages is not None:
+                self._messages[0] = self._system
+
+    @property
+    def turn_count(self):
+        return self.log.count(self.stage)
+
+    def history(self):
+        """返回已完成轮次的消息（不含系统提示词和未提交的请求）"""
+        end = len(self.messages) - 1 if self._pending is not None else len(self.messages)
+        return self.messages[1:end]
+
+    def begin(self, request_content):
+        """追加本轮请求消息，返回可直接发送给接口的消息列表"""
+        if self._pending is not None:
+            self.rollback()
+        messages = self.messages
+        messages.append({"role": "user", "content": request_content})
+        self._pending = request_content
+        return messages
+
+    def commit(self, user_content, assistant_content, seconds=None, turn=None):
+        """提交本轮：请求消息替换为原始用户输入，并追加回复
+
+        seconds 为本阶段耗时；turn 为本轮的 Turn 标识（见 TurnLog.begin_turn），
+        同一轮的另一个阶段用同一个标识提交时写入同一个节点。
+        """
+        messages = self.messages
+        if self._pending is not None:
+            messages.pop()
+            self._pending = None
+        node = self.log.record(self.stage, user_content, assistant_content, turn)
+        if seconds is not None:
+            self.log.set_seconds(self.stage, seconds, node)
+        messages.append({"role": "user", "content": user_content})
+        messages.append({"role": "assistant", "content": assistant_content})
+
+    def amend(self, assistant_content):
+        """替换最后一轮已提交的回复，之前的轮次保持不变"""
+        self.log.amend(self.stage, assistant_content)
+        messages = self._messages
+        if messages is not None and self._pending is None and messages[-1]["role"] == "assistant":
+            messages[-1] = {"role": "assistant", "content": assistant_content}
+
+    def last_reply(self):
+        """最后一轮已提交的回复，没有时返回 None"""
+        return self.log.last(self.stage)
+
+    def rollback(self):
+        """请求失败时撤销本轮请求消息"""
+        if self._pending is not None:
+            self.messages.pop()
+            self._pending = None
+
+    def clear(self):
+        """清空历史，保留系统提示词"""
+        self._pending = None
+        self.log.clear()
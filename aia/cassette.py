@@ -0,0 +1,321 @@
+"""
+接口流量录制与回放
+
+录制模式下记录 SF、BA、TTS 和音色列表的每次交互（包括流式分片的到达时间），
+回放模式下通过同样的客户端接口按原始或压缩后的节奏返回录制内容，
+不需要 API 密钥和网络即可复现、分析客户端管线的耗时。
+
+通过环境变量启用：
+- AIA_CASSETTE_MODE：record 或 replay
+- AIA_CASSETTE：录制文件路径（默认 cassettes/session.jsonl.gz）
+- AIA_CASSETTE_SPEED：回放时间缩放，1 为原始节奏，0.1 为压缩到十分之一，0 为不等待
+
+录制文件为 gzip 压缩的 JSONL，每行一次交互。回放时按请求内容匹配，
+没有完全相同的请求时按同类交互的录制顺序依次返回。
+"""
+import base64
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from pathlib import Path
+from types import SimpleNamespace
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATH = Path(__file__).parent.parent / "cassettes" / "session.jsonl.gz"
+
+
+def request_key(kind, name, **request):
+    """根据请求内容生成匹配键"""
+    payload = json.dumps([kind, name, request], ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def to_plain(obj):
+    """把SDK返回的对象转换为可序列化的字典"""
+    if obj is None or isinstance(obj, (str, int, float, bool)):
+        return obj
+    if isinstance(obj, dict):
+        return {k: to_plain(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [to_plain(v) for v in obj]
+    if hasattr(obj, "model_dump"):
+        # 去掉空字段，录制文件更紧凑
+        return obj.model_dump(exclude_none=True)
+    return {k: to_plain(v) for k, v in vars(obj).items() if not k.startswith("_")}
+
+
+def to_namespace(data):
+    """把字典还原为可用属性访问的对象"""
+    if isinstance(data, dict):
+        return SimpleNamespace(**{k: to_namespace(v) for k, v in data.items()})
+    if isinstance(data, list):
+        return [to_namespace(v) for v in data]
+    return data
+
+
+class Cassette:
+    def __init__(self, path, mode, speed=1.0):
+        self.path = Path(path)
+        self.mode = mode
+        self.speed = speed
+        self._lock = threading.Lock()
+        self._by_key = defaultdict(deque)
+        self._by_kind = defaultdict(deque)
+        if mode == "replay":
+            self._load()
+        else:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+        logger.info(f"接口流量{'回放' if mode == 'replay' else '录制'}已启用: {self.path}")
+
+    def _load(self):
+        with gzip.open(self.path, "rt", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                self._by_key[entry["key"]].append(entry)
+                self._by_kind[entry["kind"]].append(entry)
+        logger.info(f"已加载 {sum(len(q) for q in self._by_kind.values())} 条录制记录")
+
+    def record(self, entry):
+        line = json.dumps(entry, ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            # gzip 支持多段追加，每条记录单独写入，异常退出也不会丢失已完成的记录
+            with gzip.open(self.path, "at", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+    def take(self, kind, key):
+        """取出匹配的录制记录"""
+        with self._lock:
+            queue = self._by_key.get(key)
+            entry = None
+            while queue:
+                candidate = queue.popleft()
+                if not candidate.get("_used"):
+                    entry = candidate
+                    break
+            if entry is None:
+                kind_queue = self._by_kind.get(kind)
+                while kind_queue:
+                    candidate = kind_queue.popleft()
+                    if not candidate.get("_used"):
+                        entry = candidate
+                        logger.warning(f"回放未找到完全匹配的{kind}请求，按录制顺序返回")
+                        break
+            if entry is None:
+                raise LookupError(f"录制文件中没有可用的 {kind} 记录")
+            entry["_used"] = True
+            return entry
+
+    def wait(self, seconds):
+        if self.speed > 0 and seconds > 0:
+            time.sleep(seconds * self.speed)
+
+
+class _RecordingStream:
+    """透传流式分片，同时记录每个分片的到达时间"""
+
+    def __init__(self, stream, cassette, entry, start):
+        self._stream = stream
+        self._cassette = cassette
+        self._entry = entry
+        self._start = start
+
+    def __iter__(self):
+        chunks = self._entry["chunks"]
+        for chunk in self._stream:
+            offset = time.perf_counter() - self._start
+            chunks.append([round(offset, 4), to_plain(chunk)])
+            yield chunk
+        self._cassette.record(self._entry)
+
+    def close(self):
+        close = getattr(self._stream, "close", None)
+        if close:
+            close()
+
+
+class _RecordingCompletions:
+    def __init__(self, completions, cassette, name):
+        self._completions = completions
+        self._cassette = cassette
+        self._name = name
+
+    def create(self, **kwargs):
+        key = request_key("chat", self._name, model=kwargs.get("model"), messages=kwargs.get("messages"))
+        entry = {"kind": "chat", "key": key, "name": self._name, "model": kwargs.get("model"),
+                 "stream": bool(kwargs.get("stream")), "chunks": []}
+        start = time.perf_counter()
+        response = self._completions.create(**kwargs)
+        if kwargs.get("stream"):
+            return _RecordingStream(response, self._cassette, entry, start)
+        entry["chunks"].append([round(time.perf_counter() - start, 4), to_plain(response)])
+        self._cassette.record(entry)
+        return response
+
+
+class _RecordingSpeech:
+    def __init__(self, speech, cassette, name):
+        self._speech = speech
+        self._cassette = cassette
+        self._name = name
+
+    @contextmanager
+    def create(self, **kwargs):
+        key = request_key("tts", self._name, model=kwargs.get("model"),
+                          voice=kwargs.get("voice"), input=kwargs.get("input"))
+        start = time.perf_counter()
+        with self._speech.with_streaming_response.create(**kwargs) as response:
+            yield _RecordingAudioResponse(response, self._cassette, key, self._name, start)
+
+
+class _RecordingAudioResponse:
+    def __init__(self, response, cassette, key, name, start):
+        self._response = response
+        self._cassette = cassette
+        self._key = key
+        self._name = name
+        self._start = start
+
+    def stream_to_file(self, path):
+        self._response.stream_to_file(path)
+        with open(path, "rb") as f:
+            audio = base64.b64encode(f.read()).decode("ascii")
+        self._cassette.record({"kind": "tts", "key": self._key, "name": self._name,
+                               "duration": round(time.perf_counter() - self._start, 4), "audio": audio})
+
+
+class RecordingClient:
+    """包装真实客户端，记录所有交互"""
+
+    def __init__(self, client, cassette, name):
+        self._client = client
+        self.chat = SimpleNamespace(completions=_RecordingCompletions(client.chat.completions, cassette, name))
+        self.audio = SimpleNamespace(speech=SimpleNamespace(
+            with_streaming_response=_RecordingSpeech(client.audio.speech, cassette, name)
+        ))
+
+    def __getattr__(self, item):
+        return getattr(self._client, item)
+
+
+class _ReplayStream:
+    def __init__(self, entry, cassette):
+        self._entry = entry
+        self._cassette = cassette
+        self._closed = False
+
+    def __iter__(self):
+        elapsed = 0.0
+        for offset, chunk in self._entry["chunks"]:
+            if self._closed:
+                return
+            self._cassette.wait(offset - elapsed)
+            elapsed = offset
+            yield to_namespace(chunk)
+
+    def close(self):
+        self._closed = True
+
+
+class _ReplayCompletions:
+    def __init__(self, cassette, name):
+        self._cassette = cassette
+        self._name = name
+
+    def create(self, **kwargs):
+        key = request_key("chat", self._name, model=kwargs.get("model"), messages=kwargs.get("messages"))
+        entry = self._cassette.take("chat", key)
+        if entry.get("stream"):
+            return _ReplayStream(entry, self._cassette)
+        offset, response = entry["chunks"][0]
+        self._cassette.wait(offset)
+        return to_namespace(response)
+
+
+class _ReplayAudioResponse:
+    def __init__(self, entry, cassette):
+        self._entry = entry
+        self._cassette = cassette
+
+    def stream_to_file(self, path):
+        self._cassette.wait(self._entry["duration"])
+        with open(path, "wb") as f:
+            f.write(base64.b64decode(self._entry["audio"]))
+
+
+class _ReplaySpeech:
+    def __init__(self, cassette, name):
+        self._cassette = cassette
+        self._name = name
+
+    @contextmanager
+    def create(self, **kwargs):
+        key = request_key("tts", self._name, model=kwargs.get("model"),
+                          voice=kwargs.get("voice"), input=kwargs.get("input"))
+        yield _ReplayAudioResponse(self._cassette.take("tts", key), self._cassette)
+
+
+class ReplayClient:
+    """用录制内容代替真实接口"""
+
+    def __init__(self, cassette, name, api_key="replay", base_url=""):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.chat = SimpleNamespace(completions=_ReplayCompletions(cassette, name))
+        self.audio = SimpleNamespace(speech=SimpleNamespace(
+            with_streaming_response=_ReplaySpeech(cassette, name)
+        ))
+        self.models = SimpleNamespace(list=lambda: [])
+
+
+_active = None
+_active_lock = threading.Lock()
+
+
+def active_cassette():
+    """根据环境变量返回当前的录制/回放文件，未启用时返回 None"""
+    global _active
+    mode = os.environ.get("AIA_CASSETTE_MODE", "").lower()
+    if mode not in ("record", "replay"):
+        return None
+    with _active_lock:
+        if _active is None:
+            path = os.environ.get("AIA_CASSETTE") or DEFAULT_PATH
+            speed = float(os.environ.get("AIA_CASSETTE_SPEED", "1"))
+            _active = Cassette(path, mode, speed)
+        return _active
+
+
+def wrap_client(client, name):
+    """按当前模式包装客户端"""
+    cassette = active_cassette()
+    if cassette is None:
+        return client
+    if cassette.mode == "record":
+        return RecordingClient(client, cassette, name)
+    return ReplayClient(cassette, name, client.api_key, str(client.base_url))
+
+
+def voice_list_call(api_key, fetch):
+    """录制或回放音色列表请求；未启用时直接调用 fetch"""
+    cassette = active_cassette()
+    if cassette is None:
+        return fetch(api_key)
+    key = request_key("voice_list", "SF")
+    if cassette.mode == "replay":
+        entry = cassette.take("voice_list", key)
+        cassette.wait(entry["duration"])
+        return entry["result"]
+    start = time.perf_counter()
+    result = fetch(api_key)
+    cassette.record({"kind": "voice_list", "key": key, "duration": round(time.perf_counter() - start, 4),
+                     "result": result})
+    return result
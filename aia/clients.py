@@ -0,0 +1,60 @@
+"""
+API客户端构建
+
+两个前端共用同一套客户端配置。连接保活时间比 httpx 默认的5秒更长，
+这样预热建立的连接在用户输入期间不会被提前回收。
+"""
+import logging
+import os
+
+import httpx
+import requests
+from openai import OpenAI, DefaultHttpxClient
+
+from aia.cassette import wrap_client, voice_list_call
+from aia.hedging import alternates
+
+logger = logging.getLogger(__name__)
+
+SF_BASE_URL = "https://api.siliconflow.cn/v1"
+BA_BASE_URL = "https://api2.aigcbest.top/v1"
+VOICE_LIST_URL = "https://api.siliconflow.cn/v1/audio/voice/list"
+
+# 空闲连接保留时间（秒）
+KEEPALIVE_EXPIRY = 120
+
+# 音色列表等普通HTTP请求共用的连接池
+http_session = requests.Session()
+
+
+def create_client(api_key, base_url, name):
+    """创建客户端；启用录制/回放时返回包装后的客户端"""
+    client = OpenAI(
+        api_key=api_key,
+        base_url=base_url,
+        http_client=DefaultHttpxClient(limits=httpx.Limits(keepalive_expiry=KEEPALIVE_EXPIRY))
+    )
+    return wrap_client(client, name)
+
+
+def create_clients(apikey_sf, apikey_ba):
+    """创建SF和BA客户端；配置了备用地址时同时创建对冲请求使用的客户端"""
+    for name, api_key in (("SF", apikey_sf), ("BA", apikey_ba)):
+        base_url = os.environ.get(f"AIA_HEDGE_{name}_BASE_URL")
+        if base_url:
+            alternates[name] = create_client(api_key, base_url, name)
+            logger.info(f"{name} 对冲请求使用备用地址: {base_url}")
+    return create_client(apikey_sf, SF_BASE_URL, "SF"), create_client(apikey_ba, BA_BASE_URL, "BA")
+
+
+def fetch_voice_list(api_key):
+    """请求音色列表，失败时抛出异常"""
+    return voice_list_call(api_key, _fetch_voice_list)
+
+
+def _fetch_voice_list(api_key):
+    headers = {"Authorization": f"Bearer {api_key}"}
+    response = http_session.get(VOICE_LIST_URL, headers=headers)
+    if response.status_code != 200:
+        raise RuntimeError(f"状态码: {response.status_code}, 响应: {response.text}")
+    return response.json().get('result', [])
@@ -0,0 +1,161 @@
+"""
+SF分析结果压缩
+
+DeepSeek-R1 的输出往往包含冗长的推理过程，直接粘贴进BA提示词会拖慢 GPT-4o 的首字时间，
+并且每一轮都会随SF历史重复发送。这里把分析拆成：
+- 推理过程（reasoning_content 或 <think> 标签内的内容）：丢弃，不进入BA和历史
+- 正文：按“要点 / 思路 / 注意事项”提取成结构化摘要，控制在 token 预算内
+
+环境变量 AIA_SF_DIGEST_TOKENS 设置摘要预算（默认400），设为0表示不压缩。
+"""
+import os
+import re
+
+from aia.tokens import estimate_tokens
+
+DIGEST_TOKENS = int(os.environ.get("AIA_SF_DIGEST_TOKENS", "400"))
+
+THINK_BLOCK = re.compile(r"<think>(.*?)</think>", re.DOTALL)
+MARKDOWN_HEADING = re.compile(r"^#{1,6}\s*(.+)$")
+BOLD_HEADING = re.compile(r"^(?:\d+[.、)]|[一二三四五六七八九十]+[、.])?\s*\*\*(.+?)\*\*\s*[:：]?$")
+SHORT_HEADING = re.compile(r"^(?:\d+[.、)]|[一二三四五六七八九十]+[、.])\s*(.{1,16}?)\s*[:：]?$")
+ITEM = re.compile(r"^\s*([-*+•]|\d+[.、)]|[（(]\d+[)）])\s+")
+MARKUP = re.compile(r"(\*\*|__|`|#{1,6}\s)")
+SENTENCE = re.compile(r"(?<=[。！？!?；;])")
+
+SECTIONS = (
+    ("要点", ("核心", "要点", "问题", "关键点", "结论", "总结")),
+    ("思路", ("思路", "方案", "方法", "解决", "推理", "步骤", "建议", "过程")),
+    ("注意", ("因素", "注意", "风险", "限制", "前提", "考虑", "局限", "边界")),
+)
+ITEM_MAX_CHARS = 80
+
+
+def split_reasoning(content, reasoning=None):
+    """把正文中的 <think> 推理内容拆出来，返回 (推理, 正文)"""
+    thoughts = THINK_BLOCK.findall(content or "")
+    if thoughts:
+        content = THINK_BLOCK.sub("", content)
+        reasoning = "\n".join(filter(None, [reasoning] + thoughts))
+    return reasoning, (content or "").strip()
+
+
+class ReasoningFilter:
+    """流式去掉 <think> 推理内容，与 split_reasoning 的结果一致
+
+    标签可能被拆在两个分片之间，结尾可能是标签前半段的部分留到下一个分片再判断；
+    正文开头的空白（通常紧跟在 </think> 之后）不输出。
+    """
+
+    OPEN, CLOSE = "<think>", "</think>"
+
+    def __init__(self):
+        self.pending = ""
+        self.thinking = False
+        self.started = False
+
+    def feed(self, chunk):
+        """返回本分片中可以显示的正文"""
+        text = self.pending + chunk
+        self.pending = ""
+        visible = []
+        while text:
+            tag = self.CLOSE if self.thinking else self.OPEN
+            index = text.find(tag)
+            if index >= 0:
+                if not self.thinking:
+                    visible.append(text[:index])
+                text = text[index + len(tag):]
+                self.thinking = not self.thinking
+                continue
+            # 结尾可能是标签的前半段，留到下一个分片
+            keep = next((n for n in range(min(len(tag) - 1, len(text)), 0, -1) if tag.startswith(text[-n:])), 0)
+            if not self.thinking:
+                visible.append(text[:len(text) - keep])
+            self.pending = text[len(text) - keep:]
+            break
+        return self._emit("".join(visible))
+
+    def _emit(self, text):
+        if not self.started:
+            text = text.lstrip()
+            self.started = bool(text)
+        return text
+
+    def close(self):
+        """流结束时返回留下的正文（未闭合的推理内容丢弃）"""
+        text, self.pending = self.pending, ""
+        return "" if self.thinking else self._emit(text)
+
+
+def _heading_title(line):
+    """标题行返回标题文字，否则返回 None"""
+    for pattern in (MARKDOWN_HEADING, BOLD_HEADING, SHORT_HEADING):
+        match = pattern.match(line)
+        if match:
+            return match.group(1)
+    return None
+
+
+def _section_for(title):
+    for name, keywords in SECTIONS:
+        if any(keyword in title for keyword in keywords):
+            return name
+    return None
+
+
+def _clean(line):
+    line = MARKUP.sub("", ITEM.sub("", line)).strip()
+    if len(line) > ITEM_MAX_CHARS:
+        line = line[:ITEM_MAX_CHARS].rstrip("，,；;、 ") + "…"
+    return line
+
+
+def build_digest(content, max_tokens=DIGEST_TOKENS):
+    """把分析正文压缩为结构化摘要；无需压缩或未启用时原样返回"""
+    if max_tokens <= 0 or estimate_tokens(content) <= max_tokens:
+        return content
+
+    sections = {name: [] for name, _ in SECTIONS}
+    current = "要点"
+    for line in content.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        title = _heading_title(line)
+        if title:
+            section = _section_for(title)
+            if section:
+                current = section
+                continue
+        text = _clean(line)
+        if text:
+            sections[current].append(text)
+
+    # 没有识别出结构时，按句子截取
+    if sum(len(items) for items in sections.values()) <= 1:
+        sections = {"要点": [_clean(s) for s in SENTENCE.split(content) if s.strip()], "思路": [], "注意": []}
+
+    # 各部分轮流取条目，保证每部分都有代表，直到用完预算
+    lines = {name: [] for name in sections}
+    used = 0
+    cursor = {name: 0 for name in sections}
+    progress = True
+    while progress:
+        progress = False
+        for name, items in sections.items():
+            if cursor[name] >= len(items):
+                continue
+            item = items[cursor[name]]
+            cursor[name] += 1
+            progress = True
+            cost = estimate_tokens(item) + 2
+            if used + cost <= max_tokens:
+                lines[name].append(item)
+                used += cost
+
+    parts = []
+    for name, items in lines.items():
+        if items:
+            parts.append(f"【{name}】\n" + "\n".join(f"- {item}" for item in items))
+    return "\n".join(parts) or content[:max_tokens]
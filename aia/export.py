@@ -0,0 +1,147 @@
+"""
+对话导出
+
+把会话导出为 Markdown、JSONL 或 HTML，包括用户输入、SF 分析摘要、BA 回复、
+各阶段耗时和语音文件路径。
+SF 历史中只保存交给 BA 的压缩摘要（见 aia.digest），不是完整的分析正文，三种格式中都标明为摘要。
+每种格式都是生成器，逐轮产出文本片段并立即写入文件；
+配合 SessionManager.iter_sessions() 逐个读取会话，导出很长或很多会话时内存占用保持不变。
+"""
+import html
+import json
+import logging
+import math
+from datetime import datetime
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+FORMATS = {".md": "markdown", ".markdown": "markdown", ".jsonl": "jsonl", ".html": "html", ".htm": "html"}
+
+HTML_HEAD = """<!DOCTYPE html>
+<html lang="zh-CN">
+<head>
+<meta charset="utf-8">
+<title>AIA 对话记录</title>
+<style>
+body { font-family: sans-serif; max-width: 860px; margin: 2em auto; line-height: 1.6; color: #222; }
+h2 { border-bottom: 1px solid #ddd; padding-bottom: .3em; }
+.turn { margin: 1.5em 0; }
+.meta { color: #888; font-size: .85em; }
+.user { color: #1a4fb5; font-weight: bold; white-space: pre-wrap; }
+.analysis { color: #6a3d9a; background: #f7f3fb; padding: .5em 1em; white-space: pre-wrap; }
+.reply { white-space: pre-wrap; }
+</style>
+</head>
+<body>
+"""
+HTML_TAIL = "</body>\n</html>\n"
+
+
+def _seconds(value):
+    return None if math.isnan(value) else round(value, 2)
+
+
+def _time(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S") if timestamp else None
+
+
+def _audio_uri(path):
+    return Path(path).resolve().as_uri()
+
+
+def iter_turns(session):
+    """逐轮返回会话当前分支的内容（字典）"""
+    log = session.log
+    for turn, i in enumerate(log.path(), 1):
+        yield {
+            "session_id": session.session_id,
+            "turn": turn,
+            "time": _time(log.started[i]),
+            "user": log.user[i],
+            "analysis_digest": log.sf[i],
+            "reply": log.ba[i],
+            "sf_seconds": _seconds(log.sf_seconds[i]),
+            "ba_seconds": _seconds(log.ba_seconds[i]),
+            "audio": log.audio[i],
+        }
+
+
+def _timing(turn):
+    parts = []
+    if turn["time"]:
+        parts.append(turn["time"])
+    if turn["sf_seconds"] is not None:
+        parts.append(f"分析 {turn['sf_seconds']}秒")
+    if turn["ba_seconds"] is not None:
+        parts.append(f"回复 {turn['ba_seconds']}秒")
+    return " · ".join(parts)
+
+
+def export_markdown(sessions):
+    yield "# AIA 对话记录\n\n"
+    for session in sessions:
+        yield f"## 会话 {session.session_id}\n\n"
+        for turn in iter_turns(session):
+            yield f"### 第 {turn['turn']} 轮\n\n"
+            timing = _timing(turn)
+            if timing:
+                yield f"_{timing}_\n\n"
+            yield f"**用户：** {turn['user']}\n\n"
+            if turn["analysis_digest"] is not None:
+                quoted = "\n".join(f"> {line}" for line in turn["analysis_digest"].splitlines())
+                yield f"**逻辑分析摘要：**\n\n{quoted}\n\n"
+            if turn["reply"] is not None:
+                yield f"**AI：**\n\n{turn['reply']}\n\n"
+            if turn["audio"]:
+                yield f"🔊 语音：[{Path(turn['audio']).name}]({_audio_uri(turn['audio'])})\n\n"
+
+
+def export_jsonl(sessions):
+    for session in sessions:
+        for turn in iter_turns(session):
+            yield json.dumps(turn, ensure_ascii=False) + "\n"
+
+
+def export_html(sessions):
+    yield HTML_HEAD
+    yield "<h1>AIA 对话记录</h1>\n"
+    for session in sessions:
+        yield f"<h2>会话 {html.escape(str(session.session_id))}</h2>\n"
+        for turn in iter_turns(session):
+            yield '<div class="turn">\n'
+            yield f'<div class="meta">第 {turn["turn"]} 轮 {html.escape(_timing(turn))}</div>\n'
+            yield f'<div class="user">用户：{html.escape(turn["user"])}</div>\n'
+            if turn["analysis_digest"] is not None:
+                yield f'<div class="analysis">逻辑分析摘要：\n{html.escape(turn["analysis_digest"])}</div>\n'
+            if turn["reply"] is not None:
+                yield f'<div class="reply">{html.escape(turn["reply"])}</div>\n'
+            if turn["audio"]:
+                uri = html.escape(_audio_uri(turn["audio"]))
+                yield f'<audio controls preload="none" src="{uri}"></audio>\n'
+            yield "</div>\n"
+    yield HTML_TAIL
+
+
+EXPORTERS = {"markdown": export_markdown, "jsonl": export_jsonl, "html": export_html}
+
+
+def format_for(path):
+    """按扩展名确定导出格式，不支持时返回 None"""
+    return FORMATS.get(Path(path).suffix.lower())
+
+
+def write_export(path, sessions, fmt=None):
+    """把会话逐段写入文件，返回写入的字符数"""
+    path = Path(path)
+    fmt = fmt or format_for(path)
+    if fmt not in EXPORTERS:
+        raise ValueError(f"不支持的导出格式: {path.suffix or fmt}（可选 .md / .jsonl / .html）")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    written = 0
+    with open(path, "w", encoding="utf-8") as f:
+        for piece in EXPORTERS[fmt](sessions):
+            f.write(piece)
+            written += len(piece)
+    logger.info(f"对话已导出为 {fmt}: {path}（{written} 字符）")
+    return written
@@ -0,0 +1,200 @@
+"""
+对冲请求
+
+DeepSeek-R1 的耗时长尾很明显：大多数请求正常，少数要等中位数的好几倍。
+流式请求在一定时间内没有收到第一个分片时，再向同一个（或备用）地址发一份相同的请求，
+哪个先开始输出就用哪个，另一个立即关闭：
+- 等待阈值取该阶段最近首个分片耗时的分位数（默认 p95），样本不足时不对冲
+- 每个阶段有独立的预算：每个请求积攒 ratio 份额度，对冲一次消耗 1 份，限制额外开销
+- 对冲请求同样受限流器约束，没有空余配额时不对冲；结束后结算落败一方预扣的配额
+- 录制/回放模式下不对冲，保证录制内容与请求一一对应
+
+环境变量：
+- AIA_HEDGE：设为0关闭对冲
+- AIA_HEDGE_PERCENTILE：等待阈值的分位数（默认95）
+- AIA_HEDGE_SF_BUDGET / AIA_HEDGE_BA_BUDGET：允许对冲的请求比例（默认0.1）
+- AIA_HEDGE_SF_BASE_URL / AIA_HEDGE_BA_BASE_URL：对冲请求使用的备用地址（默认与原请求相同）
+"""
+import logging
+import os
+import queue
+import threading
+import time
+
+from aia.metrics import LatencyStats
+
+logger = logging.getLogger(__name__)
+
+HEDGE_ENABLED = os.environ.get("AIA_HEDGE", "1") != "0"
+HEDGE_PERCENTILE = float(os.environ.get("AIA_HEDGE_PERCENTILE", "95"))
+# 少于该样本数时不对冲
+MIN_SAMPLES = 20
+# 预算最多积攒的对冲次数
+MAX_BUDGET = 5.0
+# 等待首个分片时检查取消的间隔
+POLL_SECONDS = 0.25
+
+# 各阶段收到首个分片（正文或推理内容）的耗时
+first_chunk = {
+    "SF": LatencyStats(),
+    "BA": LatencyStats(),
+}
+
+# 备用地址的客户端（见 aia.clients.create_clients）
+alternates = {}
+
+
+class HedgeBudget:
+    def __init__(self, ratio):
+        self.ratio = ratio
+        self.balance = 0.0
+        self.hedged = 0
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.requests += 1
+            self.balance = min(MAX_BUDGET, self.balance + self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            if self.balance < 1:
+                return False
+            self.balance -= 1
+            self.hedged += 1
+            return True
+
+    def refund(self):
+        with self._lock:
+            self.balance += 1
+            self.hedged -= 1
+
+
+budgets = {
+    "SF": HedgeBudget(float(os.environ.get("AIA_HEDGE_SF_BUDGET", "0.1"))),
+    "BA": HedgeBudget(float(os.environ.get("AIA_HEDGE_BA_BUDGET", "0.1"))),
+}
+
+
+def hedge_delay(name):
+    """返回触发对冲的等待时间，不满足条件时返回 None"""
+    if not HEDGE_ENABLED or name not in first_chunk:
+        return None
+    from aia.cassette import active_cassette
+    if active_cassette() is not None:
+        return None
+    stats = first_chunk[name]
+    if len(stats) < MIN_SAMPLES:
+        return None
+    return stats.percentile(HEDGE_PERCENTILE)
+
+
+class _Attempt(threading.Thread):
+    """在后台线程中读取一次流式请求，分片放入共享队列"""
+
+    def __init__(self, index, create, output):
+        super().__init__(daemon=True)
+        self.index = index
+        self.create = create
+        self.output = output
+        self.started = time.perf_counter()
+        self.stream = None
+        self._stop_event = threading.Event()
+
+    def run(self):
+        try:
+            self.stream = self.create()
+            for chunk in self.stream:
+                if self._stop_event.is_set():
+                    return
+                self.output.put((self.index, "chunk", chunk))
+            self.output.put((self.index, "end", None))
+        except Exception as e:
+            if not self._stop_event.is_set():
+                self.output.put((self.index, "error", e))
+        finally:
+            self.close()
+
+    def close(self):
+        self._stop_event.set()
+        close = getattr(self.stream, "close", None)
+        if close:
+            try:
+                close()
+            except Exception:
+                pass
+
+
+def hedged_stream(name, create, create_hedge=None, admit=None, cancel=None, release=None):
+    """返回流式分片的迭代器；首个分片迟迟不到时发出对冲请求，采用先输出的一方
+
+    create / create_hedge 为发起请求的函数，admit() 返回 False 时不对冲（例如没有限流配额）。
+    发出过对冲请求时，结束后调用一次 release() 结算落败一方预扣的配额（胜出一方由调用方按实际用量结算）。
+    cancel 被设置后关闭所有请求并结束迭代。不满足对冲条件时直接返回原请求的流。
+    首个分片耗时由调用方记录到 first_chunk。
+    """
+    budget = budgets.get(name)
+    if budget is None:
+        return create()
+    budget.deposit()
+    delay = hedge_delay(name)
+    if delay is None:
+        return create()
+    return _race(name, budget, delay, create, create_hedge, admit, cancel, release)
+
+
+def _race(name, budget, delay, create, create_hedge, admit, cancel, release):
+    output = queue.Queue()
+    attempts = [_Attempt(0, create, output)]
+    attempts[0].start()
+    failed = set()
+    winner = None
+    deadline = time.perf_counter() + delay
+
+    try:
+        while True:
+            if cancel is not None and cancel.is_set():
+                return
+            timeout = POLL_SECONDS
+            if winner is None and deadline is not None:
+                timeout = min(timeout, max(0.0, deadline - time.perf_counter()))
+            try:
+                index, kind, payload = output.get(timeout=timeout)
+            except queue.Empty:
+                if winner is None and deadline is not None and time.perf_counter() >= deadline:
+                    deadline = None
+                    if budget.withdraw():
+                        if admit is None or admit():
+                            logger.info(f"{name} 超过 {delay:.2f}秒未收到首个分片，发出对冲请求")
+                            hedge = _Attempt(1, create_hedge or create, output)
+                            attempts.append(hedge)
+                            hedge.start()
+                        else:
+                            budget.refund()
+                continue
+
+            if winner is not None and index != winner:
+                continue
+            if kind == "error":
+                failed.add(index)
+                if winner is None and len(failed) < len(attempts):
+                    logger.warning(f"{name} 请求失败，等待另一份请求: {payload}")
+                    continue
+                raise payload
+            if winner is None:
+                winner = index
+                for attempt in attempts:
+                    if attempt.index != index:
+                        attempt.close()
+                if index == 1:
+                    logger.info(f"{name} 对冲请求先开始输出，已关闭原请求"
+                                f"（累计对冲 {budget.hedged}/{budget.requests}）")
+            if kind == "end":
+                return
+            yield payload
+    finally:
+        for attempt in attempts:
+            attempt.close()
+        if len(attempts) > 1 and release is not None:
+            release()
@@ -0,0 +1,335 @@
+"""
+紧凑的对话记录
+
+SF 和 BA 两份历史共享同一份 TurnLog：每轮只保存一次原始用户输入，
+两个阶段的回复各占一列，未经过某个阶段的轮次在该列记为 None。
+MessageBuffer 只是按列派生出的视图，不复制文本。
+
+每轮的开销只是几个列表槽位、数组元素加上文本本身，而不是四个消息字典。
+除文本外还按列记录每轮的开始时间、两个阶段的耗时和语音文件路径，供导出使用；
+用户输入的模式前缀（！/#/&）单独一列，重新生成时按原来的模式再发送；
+写入长期记忆的轮次记下记忆中的行号，检索时据此排除仍在当前分支上的轮次。
+
+所有轮次组成一棵持久的树：各列是只追加的节点数组，parent 列记录上一轮的节点编号，
+head 指向当前分支的最后一轮。重新生成、编辑早先的消息都只是从某个节点另起一个子节点，
+分支之间共享公共前缀，不复制任何历史；切换分支只改动 head，当前分支的线性历史在下次使用时生成。
+节点编号只在清空、裁剪时变化（generation 递增）。
+同一轮的两个阶段由调用方用 begin_turn() 得到的 Turn 标识提交，才会写入同一个节点；
+不带标识的提交总是新建一个节点，连续两轮输入相同的文字也不会被合并。
+
+会话换出时用 to_bytes / from_bytes 做二进制快照：
+文本列写一个长度数组和一段连续的 UTF-8 数据，数值列直接写数组内容，读写都只需要几次整块操作。
+"""
+import math
+import struct
+import sys
+import time
+from array import array
+
+STAGES = ("sf", "ba")
+
+SNAPSHOT_MAGIC = b"AIAT"
+SNAPSHOT_VERSION = 1
+_HEADER = struct.Struct("<4sHI")
+_HEAD = struct.Struct("<i")
+
+# 每轮在五个列表中各占一个指针槽位，另有开始时间（8字节）、两个耗时（各4字节）、父节点编号和记忆行号（各4字节）
+TURN_OVERHEAD = 5 * 8 + 8 + 4 + 4 + 4 + 4
+
+
+def _pack_texts(column):
+    encoded = [b"" if text is None else text.encode("utf-8") for text in column]
+    lengths = array("i", (-1 if text is None else len(data) for text, data in zip(column, encoded)))
+    blob = b"".join(encoded)
+    return [lengths.tobytes(), struct.pack("<Q", len(blob)), blob]
+
+
+def _unpack_texts(view, offset, count):
+    lengths = array("i")
+    lengths.frombytes(view[offset:offset + count * lengths.itemsize])
+    offset += count * lengths.itemsize + 8
+    column = []
+    for length in lengths:
+        if length < 0:
+            column.append(None)
+        else:
+            column.append(str(view[offset:offset + length], "utf-8"))
+            offset += length
+    return column, offset
+
+
+def _unpack_numbers(view, offset, count, typecode):
+    numbers = array(typecode)
+    numbers.frombytes(view[offset:offset + count * numbers.itemsize])
+    return numbers, offset + count * numbers.itemsize
+
+
+class Turn:
+    """一轮对话的标识：同一轮的各阶段用同一个 Turn 提交，写入同一个节点
+
+    prefix 为用户输入的模式前缀，新建节点时记录下来。
+    """
+    __slots__ = ("node", "generation", "prefix")
+
+    def __init__(self, generation, prefix=None):
+        self.node = None
+        self.generation = generation
+        self.prefix = prefix
+
+
+class TurnLog:
+    __slots__ = ("user", "sf", "ba", "started", "sf_seconds", "ba_seconds", "audio", "prefix", "parent", "memory",
+                 "head", "version", "generation", "_path", "_counts", "_sized", "_bytes")
+
+    def __init__(self):
+        self.user = []
+        self.sf = []
+        self.ba = []
+        # 每轮的开始时间（时间戳）和各阶段耗时（秒，未经过该阶段为 NaN）
+        self.started = array("d")
+        self.sf_seconds = array("f")
+        self.ba_seconds = array("f")
+        # 语音回复文件路径
+        self.audio = []
+        # 用户输入的模式前缀（无前缀为 None）
+        self.prefix = []
+        # 上一轮的节点编号（-1 为第一轮）与当前分支最后一轮的节点
+        self.parent = array("i")
+        self.head = -1
+        # 该轮在长期记忆中的行号（-1 为未写入）
+        self.memory = array("i")
+        # 当前分支被切换、清空、裁剪时递增，视图据此重建缓存
+        self.version = 0
+        # 节点编号变化（清空、裁剪）时递增
+        self.generation = 0
+        # 当前分支的节点编号及各阶段轮数，切换分支后按需重新计算
+        self._path = None
+        self._counts = None
+        self._sized = 0
+        self._bytes = 0
+
+    def __len__(self):
+        """当前分支的轮数"""
+        return len(self.path())
+
+    @property
+    def nodes(self):
+        """所有分支的节点总数"""
+        return len(self.user)
+
+    def path(self):
+        """当前分支从第一轮到最后一轮的节点编号"""
+        if self._path is None:
+            path = []
+            node = self.head
+            while node >= 0:
+                path.append(node)
+                node = self.parent[node]
+            path.reverse()
+            self._path = path
+            self._counts = {stage: sum(self.column(stage)[n] is not None for n in path) for stage in STAGES}
+        return self._path
+
+    def count(self, stage):
+        """当前分支中某个阶段已完成的轮数"""
+        self.path()
+        return self._counts[stage]
+
+    def column(self, stage):
+        """某个阶段的回复列（按节点编号，包含所有分支）"""
+        return self.sf if stage == "sf" else self.ba
+
+    def last(self, stage):
+        """当前分支最后一轮某个阶段的回复，没有时返回 None"""
+        return self.column(stage)[self.head] if self.head >= 0 else None
+
+    def begin_turn(self, prefix=None):
+        """开始新的一轮，返回传给各阶段提交的 Turn 标识；prefix 为本轮输入的模式前缀"""
+        return Turn(self.generation, prefix)
+
+    def input(self, node):
+        """某个节点的原始输入：带上模式前缀，重新发送时按原来的模式处理"""
+        return (self.prefix[node] or "") + self.user[node]
+
+    def record(self, stage, user, reply, turn=None):
+        """记录某个阶段的回复，返回写入的节点编号
+
+        turn 已有节点（同一轮的另一个阶段先提交）且该阶段尚无回复时补到这个节点，
+        否则在当前分支末尾新建一个节点。两个视图各自只读取自己的列，所以合并与否都不影响视图内容。
+        """
+        column = self.column(stage)
+        node = turn.node if turn is not None and turn.generation == self.generation else None
+        if node is not None and column[node] is None:
+            column[node] = reply
+            if node < self._sized:
+                self._bytes += sys.getsizeof(reply)
+        else:
+            node = len(self.user)
+            self.user.append(user)
+            self.sf.append(None)
+            self.ba.append(None)
+            self.started.append(time.time())
+            self.sf_seconds.append(math.nan)
+            self.ba_seconds.append(math.nan)
+            self.audio.append(None)
+            self.prefix.append(turn.prefix if turn is not None else None)
+            self.parent.append(self.head)
+            self.memory.append(-1)
+            column[node] = reply
+            self.head = node
+            if self._path is not None:
+                self._path.append(node)
+            if turn is not None:
+                turn.node, turn.generation = node, self.generation
+        if self._counts is not None:
+            self._counts[stage] += 1
+        return node
+
+    def amend(self, stage, reply):
+        """替换当前分支最后一轮某个阶段的回复（例如追加补充内容）"""
+        node = self.head
+        column = self.column(stage)
+        if node < 0 or column[node] is None:
+            return
+        if node < self._sized:
+            self._bytes += sys.getsizeof(reply) - sys.getsizeof(column[node])
+        column[node] = reply
+
+    def set_seconds(self, stage, seconds, node=None):
+        """记录某个节点（默认当前分支最后一轮）某个阶段的耗时"""
+        node = self.head if node is None else node
+        if node >= 0:
+            (self.sf_seconds if stage == "sf" else self.ba_seconds)[node] = seconds
+
+    def set_audio(self, path, node=None, generation=None):
+        """记录某个节点（默认当前分支最后一轮）的语音文件路径
+
+        语音在后台生成时，完成前记录可能已被清空或裁剪：传入开始时的 generation，不一致时不记录。
+        """
+        if generation is not None and generation != self.generation:
+            return
+        node = self.head if node is None else node
+        if 0 <= node < len(self.audio):
+            self.audio[node] = str(path)
+
+    def set_memory(self, row, node):
+        """记录某个节点写入长期记忆后的行号（row 为 None 表示没有写入）"""
+        if row is not None and node is not None and 0 <= node < len(self.memory):
+            self.memory[node] = row
+
+    def memory_rows(self):
+        """当前分支上已写入长期记忆的行号，检索时排除（这些轮次仍在实时历史中）"""
+        return [self.memory[n] for n in self.path() if self.memory[n] >= 0]
+
+    def pairs(self, stage):
+        """按顺序返回当前分支某个阶段的 (用户输入, 回复)"""
+        column = self.column(stage)
+        return [(self.user[n], column[n]) for n in self.path() if column[n] is not None]
+
+    def checkout(self, node):
+        """把当前分支切换到以 node 结尾的分支（-1 表示从头开始），只移动 head"""
+        if not -1 <= node < len(self.user):
+            raise IndexError(f"没有编号为 {node} 的对话节点")
+        self.head = node
+        self._path = None
+        self._counts = None
+        self.version += 1
+
+    def leaves(self):
+        """所有分支末端的节点编号"""
+        has_child = set(self.parent)
+        return [n for n in range(len(self.user)) if n not in has_child]
+
+    def trim(self, max_turns):
+        """当前分支超过 max_turns 轮时丢弃最早的一半，返回丢弃的轮数
+
+        一次多丢一些而不是每轮丢一轮，前缀只在裁剪的那一轮变化，其余轮次仍可命中缓存。
+        只保留从新的第一轮分出去的节点，在被丢弃部分分叉的其他分支一并丢弃。
+        """
+        path = self.path()
+        if max_turns <= 0 or len(path) <= max_turns:
+            return 0
+        dropped = len(path) - max_turns // 2
+        root = path[dropped]
+        # 父节点总是先于子节点创建，一次正向遍历即可找出 root 的所有后代
+        keep = {root}
+        for node in range(root + 1, len(self.user)):
+            if self.parent[node] in keep:
+                keep.add(node)
+        self._compact(sorted(keep), root)
+        return dropped
+
+    def _compact(self, kept, root):
+        """只保留 kept 中的节点并重新编号，root 成为第一轮"""
+        index = {node: i for i, node in enumerate(kept)}
+        self.user = [self.user[n] for n in kept]
+        self.sf = [self.sf[n] for n in kept]
+        self.ba = [self.ba[n] for n in kept]
+        self.audio = [self.audio[n] for n in kept]
+        self.prefix = [self.prefix[n] for n in kept]
+        self.started = array("d", (self.started[n] for n in kept))
+        self.sf_seconds = array("f", (self.sf_seconds[n] for n in kept))
+        self.ba_seconds = array("f", (self.ba_seconds[n] for n in kept))
+        self.parent = array("i", (-1 if n == root else index[self.parent[n]] for n in kept))
+        self.memory = array("i", (self.memory[n] for n in kept))
+        self.head = index.get(self.head, -1)
+        self._changed()
+
+    def clear(self):
+        self.user.clear()
+        self.sf.clear()
+        self.ba.clear()
+        self.audio.clear()
+        self.prefix.clear()
+        del self.started[:], self.sf_seconds[:], self.ba_seconds[:], self.parent[:], self.memory[:]
+        self.head = -1
+        self._changed()
+
+    def _changed(self):
+        self._path = None
+        self._counts = None
+        self._sized = 0
+        self._bytes = 0
+        self.version += 1
+        self.generation += 1
+
+    def size_bytes(self):
+        """估算占用的内存，只累加新增的节点"""
+        for i in range(self._sized, len(self.user)):
+            self._bytes += TURN_OVERHEAD + sys.getsizeof(self.user[i])
+            for reply in (self.sf[i], self.ba[i]):
+                if reply is not None:
+                    self._bytes += sys.getsizeof(reply)
+        self._sized = len(self.user)
+        return self._bytes
+
+    def to_bytes(self):
+        """二进制快照"""
+        parts = [_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(self.user))]
+        for column in (self.user, self.sf, self.ba, self.prefix, self.audio):
+            parts.extend(_pack_texts(column))
+        for numbers in (self.started, self.sf_seconds, self.ba_seconds, self.parent, self.memory):
+            parts.append(numbers.tobytes())
+        parts.append(_HEAD.pack(self.head))
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        magic, version, count = _HEADER.unpack_from(data, 0)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError("无法识别的对话记录快照")
+        log = cls()
+        view = memoryview(data)
+        offset = _HEADER.size
+        log.user, offset = _unpack_texts(view, offset, count)
+        log.sf, offset = _unpack_texts(view, offset, count)
+        log.ba, offset = _unpack_texts(view, offset, count)
+        log.prefix, offset = _unpack_texts(view, offset, count)
+        log.audio, offset = _unpack_texts(view, offset, count)
+        log.started, offset = _unpack_numbers(view, offset, count, "d")
+        log.sf_seconds, offset = _unpack_numbers(view, offset, count, "f")
+        log.ba_seconds, offset = _unpack_numbers(view, offset, count, "f")
+        log.parent, offset = _unpack_numbers(view, offset, count, "i")
+        log.memory, offset = _unpack_numbers(view, offset, count, "i")
+        (log.head,) = _HEAD.unpack_from(view, offset)
+        return log
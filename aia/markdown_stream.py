@@ -0,0 +1,205 @@
+"""
+流式 Markdown 解析
+
+聊天区逐个分片显示回复时，如果每来一个分片就把整段回复重新解析、重新插入，
+总开销是回复长度的平方。MarkdownStream 只解析新到达的部分：
+- 行首只缓存判断行类型所需的几个字符（标题、列表、引用、代码块围栏、分隔线）
+- 行内只为 ** 多等一个字符，其余文本立即输出
+- 解析状态（是否在代码块、粗体、行内代码中）跨分片保留
+输出为 (文本, 标签元组) 片段，与界面无关：GUI 在工作线程中解析，
+Tk 线程只按片段插入文本并套用同名的 Text 标签。
+
+支持的标签：md_h1 / md_h2 / md_h3、md_list、md_quote、md_code（代码块和行内代码）、md_bold、md_hr
+"""
+import re
+
+# 判断行类型前最多缓存的字符数（足够看到 "###### "、"100. "、"```"）
+LINE_LOOKAHEAD = 8
+
+FENCE = re.compile(r"[ \t]*(```|~~~)")
+HEADING = re.compile(r"(#{1,6})[ \t]+")
+BULLET = re.compile(r"([ \t]*)[-*+][ \t]+")
+NUMBERED = re.compile(r"([ \t]*)(\d{1,3}[.)])[ \t]+")
+QUOTE = re.compile(r"[ \t]*>[ \t]?")
+HORIZONTAL_RULE = re.compile(r"[ \t]*([-*_])([ \t]*\1){2,}[ \t]*(\n|\Z)")
+RULE_PREFIX = re.compile(r"[ \t]*[-*_][-*_ \t]*\Z")
+INLINE = re.compile(r"[*`\n]")
+IN_CODE_SPAN = re.compile(r"[`\n]")
+
+HR_TEXT = "─" * 24
+
+
+class MarkdownStream:
+    def __init__(self):
+        self._buffer = ""
+        # 已解析到的位置；每次解析结束后才丢弃已处理的部分，避免反复复制剩余文本
+        self._pos = 0
+        self._line_started = False
+        self._line_tags = ()
+        self._fence = None
+        self._bold = False
+        self._code_span = False
+        self._final = False
+        self._out = []
+
+    def feed(self, text):
+        """解析新到达的文本，返回可以立即显示的片段"""
+        self._buffer += text
+        self._parse()
+        return self._take()
+
+    def close(self):
+        """输入结束，输出缓存中剩余的内容"""
+        self._final = True
+        self._parse()
+        return self._take()
+
+    def _take(self):
+        out, self._out = self._out, []
+        return [("".join(parts), tags) for tags, parts in out]
+
+    def _emit(self, text, tags):
+        """相邻且标签相同的文本合并为一个片段，减少 Tk 插入次数"""
+        if not text:
+            return
+        if self._out and self._out[-1][0] == tags:
+            self._out[-1][1].append(text)
+        else:
+            self._out.append((tags, [text]))
+
+    def _inline_tags(self):
+        tags = self._line_tags
+        if self._code_span:
+            tags += ("md_code",)
+        elif self._bold:
+            tags += ("md_bold",)
+        return tags
+
+    def _end_line(self):
+        self._line_started = False
+        self._line_tags = ()
+        self._bold = False
+        self._code_span = False
+
+    def _skip_line(self):
+        """丢弃当前整行（围栏行）"""
+        end = self._buffer.find("\n", self._pos)
+        self._pos = len(self._buffer) if end < 0 else end + 1
+
+    def _parse(self):
+        while self._pos < len(self._buffer):
+            if not self._line_started:
+                if not self._start_line():
+                    break
+            elif self._fence is not None:
+                self._code_line()
+            elif not self._inline():
+                break
+        self._buffer = self._buffer[self._pos:]
+        self._pos = 0
+
+    def _start_line(self):
+        """在行首判断行类型，字符不够判断时返回 False 等待后续分片"""
+        buffer, pos = self._buffer, self._pos
+        complete = self._final or buffer.find("\n", pos) >= 0
+        if self._fence is not None:
+            if not complete:
+                # 行内还没有换行，剩余文本就是这一行已到达的部分
+                partial = buffer[pos:].lstrip(" \t")
+                if self._fence.startswith(partial) or partial.startswith(self._fence):
+                    return False
+            match = FENCE.match(buffer, pos)
+            if match and match.group(1) == self._fence:
+                self._skip_line()
+                self._fence = None
+                return True
+            self._line_started = True
+            self._line_tags = ("md_code",)
+            return True
+
+        if not complete and (len(buffer) - pos < LINE_LOOKAHEAD or RULE_PREFIX.match(buffer, pos)):
+            return False
+        match = FENCE.match(buffer, pos)
+        if match:
+            if not complete:
+                return False
+            # 开始围栏（含语言标记）整行丢弃
+            self._fence = match.group(1)
+            self._skip_line()
+            return True
+        match = HORIZONTAL_RULE.match(buffer, pos)
+        if match:
+            self._emit(HR_TEXT + match.group(3), ("md_hr",))
+            self._pos = match.end()
+            return True
+
+        self._line_started = True
+        match = HEADING.match(buffer, pos)
+        if match:
+            self._line_tags = (f"md_h{min(len(match.group(1)), 3)}",)
+            self._pos = match.end()
+            return True
+        match = BULLET.match(buffer, pos)
+        if match:
+            self._line_tags = ("md_list",)
+            self._emit(f"{match.group(1)}• ", self._line_tags)
+            self._pos = match.end()
+            return True
+        match = NUMBERED.match(buffer, pos)
+        if match:
+            self._line_tags = ("md_list",)
+            self._emit(f"{match.group(1)}{match.group(2)} ", self._line_tags)
+            self._pos = match.end()
+            return True
+        match = QUOTE.match(buffer, pos)
+        if match:
+            self._line_tags = ("md_quote",)
+            self._pos = match.end()
+        return True
+
+    def _code_line(self):
+        buffer, pos = self._buffer, self._pos
+        end = buffer.find("\n", pos)
+        if end < 0:
+            self._emit(buffer[pos:], self._line_tags)
+            self._pos = len(buffer)
+            return
+        self._emit(buffer[pos:end + 1], self._line_tags)
+        self._pos = end + 1
+        self._end_line()
+
+    def _inline(self):
+        """处理行内粗体和行内代码，需要等待下一个字符时返回 False"""
+        buffer, pos = self._buffer, self._pos
+        match = (IN_CODE_SPAN if self._code_span else INLINE).search(buffer, pos)
+        if match is None:
+            self._emit(buffer[pos:], self._inline_tags())
+            self._pos = len(buffer)
+            return True
+        start = match.start()
+        self._emit(buffer[pos:start], self._inline_tags())
+        char = match.group()
+        if char == "\n":
+            self._emit("\n", self._line_tags)
+            self._pos = start + 1
+            self._end_line()
+        elif char == "`":
+            self._code_span = not self._code_span
+            self._pos = start + 1
+        elif start + 1 >= len(buffer) and not self._final:
+            # 单个 * 还不能确定是否是 ** 的一半
+            self._pos = start
+            return False
+        elif buffer.startswith("**", start):
+            self._bold = not self._bold
+            self._pos = start + 2
+        else:
+            self._emit("*", self._inline_tags())
+            self._pos = start + 1
+        return True
+
+
+def render(text):
+    """一次性解析完整文本"""
+    stream = MarkdownStream()
+    return stream.feed(text) + stream.close()
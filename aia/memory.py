@@ -0,0 +1,228 @@
+"""
+本地长期记忆
+
+每轮对话结束后把（用户输入, 回复）编码为哈希 TF-IDF 向量，追加写入磁盘索引；
+新消息到来时只检索最相关的 top-k 段历史对话，拼进本轮请求（最后一条用户消息），
+不改动已发送的历史，服务端前缀缓存不受影响。
+开启长期记忆后，实时历史只保留最近若干轮，更早的内容靠检索找回。
+
+向量化不依赖模型：中文按单字和相邻两字、其他文本按单词提取特征，
+哈希到固定维度（带符号哈希，减少冲突偏差），词频取对数后归一化。
+检索时查询向量按 IDF 加权，与全部向量做一次矩阵乘法，数万轮时仍在毫秒级。
+
+索引目录结构：
+- vectors.f32：float32 向量，逐行追加
+- turns.jsonl：对应的对话文本，逐行追加，检索结果按偏移量读取
+
+需要 NumPy；未安装时长期记忆不可用，程序照常运行。
+
+环境变量：
+- AIA_MEMORY：设为1开启长期记忆（默认关闭：开启后对话会写入磁盘，实时历史也会被裁剪）
+- AIA_MEMORY_TOP_K：每轮检索的历史对话数（默认3）
+- AIA_HISTORY_MAX_TURNS：开启长期记忆后实时历史保留的最大轮数（默认20）
+"""
+import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+import zlib
+from array import array
+from pathlib import Path
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+MEMORY_ENABLED = os.environ.get("AIA_MEMORY", "0") == "1"
+TOP_K = int(os.environ.get("AIA_MEMORY_TOP_K", "3"))
+HISTORY_MAX_TURNS = int(os.environ.get("AIA_HISTORY_MAX_TURNS", "20"))
+
+DIM = 512
+# 余弦相似度低于该值的结果视为不相关
+MIN_SCORE = 0.15
+# 检索结果中每段文字的最大长度
+RECALL_MAX_CHARS = 200
+
+CJK_RUN = re.compile(r"[㐀-䶿一-鿿]+")
+WORD = re.compile(r"[a-z0-9_]{2,}")
+
+
+def features(text):
+    """提取特征：中文单字与相邻两字，其他文本按单词"""
+    text = text.lower()
+    for run in CJK_RUN.findall(text):
+        yield from run
+        for i in range(len(run) - 1):
+            yield run[i:i + 2]
+    yield from WORD.findall(CJK_RUN.sub(" ", text))
+
+
+def vectorize(text, dim=DIM):
+    """文本转为归一化的哈希词频向量"""
+    counts = {}
+    for feature in features(text):
+        h = zlib.crc32(feature.encode("utf-8"))
+        index = h % dim
+        sign = 1.0 if h & 0x80000000 else -1.0
+        counts[index] = counts.get(index, 0.0) + sign
+    vector = np.zeros(dim, dtype=np.float32)
+    for index, count in counts.items():
+        if count:
+            vector[index] = math.copysign(1.0 + math.log(abs(count)), count)
+    norm = np.linalg.norm(vector)
+    if norm:
+        vector /= norm
+    return vector
+
+
+def _clip(text, limit=RECALL_MAX_CHARS):
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[:limit] + "…"
+
+
+class LongTermMemory:
+    def __init__(self, store_dir, dim=DIM, top_k=TOP_K, min_score=MIN_SCORE):
+        self.store_dir = Path(store_dir)
+        self.dim = dim
+        self.top_k = top_k
+        self.min_score = min_score
+        self._lock = threading.Lock()
+        self._vectors_path = self.store_dir / "vectors.f32"
+        self._turns_path = self.store_dir / "turns.jsonl"
+        self._matrix = np.empty((1024, dim), dtype=np.float32)
+        self._df = np.zeros(dim, dtype=np.int64)
+        self._offsets = array("q")
+        self._count = 0
+        self._load()
+
+    def __len__(self):
+        return self._count
+
+    def _load(self):
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        if not self._vectors_path.exists() or not self._turns_path.exists():
+            return
+        start = time.perf_counter()
+        offset = 0
+        with open(self._turns_path, "rb") as f:
+            for line in f:
+                self._offsets.append(offset)
+                offset += len(line)
+        vectors = np.fromfile(self._vectors_path, dtype=np.float32)
+        rows = min(len(self._offsets), len(vectors) // self.dim)
+        # 两个文件长度不一致（例如写入中途退出）时以较短的为准
+        del self._offsets[rows:]
+        self._reserve(rows)
+        self._matrix[:rows] = vectors[:rows * self.dim].reshape(rows, self.dim)
+        self._df += np.count_nonzero(self._matrix[:rows], axis=0)
+        self._count = rows
+        logger.info(f"长期记忆已加载: {rows} 轮，耗时 {(time.perf_counter() - start) * 1000:.1f}毫秒")
+
+    def _reserve(self, rows):
+        if rows <= len(self._matrix):
+            return
+        capacity = len(self._matrix)
+        while capacity < rows:
+            capacity *= 2
+        matrix = np.empty((capacity, self.dim), dtype=np.float32)
+        matrix[:self._count] = self._matrix[:self._count]
+        self._matrix = matrix
+
+    def add(self, user_text, reply_text):
+        """记录一轮对话，返回该轮在索引中的行号；没有写入时返回 None"""
+        if not user_text or not reply_text:
+            return None
+        vector = vectorize(f"{user_text}\n{reply_text}", self.dim)
+        line = (json.dumps({"user": user_text, "reply": reply_text, "time": time.time()},
+                           ensure_ascii=False) + "\n").encode("utf-8")
+        with self._lock:
+            try:
+                with open(self._turns_path, "ab") as f:
+                    offset = f.tell()
+                    f.write(line)
+                with open(self._vectors_path, "ab") as f:
+                    vector.tofile(f)
+            except OSError as e:
+                logger.error(f"写入长期记忆失败: {e}")
+                return None
+            row = self._count
+            self._reserve(row + 1)
+            self._matrix[row] = vector
+            self._df += vector != 0
+            self._offsets.append(offset)
+            self._count += 1
+        return row
+
+    def clear(self):
+        """删除全部记录（对话被清空时调用，之后不会再检索到被清空的内容）"""
+        with self._lock:
+            try:
+                for path in (self._turns_path, self._vectors_path):
+                    path.unlink(missing_ok=True)
+            except OSError as e:
+                logger.error(f"清空长期记忆失败: {e}")
+                return
+            self._df[:] = 0
+            del self._offsets[:]
+            self._count = 0
+        logger.info("长期记忆已清空")
+
+    def recall(self, query, exclude=()):
+        """检索与 query 最相关的历史对话，exclude 为仍在实时历史中的轮次的行号（add 的返回值）"""
+        with self._lock:
+            excluded = sorted({row for row in exclude if 0 <= row < self._count})
+            count = self._count - len(excluded)
+            if count <= 0 or self.top_k <= 0:
+                return []
+            start = time.perf_counter()
+            query_vector = vectorize(query, self.dim)
+            if not query_vector.any():
+                return []
+            matrix = self._matrix[:self._count]
+            idf = np.log((1 + self._count) / (1 + self._df)).astype(np.float32) + 1.0
+            scores = matrix @ (query_vector * idf * idf)
+            scores[excluded] = -np.inf
+            k = min(self.top_k, count)
+            candidates = np.argpartition(-scores, k - 1)[:k]
+            candidates = candidates[np.argsort(-scores[candidates])]
+            # 候选结果再按未加权的余弦相似度过滤掉不相关的
+            similarity = matrix[candidates] @ query_vector
+            hits = [(int(row), float(score)) for row, score in zip(candidates, similarity)
+                    if score >= self.min_score]
+            entries = []
+            with open(self._turns_path, "rb") as f:
+                for row, score in hits:
+                    f.seek(self._offsets[row])
+                    entry = json.loads(f.readline())
+                    entry["score"] = score
+                    entries.append(entry)
+        logger.info(f"长期记忆检索: {count} 轮中命中 {len(entries)} 条，"
+                    f"耗时 {(time.perf_counter() - start) * 1000:.2f}毫秒")
+        return entries
+
+
+def format_recalled(entries):
+    """把检索结果整理为请求中的参考文本"""
+    return "\n".join(
+        f"- 用户: {_clip(entry['user'])}\n  回复: {_clip(entry['reply'])}" for entry in entries
+    )
+
+
+def create_memory(store_dir):
+    """按配置创建长期记忆，未启用或缺少 NumPy 时返回 None"""
+    if not MEMORY_ENABLED:
+        return None
+    if np is None:
+        logger.warning("未安装 NumPy，长期记忆不可用（pip install numpy）")
+        return None
+    try:
+        return LongTermMemory(store_dir)
+    except Exception as e:
+        logger.error(f"长期记忆初始化失败: {e}", exc_info=True)
+        return None
@@ -0,0 +1,52 @@
+"""
+轻量的耗时统计
+
+只保留最近一段窗口内的样本，用于估算中位数、分位数等，
+供自动模式估算节省耗时、对冲请求计算等待阈值等场景使用。
+"""
+import threading
+from collections import deque
+
+
+class LatencyStats:
+    def __init__(self, window=200):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        if seconds is None:
+            return
+        with self._lock:
+            self._samples.append(seconds)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def percentile(self, p, default=None):
+        """返回第 p 百分位（0-100），没有样本时返回 default"""
+        with self._lock:
+            if not self._samples:
+                return default
+            ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, max(0, round(p / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+    def median(self, default=None):
+        return self.percentile(50, default)
+
+
+# 各阶段的总耗时与首字耗时
+stage_latency = {
+    "SF": LatencyStats(),
+    "BA": LatencyStats(),
+}
+stage_ttft = {
+    "SF": LatencyStats(),
+    "BA": LatencyStats(),
+}
+
+# 各限流器的排队等待时间（见 aia.ratelimit）
+rate_wait = {}
+
+# 各插件钩子的调用耗时，键为“钩子:插件名”（见 aia.plugins）
+hook_latency = {}
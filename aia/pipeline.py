@@ -0,0 +1,418 @@
+"""
+SF / BA 两阶段对话管线
+
+mainCLI.py 和 mainUI.py 共用这里的请求构建与调用逻辑：
+- SF（DeepSeek-R1）负责逻辑分析
+- BA（GPT-4o）基于分析结果给出人性化回复
+两个阶段都通过 MessageBuffer 原地追加消息，保持提示词前缀稳定。
+SF的推理过程不会进入BA和历史，正文压缩为结构化摘要后再交给BA（见 aia.digest）。
+两个阶段的请求内容和结果都会经过插件的预处理、后处理钩子（见 aia.plugins）。
+并行模式下SF在后台线程中分析，BA先直接回复，分析完成后再按需简短补充。
+用户偏好变化后可以只重新生成BA回复，沿用该轮已保存的分析摘要，不再调用SF。
+
+环境变量：
+- AIA_BOTH_REFINE：设为0时并行模式只显示分析结果，不再请求BA补充回复
+"""
+import logging
+import math
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+from aia.digest import build_digest, split_reasoning
+from aia.hedging import hedged_stream, alternates, first_chunk
+from aia.metrics import stage_latency, stage_ttft
+from aia.plugins import plugins
+from aia.ratelimit import limiter_for
+from aia.singleflight import sf_flights, messages_key
+from aia.tokens import estimate_tokens, estimate_messages_tokens
+
+logger = logging.getLogger(__name__)
+
+SF_MODEL = "deepseek-ai/DeepSeek-R1"
+BA_MODEL = "gpt-4o"
+
+# 限流预扣时对输出 token 数的估计，收到实际用量后修正
+OUTPUT_TOKENS_ESTIMATE = {"SF": 1500, "BA": 600}
+
+# SF固定提示词 - 专注于逻辑分析
+SF_PROMPT = (
+    "你是一个逻辑分析助手。请对用户的问题进行深入的逻辑分析，包括：\n"
+    "1. 问题的核心要点\n"
+    "2. 可能的解决思路\n"
+    "3. 需要考虑的关键因素\n"
+    "4. 逻辑推理过程\n"
+    "请提供结构化的分析结果，不需要人性化的表达，专注于逻辑和事实。"
+)
+
+# BA请求模板：固定说明在前，逐轮变化的内容在后
+BA_ANALYSIS_TEMPLATE = (
+    "基于以下逻辑分析结果，请给用户一个人性化、温暖的回复：\n\n"
+    "【逻辑分析(deepseek分析)】\n{analysis}\n\n"
+    "【用户原问题】\n{question}\n\n"
+    "请结合分析结果，用符合用户偏好的方式进行回复。"
+)
+
+# 并行模式：分析完成后请BA对照分析补充刚才的直接回复
+REFINE_ENABLED = os.environ.get("AIA_BOTH_REFINE", "1") != "0"
+NO_REFINEMENT = "无需补充"
+BA_REFINE_TEMPLATE = (
+    "以下是针对用户上一个问题的深入逻辑分析：\n\n{analysis}\n\n"
+    "请对照分析检查你刚才的回答：只有遗漏要点或需要修正时，用一两句话简短补充，不要重复已经说过的内容；"
+    "没有需要补充的内容时只回复“" + NO_REFINEMENT + "”。"
+)
+
+# 长期记忆检索结果放在本轮请求的开头，提交后不进入历史
+RECALL_TEMPLATE = "【相关的历史对话（供参考）】\n{recalled}\n\n{request}"
+
+
+# 并行模式下SF和BA可能同时读写同一份 TurnLog：begin 按记录重建消息列表，commit 写入记录，
+# rollback 撤销请求消息，三者都在锁内进行
+_commit_lock = threading.Lock()
+
+
+class StageCancelled(Exception):
+    """请求被调用方取消（例如预判分析作废）"""
+
+
+class StageResult:
+    """单个阶段的调用结果"""
+    __slots__ = ("content", "reasoning", "usage", "duration", "ttft", "digest", "wait", "hooks")
+
+    def __init__(self, content, reasoning=None, usage=None, duration=0.0, ttft=None, digest=None, wait=0.0,
+                 hooks=None):
+        self.content = content
+        self.reasoning = reasoning
+        self.usage = usage
+        self.duration = duration
+        self.ttft = ttft
+        self.digest = digest
+        self.wait = wait
+        # 插件钩子耗时 {钩子: 秒数}
+        self.hooks = hooks if hooks is not None else {}
+
+    @property
+    def prompt_tokens(self):
+        return getattr(self.usage, "prompt_tokens", None)
+
+    @property
+    def cached_tokens(self):
+        return cached_prompt_tokens(self.usage)
+
+    def copy(self):
+        """浅复制，hooks 单独复制一份"""
+        return StageResult(self.content, self.reasoning, self.usage, self.duration,
+                           self.ttft, self.digest, self.wait, dict(self.hooks))
+
+    @property
+    def total_tokens(self):
+        total = getattr(self.usage, "total_tokens", None)
+        if total is None and self.prompt_tokens is not None:
+            total = self.prompt_tokens + (getattr(self.usage, "completion_tokens", None) or 0)
+        return total
+
+
+def cached_prompt_tokens(usage):
+    """读取服务端返回的前缀缓存命中 token 数，未返回时为 None"""
+    if usage is None:
+        return None
+    # OpenAI 格式
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None) if details is not None else None
+    if cached is None:
+        # DeepSeek / SiliconFlow 格式
+        cached = getattr(usage, "prompt_cache_hit_tokens", None)
+    return cached
+
+
+def limited_completion(name, client, model, messages, temperature, on_delta=None, cancel=None):
+    """经过（服务商, 密钥）限流器排队后再调用接口"""
+    limiter = limiter_for(name, getattr(client, "api_key", ""))
+    prompt_tokens = estimate_messages_tokens(messages)
+    reserved = prompt_tokens + OUTPUT_TOKENS_ESTIMATE[name]
+    wait = limiter.acquire(reserved)
+    try:
+        # 对冲落败的一方已发出请求但输出被中途关闭，只按输入计入用量
+        result = stream_completion(client, model, messages, temperature, on_delta, cancel,
+                                   hedge_name=name, admit=lambda: limiter.try_acquire(reserved),
+                                   release=lambda: limiter.settle(reserved, prompt_tokens))
+    except Exception as e:
+        limiter.report_error(e)
+        raise
+    limiter.settle(reserved, result.total_tokens)
+    result.wait = wait
+    return result
+
+
+def stream_completion(client, model, messages, temperature, on_delta=None, cancel=None,
+                      hedge_name=None, admit=None, release=None):
+    """以流式方式调用接口，汇总正文、推理内容、用量并记录首字耗时
+
+    cancel 为 threading.Event，被设置后关闭连接并抛出 StageCancelled。
+    指定 hedge_name 时首个分片迟迟不到会发出对冲请求（见 aia.hedging）。
+    """
+    start = time.perf_counter()
+    ttft = None
+    first = None
+    content_parts = []
+    reasoning_parts = []
+    usage = None
+
+    def create(target=client):
+        return target.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+
+    if hedge_name is None:
+        stream = create()
+    else:
+        alternate = alternates.get(hedge_name)
+        create_hedge = (lambda: create(alternate)) if alternate is not None else None
+        stream = hedged_stream(hedge_name, create, create_hedge, admit, cancel, release)
+    try:
+        for chunk in stream:
+            if cancel is not None and cancel.is_set():
+                raise StageCancelled()
+            if getattr(chunk, "usage", None) is not None:
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+            if first is None:
+                first = time.perf_counter() - start
+                if hedge_name in first_chunk:
+                    first_chunk[hedge_name].add(first)
+            delta = chunk.choices[0].delta
+            reasoning = getattr(delta, "reasoning_content", None)
+            if reasoning:
+                reasoning_parts.append(reasoning)
+            content = getattr(delta, "content", None)
+            if content:
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+                content_parts.append(content)
+                if on_delta:
+                    on_delta(content)
+    finally:
+        close = getattr(stream, "close", None)
+        if close:
+            close()
+    if cancel is not None and cancel.is_set():
+        raise StageCancelled()
+
+    return StageResult(
+        content="".join(content_parts),
+        reasoning="".join(reasoning_parts) or None,
+        usage=usage,
+        duration=time.perf_counter() - start,
+        ttft=ttft
+    )
+
+
+def log_stage(name, result):
+    """记录阶段耗时、首字耗时、缓存命中与插件耗时"""
+    ttft = f"{result.ttft:.2f}秒" if result.ttft is not None else "未知"
+    message = f"{name}完成，耗时: {result.duration:.2f}秒，首字: {ttft}"
+    if result.wait >= 0.01:
+        message += f"，限流等待: {result.wait:.2f}秒"
+    if result.prompt_tokens is not None:
+        cached = result.cached_tokens
+        message += f"，输入token: {result.prompt_tokens}"
+        if cached is not None:
+            message += f"，缓存命中: {cached}"
+    if result.hooks:
+        message += "，插件: " + "、".join(f"{hook} {seconds * 1000:.0f}毫秒" for hook, seconds in result.hooks.items())
+    logger.info(message)
+
+
+def with_recalled(request, recalled=None):
+    """在本轮请求前附加长期记忆检索到的历史对话"""
+    if not recalled:
+        return request
+    return RECALL_TEMPLATE.format(recalled=recalled, request=request)
+
+
+def sf_request(display_text, recalled=None, timings=None):
+    """构建SF本轮请求内容：经过 pre_sf 插件处理，并附加长期记忆"""
+    return with_recalled(plugins.apply("pre_sf", display_text, timings), recalled)
+
+
+def run_sf_stage(client_sf, buffer_sf, display_text, on_delta=None, recalled=None, turn=None):
+    """SF逻辑分析，成功后把分析摘要写入SF历史
+
+    result.content 为去掉推理过程后的完整正文（用于展示），
+    result.digest 为交给BA的压缩摘要。
+    turn 为本轮的 Turn 标识，BA用同一个标识提交时两个阶段记为同一轮。
+    """
+    logger.info("SF正在进行逻辑分析...")
+    timings = {}
+    request = sf_request(display_text, recalled, timings)
+    with _commit_lock:
+        messages = buffer_sf.begin(request)
+    logger.debug(f"SF请求消息数: {len(messages)}")
+    start = time.perf_counter()
+    first_delta = []
+
+    def forward(chunk):
+        if not first_delta:
+            first_delta.append(time.perf_counter() - start)
+        if on_delta:
+            on_delta(chunk)
+
+    try:
+        # 消息列表完全相同的并发请求共用一次上游调用
+        result, shared = sf_flights.run(
+            messages_key(SF_MODEL, messages),
+            lambda publish: analyze(client_sf, messages, publish),
+            forward
+        )
+    except Exception:
+        with _commit_lock:
+            buffer_sf.rollback()
+        raise
+    # 合并请求的结果由发起者和所有等待者共用，只读；后处理（post_sf 插件、钩子耗时）各自在副本上进行
+    result = result.copy()
+    if shared:
+        result.duration = time.perf_counter() - start
+        result.ttft = first_delta[0] if first_delta else None
+        result.wait = 0.0
+    result.hooks.update(timings)
+    return finish_sf_stage(buffer_sf, display_text, result, "SF分析（合并请求）" if shared else "SF分析", turn)
+
+
+def finish_sf_stage(buffer_sf, display_text, result, label="SF分析", turn=None):
+    """经过 post_sf 插件处理后记录耗时统计，并把摘要写入SF历史"""
+    content = plugins.apply("post_sf", result.content, result.hooks)
+    if content is not result.content:
+        result.content = content
+        result.digest = build_digest(content)
+    log_stage(label, result)
+    stage_latency["SF"].add(result.duration)
+    stage_ttft["SF"].add(result.ttft)
+    logger.debug(f"SF分析结果: {result.content[:200]}...")
+    with _commit_lock:
+        buffer_sf.commit(display_text, result.digest, result.duration, turn)
+    return result
+
+
+def start_sf_stage(client_sf, buffer_sf, display_text, recalled=None, turn=None):
+    """在后台线程中进行SF分析（并行模式），返回 Future，result() 等待分析完成"""
+    future = Future()
+
+    def worker():
+        try:
+            future.set_result(run_sf_stage(client_sf, buffer_sf, display_text, recalled=recalled, turn=turn))
+        except Exception as e:
+            future.set_exception(e)
+
+    threading.Thread(target=worker, daemon=True).start()
+    return future
+
+
+def analyze(client_sf, messages, on_delta=None, cancel=None):
+    """调用SF并整理结果：拆出推理过程，生成交给BA的摘要"""
+    result = limited_completion("SF", client_sf, SF_MODEL, messages, 0.3, on_delta, cancel)
+    result.reasoning, result.content = split_reasoning(result.content, result.reasoning)
+    result.digest = build_digest(result.content)
+    if result.digest is not result.content:
+        logger.info(f"分析摘要: 原文约{estimate_tokens(result.content)} token → "
+                    f"摘要约{estimate_tokens(result.digest)} token")
+    return result
+
+
+def build_ba_input(display_text, sf_analysis):
+    """构建BA本轮请求内容"""
+    if sf_analysis is None:
+        # 直接回复用户问题
+        return display_text
+    return BA_ANALYSIS_TEMPLATE.format(analysis=sf_analysis, question=display_text)
+
+
+def run_ba_stage(client_ba, buffer_ba, display_text, sf_analysis=None, on_delta=None, recalled=None, turn=None):
+    """BA人性化回复，成功后写入BA历史（存储原始用户输入和BA回复）"""
+    logger.info("BA正在生成人性化回复...")
+    timings = {}
+    request = plugins.apply("pre_ba", build_ba_input(display_text, sf_analysis), timings)
+    with _commit_lock:
+        messages = buffer_ba.begin(with_recalled(request, recalled))
+    logger.debug(f"BA请求消息数: {len(messages)}")
+    try:
+        result = limited_completion("BA", client_ba, BA_MODEL, messages, 0.7, on_delta)
+    except Exception:
+        with _commit_lock:
+            buffer_ba.rollback()
+        raise
+    result.content = plugins.apply("post_ba", result.content, timings)
+    result.hooks = timings
+
+    log_stage("BA回复生成", result)
+    stage_latency["BA"].add(result.duration)
+    stage_ttft["BA"].add(result.ttft)
+    logger.debug(f"BA回复: {result.content[:200]}...")
+    with _commit_lock:
+        buffer_ba.commit(display_text, result.content, result.duration, turn)
+    return result
+
+
+def restyle_reply(client_ba, buffer_sf, buffer_ba, node, on_delta=None):
+    """按当前系统提示词重新生成某一轮（节点 node）的BA回复，沿用该轮的SF分析摘要
+
+    新回复从该轮之前另起一个分支（原来的回复保留在原分支），SF列直接引用原摘要，不调用SF。
+    该轮没有分析（直接回复）时按直接回复重新生成；该轮只有分析、没有BA回复时没有可润色的内容，抛出 ValueError。
+    返回 (result, 节省的SF耗时秒数, 节省的token估计)，没有可沿用的分析时后两项为 0。
+    """
+    log = buffer_ba.log
+    display_text, sf_digest = log.user[node], log.sf[node]
+    if log.ba[node] is None:
+        raise ValueError("该轮只有逻辑分析，没有可以重新润色的回复")
+    previous_head = log.head
+    log.checkout(log.parent[node])
+
+    saved_seconds = saved_tokens = 0
+    if sf_digest is not None:
+        # 该轮的分析耗时优先，旧快照没有记录时按近期SF耗时的中位数估计
+        saved_seconds = log.sf_seconds[node]
+        if math.isnan(saved_seconds):
+            saved_seconds = stage_latency["SF"].median(0.0)
+        saved_tokens = (estimate_messages_tokens(buffer_sf.messages) + estimate_tokens(display_text)
+                        + OUTPUT_TOKENS_ESTIMATE["SF"])
+        logger.info(f"沿用已有分析重新生成回复，跳过SF: 节省约{saved_seconds:.1f}秒、约{saved_tokens} token")
+
+    turn = log.begin_turn(log.prefix[node])
+    try:
+        result = run_ba_stage(client_ba, buffer_ba, display_text, sf_digest, on_delta, turn=turn)
+    except Exception:
+        log.checkout(previous_head)
+        raise
+    if sf_digest is not None:
+        # BA已在新分支上建好本轮节点，摘要补进同一节点
+        with _commit_lock:
+            buffer_sf.commit(display_text, sf_digest, log.sf_seconds[node], turn)
+    return result, saved_seconds, saved_tokens
+
+
+def refine_reply(client_ba, buffer_ba, sf_analysis):
+    """并行模式：分析完成后请BA对照分析补充上一轮的直接回复
+
+    补充内容追加到该轮的BA回复中，返回补充文本；不需要补充或已关闭时返回 None。
+    请求在当前历史之后临时附加一条消息，不改变缓冲区，前缀缓存仍然有效。
+    """
+    if not REFINE_ENABLED or not sf_analysis or buffer_ba.last_reply() is None:
+        return None
+    logger.info("BA正在根据分析结果补充回复...")
+    messages = list(buffer_ba.messages) + [
+        {"role": "user", "content": BA_REFINE_TEMPLATE.format(analysis=sf_analysis)}
+    ]
+    result = limited_completion("BA", client_ba, BA_MODEL, messages, 0.3)
+    log_stage("BA补充回复", result)
+    refinement = result.content.strip()
+    if not refinement or refinement.startswith(NO_REFINEMENT):
+        logger.info("分析结果与直接回复一致，无需补充")
+        return None
+    with _commit_lock:
+        buffer_ba.amend(f"{buffer_ba.last_reply()}\n\n{refinement}")
+    return refinement
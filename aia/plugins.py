@@ -0,0 +1,167 @@
+"""
+插件
+
+第三方包通过入口点（entry points）注册插件，无需修改 mainCLI.py / mainUI.py：
+- aia.pre_sf / aia.post_sf：SF 请求内容、SF 分析正文的预处理和后处理（文本 -> 文本）
+- aia.pre_ba / aia.post_ba：BA 请求内容、BA 回复的预处理和后处理（文本 -> 文本）
+- aia.tts：自定义语音合成后端（返回 TTSBackend 风格对象的工厂，取代远程合成）
+- aia.commands：自定义命令，入口点名即命令名，用户输入“/命令名 参数”时调用（参数 -> 回复文本）
+
+示例（插件包的 pyproject.toml）：
+    [project.entry-points."aia.post_ba"]
+    emoji = "aia_emoji:decorate"
+
+插件按需加载：某个钩子第一次触发时才扫描该组的入口点并导入插件模块，
+插件再多也不会增加启动时间；命令只按入口点名匹配，调用时才导入。
+每次调用的耗时记录在 metrics.hook_latency 中，并汇总到各阶段的完成日志里；
+单次调用超过 SLOW_HOOK_SECONDS 时输出警告，方便找出拖慢对话的插件。
+插件出错时跳过该插件，不影响对话。
+
+环境变量：
+- AIA_PLUGINS：设为0不加载任何插件
+"""
+import logging
+import os
+import threading
+import time
+from importlib import metadata
+
+from aia.metrics import LatencyStats, hook_latency
+
+logger = logging.getLogger(__name__)
+
+PLUGINS_ENABLED = os.environ.get("AIA_PLUGINS", "1") != "0"
+
+GROUP_PREFIX = "aia."
+COMMAND_PREFIX = "/"
+# 单次调用超过该时间时输出警告
+SLOW_HOOK_SECONDS = 0.1
+
+
+def _entry_points(group):
+    points = metadata.entry_points()
+    if hasattr(points, "select"):
+        return list(points.select(group=group))
+    # Python 3.8 / 3.9 返回按组划分的字典
+    return list(points.get(group, ()))
+
+
+class PluginRegistry:
+    def __init__(self, enabled=PLUGINS_ENABLED):
+        self.enabled = enabled
+        self._points = {}
+        self._loaded = {}
+        self._failed = set()
+        self._tts = None
+        self._lock = threading.Lock()
+
+    def entry_points(self, hook):
+        """该钩子注册的入口点（首次调用时扫描，不导入插件）"""
+        if not self.enabled:
+            return []
+        points = self._points.get(hook)
+        if points is None:
+            with self._lock:
+                points = self._points.get(hook)
+                if points is None:
+                    try:
+                        points = sorted(_entry_points(GROUP_PREFIX + hook), key=lambda point: point.name)
+                    except Exception as e:
+                        logger.warning(f"扫描插件入口点失败（{hook}）: {e}")
+                        points = []
+                    self._points[hook] = points
+        return points
+
+    def load(self, hook, point):
+        """导入单个插件，失败的插件不再重试"""
+        key = (hook, point.name)
+        plugin = self._loaded.get(key)
+        if plugin is not None or key in self._failed:
+            return plugin
+        with self._lock:
+            if key in self._loaded or key in self._failed:
+                return self._loaded.get(key)
+            start = time.perf_counter()
+            try:
+                plugin = point.load()
+            except Exception as e:
+                self._failed.add(key)
+                logger.error(f"加载插件失败: {point.name}（{hook}）: {e}", exc_info=True)
+                return None
+            self._loaded[key] = plugin
+        logger.info(f"已加载插件: {point.name}（{hook}），导入耗时: {time.perf_counter() - start:.3f}秒")
+        return plugin
+
+    def plugins(self, hook):
+        """返回 [(名称, 插件)]，按需导入"""
+        loaded = []
+        for point in self.entry_points(hook):
+            plugin = self.load(hook, point)
+            if plugin is not None:
+                loaded.append((point.name, plugin))
+        return loaded
+
+    def call(self, hook, name, plugin, *args):
+        """调用一次插件并记录耗时，出错时返回 None"""
+        start = time.perf_counter()
+        try:
+            return plugin(*args)
+        except Exception as e:
+            logger.warning(f"插件 {name}（{hook}）出错，已跳过: {e}", exc_info=True)
+            return None
+        finally:
+            elapsed = time.perf_counter() - start
+            hook_latency.setdefault(f"{hook}:{name}", LatencyStats()).add(elapsed)
+            if elapsed > SLOW_HOOK_SECONDS:
+                logger.warning(f"插件 {name}（{hook}）耗时 {elapsed:.2f}秒")
+
+    def apply(self, hook, text, timings=None):
+        """依次经过该钩子的所有插件处理文本；timings 为 {钩子: 秒数}，用于汇总到阶段日志"""
+        plugins = self.plugins(hook)
+        if not plugins:
+            return text
+        start = time.perf_counter()
+        for name, plugin in plugins:
+            result = self.call(hook, name, plugin, text)
+            if isinstance(result, str):
+                text = result
+        if timings is not None:
+            timings[hook] = timings.get(hook, 0.0) + time.perf_counter() - start
+        return text
+
+    def tts_backend(self):
+        """第一个可用的自定义语音合成后端（创建一次后复用），没有时返回 None"""
+        if self._tts is None:
+            self._tts = (None,)
+            for name, factory in self.plugins("tts"):
+                backend = self.call("tts", name, factory)
+                if backend is not None and backend.available():
+                    backend.name = getattr(backend, "name", None) or name
+                    self._tts = (backend,)
+                    break
+        return self._tts[0]
+
+    def match_command(self, user_input):
+        """匹配“/命令名 参数”，返回 (命令名, 参数)，不是已注册的命令时返回 None"""
+        if not user_input.startswith(COMMAND_PREFIX):
+            return None
+        name, _, args = user_input[len(COMMAND_PREFIX):].partition(" ")
+        if any(point.name == name for point in self.entry_points("commands")):
+            return name, args.strip()
+        return None
+
+    def run_command(self, name, args):
+        """执行自定义命令，返回回复文本"""
+        for point in self.entry_points("commands"):
+            if point.name == name:
+                command = self.load("commands", point)
+                if command is None:
+                    break
+                start = time.perf_counter()
+                reply = self.call("commands", name, command, args)
+                logger.info(f"命令 /{name} 完成，耗时: {time.perf_counter() - start:.2f}秒")
+                return "" if reply is None else str(reply)
+        return f"命令 /{name} 不可用"
+
+
+plugins = PluginRegistry()
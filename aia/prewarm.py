@@ -0,0 +1,105 @@
+"""
+启动预热
+
+客户端创建后在后台线程中：
+- 向每个接口地址发一个轻量请求，提前完成 DNS、TCP 和 TLS 握手
+- 预取音色列表，首次进入语音对话时无需等待（之后的刷新仍实时获取）
+- 空闲期间定时保活，直到首轮对话开始或超过保活时长
+整个过程不阻塞界面；首轮对话结束后记录耗时，便于对比预热效果。
+设置环境变量 AIA_PREWARM=0 可关闭预热。
+"""
+import logging
+import os
+import threading
+import time
+
+from aia.clients import fetch_voice_list
+
+logger = logging.getLogger(__name__)
+
+PREWARM_ENABLED = os.environ.get("AIA_PREWARM", "1") != "0"
+
+# 保活间隔需小于连接空闲回收时间
+KEEPALIVE_INTERVAL = 60
+KEEPALIVE_FOR = 10 * 60
+
+
+class Prewarmer:
+    def __init__(self, clients, voice_api_key=None):
+        """clients: {名称: OpenAI客户端}"""
+        self.clients = clients
+        self.voice_api_key = voice_api_key
+        self.connect_seconds = {}
+        self.voice_list = None
+        self.done = threading.Event()
+        self._voices_ready = threading.Event()
+        self._voices_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._first_turn_reported = False
+
+    def start(self):
+        if not PREWARM_ENABLED:
+            logger.info("预热已关闭")
+            self.done.set()
+            self._voices_ready.set()
+            return self
+        threading.Thread(target=self._run, daemon=True).start()
+        return self
+
+    def stop(self):
+        """停止保活"""
+        self._stopped.set()
+
+    def _warm_clients(self):
+        for name, client in self.clients.items():
+            start = time.perf_counter()
+            try:
+                client.models.list()
+                self.connect_seconds[name] = time.perf_counter() - start
+            except Exception as e:
+                logger.warning(f"{name} 预热失败: {e}")
+
+    def _run(self):
+        start = time.perf_counter()
+        self._warm_clients()
+
+        if self.voice_api_key:
+            try:
+                self.voice_list = fetch_voice_list(self.voice_api_key)
+                logger.info(f"已预取 {len(self.voice_list)} 个音色")
+            except Exception as e:
+                logger.warning(f"预取音色列表失败: {e}")
+        self._voices_ready.set()
+
+        details = "，".join(f"{name}: {seconds:.2f}秒" for name, seconds in self.connect_seconds.items())
+        logger.info(f"预热完成，总耗时: {time.perf_counter() - start:.2f}秒（{details or '无可用连接'}）")
+        self.done.set()
+
+        # 空闲期间定时保活
+        deadline = time.monotonic() + KEEPALIVE_FOR
+        while not self._stopped.wait(KEEPALIVE_INTERVAL) and time.monotonic() < deadline:
+            self._warm_clients()
+
+    def get_voice_list(self, timeout=5):
+        """返回预取的音色列表；预取仍在进行时最多等待 timeout 秒，失败返回 None
+
+        预取结果只用一次，之后返回 None，由调用方实时获取，才能看到启动后新上传的音色。
+        """
+        self._voices_ready.wait(timeout)
+        with self._voices_lock:
+            voice_list, self.voice_list = self.voice_list, None
+        return voice_list
+
+    def report_first_turn(self, duration):
+        """记录首轮对话耗时及预热状态，只记录一次"""
+        if self._first_turn_reported:
+            return
+        self._first_turn_reported = True
+        self.stop()
+        if not PREWARM_ENABLED:
+            logger.info(f"首轮对话耗时: {duration:.2f}秒（未预热）")
+        elif self.done.is_set():
+            saved = sum(self.connect_seconds.values())
+            logger.info(f"首轮对话耗时: {duration:.2f}秒（预热已完成，提前完成的连接建立耗时: {saved:.2f}秒）")
+        else:
+            logger.info(f"首轮对话耗时: {duration:.2f}秒（预热尚未完成）")
@@ -0,0 +1,103 @@
+"""
+单轮对话性能分析
+
+TurnProfiler 在后台线程中按固定间隔对处理对话的线程采样调用栈（墙钟时间），
+因此网络等待、JSON 处理、日志、提示词构建和音频解码都能体现在结果中。
+每轮输出一个折叠栈文件（.folded），可直接用 flamegraph.pl、speedscope、inferno 等工具生成火焰图，
+并在日志中输出按自身耗时排序的热点函数。
+"""
+import logging
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+def frame_name(frame):
+    code = frame.f_code
+    name = getattr(code, "co_qualname", code.co_name)
+    return f"{Path(code.co_filename).stem}.{name}:{frame.f_lineno}"
+
+
+def function_name(frame):
+    code = frame.f_code
+    name = getattr(code, "co_qualname", code.co_name)
+    return f"{name} ({Path(code.co_filename).name}:{code.co_firstlineno})"
+
+
+class _Sampler(threading.Thread):
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.self_counts = Counter()
+        self.samples = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.self_counts[function_name(frame)] += 1
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame))
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class TurnProfiler:
+    def __init__(self, output_dir, interval=0.005, top=5):
+        self.output_dir = Path(output_dir)
+        self.interval = interval
+        self.top = top
+        self.turns = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def profile(self, label="turn"):
+        """对当前线程中执行的一轮对话采样"""
+        with self._lock:
+            self.turns += 1
+            turn = self.turns
+        sampler = _Sampler(threading.get_ident(), self.interval)
+        start = time.perf_counter()
+        sampler.start()
+        try:
+            yield
+        finally:
+            sampler.stop()
+            self._write(turn, label, sampler, time.perf_counter() - start)
+
+    def _write(self, turn, label, sampler, duration):
+        try:
+            self.output_dir.mkdir(parents=True, exist_ok=True)
+            path = self.output_dir / f"{label}_{turn:04d}_{datetime.now():%Y%m%d_%H%M%S}.folded"
+            with open(path, "w", encoding="utf-8") as f:
+                for stack, count in sampler.stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+        except Exception as e:
+            logger.error(f"写入性能分析文件失败: {e}")
+            return
+
+        if not sampler.samples:
+            logger.info(f"第{turn}轮性能分析: 耗时 {duration:.2f}秒，无采样，已保存到: {path}")
+            return
+        hot = "；".join(
+            f"{name} {duration * count / sampler.samples:.2f}秒({count / sampler.samples:.0%})"
+            for name, count in sampler.self_counts.most_common(self.top)
+        )
+        logger.info(f"第{turn}轮性能分析: 耗时 {duration:.2f}秒，采样 {sampler.samples} 次，"
+                    f"自身耗时热点: {hot}，已保存到: {path}")
@@ -0,0 +1,172 @@
+"""
+客户端限流
+
+批量任务和多个用户共用同一个 SiliconFlow / BestAPI 密钥时，超出服务商限制会引发连续的 429。
+这里按（服务商, 密钥）各维护一个限流器，同时用两个令牌桶限制每分钟请求数（RPM）和每分钟 token 数（TPM）：
+- 请求按到达顺序排队，只有队首可以取令牌，先来的请求不会被后来的插队
+- 发送前按估算的 token 数预扣，收到用量后按实际值多退少补
+- 收到 429 时按 Retry-After 暂停该限流器，避免所有排队请求同时重试
+- 每次等待时间记录在 metrics.rate_wait 中
+
+环境变量（0 或不设置表示不限制）：
+- AIA_RATE_SF_RPM / AIA_RATE_SF_TPM：SF 对话
+- AIA_RATE_BA_RPM / AIA_RATE_BA_TPM：BA 对话
+- AIA_RATE_TTS_RPM：远程语音合成
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from aia.metrics import LatencyStats, rate_wait
+
+logger = logging.getLogger(__name__)
+
+# 令牌桶最多积攒多少秒的配额，限制突发，让吞吐稳定在限额附近
+BURST_SECONDS = 10
+# 收到 429 但没有 Retry-After 时的暂停时间
+DEFAULT_RETRY_AFTER = 5.0
+# 等待超过该时间才写日志
+LOG_WAIT_SECONDS = 0.05
+
+
+def _limit(provider, kind):
+    return float(os.environ.get(f"AIA_RATE_{provider}_{kind}", "0") or 0)
+
+
+class TokenBucket:
+    def __init__(self, per_minute, burst_seconds=BURST_SECONDS):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """取走 amount 个令牌还需要等待的秒数"""
+        self._refill(now)
+        # 超过桶容量的请求只要求桶满，差额记为欠账，由后面的请求等待
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+    def take(self, amount):
+        self.tokens -= amount
+
+
+class RateLimiter:
+    def __init__(self, name, rpm=0, tpm=0):
+        self.name = name
+        self.requests = TokenBucket(rpm) if rpm > 0 else None
+        self.tokens = TokenBucket(tpm) if tpm > 0 else None
+        self.wait = rate_wait.setdefault(name, LatencyStats())
+        self._cond = threading.Condition()
+        self._queue = deque()
+        self._paused_until = 0.0
+
+    @property
+    def limited(self):
+        return self.requests is not None or self.tokens is not None
+
+    def _delay(self, tokens, now):
+        delay = self._paused_until - now
+        if self.requests is not None:
+            delay = max(delay, self.requests.wait_time(1, now))
+        if self.tokens is not None and tokens:
+            delay = max(delay, self.tokens.wait_time(tokens, now))
+        return delay
+
+    def acquire(self, tokens=0):
+        """排队等待配额，返回等待的秒数"""
+        start = time.monotonic()
+        if not self.limited and self._paused_until <= start:
+            self.wait.add(0.0)
+            return 0.0
+        ticket = object()
+        with self._cond:
+            self._queue.append(ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    delay = None
+                    if self._queue[0] is ticket:
+                        delay = self._delay(tokens, now)
+                        if delay <= 0:
+                            if self.requests is not None:
+                                self.requests.take(1)
+                            if self.tokens is not None:
+                                self.tokens.take(tokens)
+                            break
+                    self._cond.wait(delay)
+            finally:
+                self._queue.remove(ticket)
+                self._cond.notify_all()
+        waited = time.monotonic() - start
+        self.wait.add(waited)
+        if waited > LOG_WAIT_SECONDS:
+            logger.info(f"{self.name} 限流等待 {waited:.2f}秒（排队 {len(self._queue)} 个）")
+        return waited
+
+    def try_acquire(self, tokens=0):
+        """配额充足且没有人排队时立即取走并返回 True，否则不等待直接返回 False"""
+        with self._cond:
+            if self._queue or self._delay(tokens, time.monotonic()) > 0:
+                return False
+            if self.requests is not None:
+                self.requests.take(1)
+            if self.tokens is not None:
+                self.tokens.take(tokens)
+            return True
+
+    def settle(self, reserved, actual):
+        """按实际用量修正预扣的 token 数"""
+        if self.tokens is None or actual is None:
+            return
+        with self._cond:
+            self.tokens.take(actual - reserved)
+            self._cond.notify_all()
+
+    def report_error(self, error):
+        """收到 429 时暂停一段时间"""
+        if not is_rate_limit_error(error):
+            return
+        retry_after = _retry_after(error)
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            self._cond.notify_all()
+        logger.warning(f"{self.name} 触发服务商限流（429），暂停 {retry_after:.1f}秒")
+
+
+def is_rate_limit_error(error):
+    return getattr(error, "status_code", None) == 429
+
+
+def _retry_after(error):
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return max(0.0, float(headers.get("retry-after", DEFAULT_RETRY_AFTER)))
+    except (TypeError, ValueError):
+        return DEFAULT_RETRY_AFTER
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def limiter_for(provider, api_key):
+    """返回（服务商, 密钥）对应的限流器，同一密钥的所有调用共用"""
+    digest = hashlib.sha1(str(api_key or "").encode()).hexdigest()[:8]
+    key = (provider, digest)
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = RateLimiter(provider, _limit(provider, "RPM"), _limit(provider, "TPM"))
+            _limiters[key] = limiter
+            if limiter.limited:
+                logger.info(f"{provider} 限流已启用: RPM {_limit(provider, 'RPM'):g}，"
+                            f"TPM {_limit(provider, 'TPM'):g}（密钥 {digest}）")
+        return limiter
@@ -0,0 +1,158 @@
+"""
+对话模式路由
+
+- ！开头：跳过SF，直接BA人性化回复
+- #开头：仅SF逻辑分析，不进行BA回复
+- &开头：并行模式，BA立即直接回复，SF同时在后台分析，分析完成后显示并可补充回复
+- 无前缀：标准模式；开启自动模式时由本地分类器判断是否需要SF分析
+
+分类器只用长度、意图关键词和问句结构等本地特征，耗时在微秒级，
+也可以额外传入一个本地小模型打分函数参与判断。
+"""
+import logging
+import re
+
+from aia.metrics import stage_latency
+
+logger = logging.getLogger(__name__)
+
+MODE_STANDARD = "standard"
+MODE_DIRECT = "direct"
+MODE_ANALYSIS = "analysis"
+MODE_BOTH = "both"
+
+PREFIX_MODES = {
+    '！': MODE_DIRECT,
+    '#': MODE_ANALYSIS,
+    '&': MODE_BOTH,
+    '＆': MODE_BOTH,
+}
+
+
+def mode_prefix(mode):
+    """某个模式对应的输入前缀，标准模式返回 None"""
+    return next((prefix for prefix, prefix_mode in PREFIX_MODES.items() if prefix_mode == mode), None)
+
+
+def parse_prefix(user_input):
+    """解析特殊前缀，返回 (模式, 去掉前缀后的文本, 是否显式指定)"""
+    for prefix, mode in PREFIX_MODES.items():
+        if user_input.startswith(prefix):
+            return mode, user_input[len(prefix):].strip(), True
+    return MODE_STANDARD, user_input, False
+
+
+# 简单意图：问候、感谢、确认、告别
+TRIVIAL_PATTERNS = re.compile(
+    r"^(你好|您好|嗨|哈喽|早上好|中午好|下午好|晚上好|晚安|在吗|在不在|"
+    r"谢谢|多谢|感谢|辛苦了|好的|好|嗯|嗯嗯|哦|收到|明白|知道了|了解|可以|行|没问题|"
+    r"再见|拜拜|回头见|"
+    r"hi|hello|hey|thanks|thank you|thx|ok|okay|bye|good night|got it)"
+    r"[\s,，.。!！~～?？呀啊啦呢吧哈]*$",
+    re.IGNORECASE
+)
+
+# 需要推理的意图关键词：中文按子串匹配
+ANALYTICAL_KEYWORDS = (
+    "为什么", "为何", "如何", "怎么", "怎样", "分析", "比较", "对比", "区别", "优缺点",
+    "利弊", "方案", "设计", "规划", "计划", "证明", "计算", "推导", "步骤", "原因",
+    "建议", "评估", "选择", "应该", "策略", "原理", "解释", "优化", "排查", "实现",
+)
+# 英文按整词匹配（含常见词形），避免 "show" 命中 "how"、"planet" 命中 "plan"
+ANALYTICAL_WORDS = re.compile(
+    r"\b(why|how|explain(?:s|ed|ing)?|compar(?:e|es|ed|ing|ison)|analy[sz](?:e|es|ed|ing|is)"
+    r"|design(?:s|ed|ing)?|plan(?:s|ned|ning)?|prove|proof|calculat(?:e|es|ed|ing|ion))\b"
+)
+
+QUESTION_MARKS = re.compile(r"[?？]")
+SENTENCE_BREAKS = re.compile(r"[。！？!?；;\n]")
+MATH_OR_CODE = re.compile(r"```|[=+\-*/^]\s*\d|\d\s*[=+\-*/^]|def |class |import ")
+
+
+class RouteDecision:
+    """自动模式的判断结果"""
+    __slots__ = ("skip_sf", "score", "confidence", "reason")
+
+    def __init__(self, skip_sf, score, confidence, reason):
+        self.skip_sf = skip_sf
+        self.score = score
+        self.confidence = confidence
+        self.reason = reason
+
+
+def analysis_score(text):
+    """估计SF分析的必要程度（0-1），返回 (分数, 原因)"""
+    stripped = text.strip()
+    length = len(stripped)
+
+    if TRIVIAL_PATTERNS.match(stripped):
+        return 0.05, "问候/感谢/确认"
+    if MATH_OR_CODE.search(stripped):
+        return 0.95, "包含计算或代码"
+
+    lowered = stripped.lower()
+    keyword_hits = (sum(1 for keyword in ANALYTICAL_KEYWORDS if keyword in lowered)
+                    + len(set(ANALYTICAL_WORDS.findall(lowered))))
+    questions = len(QUESTION_MARKS.findall(stripped))
+    sentences = len([s for s in SENTENCE_BREAKS.split(stripped) if s.strip()])
+
+    score = 0.35
+    reasons = []
+    if keyword_hits:
+        score += min(0.45, 0.25 * keyword_hits)
+        reasons.append(f"分析类关键词×{keyword_hits}")
+    if questions > 1 or sentences > 2:
+        score += 0.15
+        reasons.append("多个问题或多句描述")
+    if length > 60:
+        score += 0.2
+        reasons.append("内容较长")
+    elif length <= 12 and not keyword_hits:
+        score -= 0.2
+        reasons.append("简短输入")
+
+    return max(0.0, min(1.0, score)), "，".join(reasons) or "普通问题"
+
+
+class AutoRouter:
+    """
+    自动模式：分数低于 skip_below 时跳过SF分析，否则保持标准模式。
+    model_scorer 为可选的本地模型打分函数（text -> 0-1），与规则分数取平均。
+    """
+
+    def __init__(self, skip_below=0.3, model_scorer=None):
+        self.skip_below = skip_below
+        self.model_scorer = model_scorer
+        self.decisions = 0
+        self.skipped = 0
+        self.saved_seconds = 0.0
+
+    def decide(self, text):
+        score, reason = analysis_score(text)
+        if self.model_scorer is not None:
+            try:
+                score = (score + float(self.model_scorer(text))) / 2
+                reason += "，本地模型参与打分"
+            except Exception as e:
+                logger.warning(f"本地模型打分失败，仅使用规则判断: {e}")
+
+        skip_sf = score < self.skip_below
+        confidence = 1 - score if skip_sf else score
+        decision = RouteDecision(skip_sf, score, confidence, reason)
+
+        self.decisions += 1
+        if skip_sf:
+            self.skipped += 1
+            estimate = stage_latency["SF"].median()
+            if estimate is not None:
+                self.saved_seconds += estimate
+                saved_str = f"预计节省: {estimate:.2f}秒，累计节省: {self.saved_seconds:.2f}秒"
+            else:
+                saved_str = "暂无SF耗时样本，无法估算节省时间"
+            logger.info(
+                f"自动模式：跳过SF分析（分数: {score:.2f}，置信度: {confidence:.2f}，原因: {reason}），"
+                f"{saved_str}，已跳过 {self.skipped}/{self.decisions}"
+            )
+        else:
+            logger.info(f"自动模式：保留SF分析（分数: {score:.2f}，置信度: {confidence:.2f}，原因: {reason}）")
+        return decision
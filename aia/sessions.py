@@ -0,0 +1,259 @@
+"""
+多会话管理
+
+每个会话拥有独立的用户偏好、系统提示词和 SF/BA 历史。
+SessionManager 按最近使用顺序（LRU）维护内存中的会话：
+- 总内存估算超过 max_bytes 时，先释放最久未使用会话的消息列表缓存，仍超出再写入磁盘
+- 空闲超过 max_idle_seconds 的会话同样换出到磁盘
+- 再次访问被换出的会话时从磁盘透明恢复
+正在处理对话的会话不会被换出。
+换出的会话保存为二进制快照（JSON 头 + TurnLog 快照）。
+"""
+import hashlib
+import json
+import logging
+import struct
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+
+from aia.buffers import MessageBuffer
+from aia.history import TurnLog
+from aia.pipeline import SF_PROMPT
+
+logger = logging.getLogger(__name__)
+
+# 缓存的消息字典本身的大致开销（文本与 TurnLog 共享，不重复计算）
+MESSAGE_OVERHEAD = sys.getsizeof({"role": "", "content": ""}) + 64
+
+_META_LENGTH = struct.Struct("<I")
+
+
+class Session:
+    def __init__(self, session_id, preferences=None, system_prompt="", log=None):
+        self.session_id = session_id
+        self.preferences = preferences or {}
+        self.log = log if log is not None else TurnLog()
+        self.buffer_sf = MessageBuffer(SF_PROMPT, self.log, "sf")
+        self.buffer_ba = MessageBuffer(system_prompt, self.log, "ba")
+        self.last_active = time.time()
+        self.busy = 0
+
+    @property
+    def system_prompt(self):
+        return self.buffer_ba.system_prompt
+
+    def set_system_prompt(self, system_prompt):
+        self.buffer_ba.set_system_prompt(system_prompt)
+
+    def set_preferences(self, preferences, system_prompt):
+        """更新用户偏好及对应的系统提示词"""
+        self.preferences = preferences
+        self.set_system_prompt(system_prompt)
+
+    def clear(self):
+        """清空对话历史，保留偏好设置"""
+        self.buffer_sf.clear()
+        self.buffer_ba.clear()
+
+    def rewind(self, turn):
+        """回到当前分支第 turn 轮（从1开始）之前，返回该轮的原始输入（带模式前缀）
+
+        之后的对话从这里另起一个分支，原来的分支仍然保留，可以切换回去。
+        """
+        node = self.log.path()[turn - 1]
+        self.log.checkout(self.log.parent[node])
+        return self.log.input(node)
+
+    def branches(self):
+        """所有分支，按创建顺序返回 [(末端节点, 轮数, 最后一轮用户输入, 是否当前分支)]"""
+        log = self.log
+        result = []
+        for leaf in log.leaves():
+            turns = 0
+            node = leaf
+            while node >= 0:
+                turns += 1
+                node = log.parent[node]
+            result.append((leaf, turns, log.user[leaf], leaf == log.head))
+        return result
+
+    def switch_branch(self, node):
+        """切换到以 node 结尾的分支"""
+        self.log.checkout(node)
+        logger.info(f"会话 {self.session_id} 已切换分支: 共 {len(self.log)} 轮")
+
+    def trim_history(self, max_turns):
+        """裁剪过长的实时历史，更早的内容交给长期记忆"""
+        dropped = self.log.trim(max_turns)
+        if dropped:
+            logger.info(f"会话 {self.session_id} 历史已裁剪: {dropped} 轮")
+
+    def touch(self):
+        self.last_active = time.time()
+
+    def size_bytes(self):
+        """估算会话占用的内存"""
+        cached = self.buffer_sf.materialized + self.buffer_ba.materialized
+        return self.log.size_bytes() + cached * MESSAGE_OVERHEAD
+
+    def compact(self):
+        """释放两个阶段的消息列表缓存"""
+        self.buffer_sf.release()
+        self.buffer_ba.release()
+
+    def to_bytes(self):
+        """二进制快照：长度前缀的 JSON 头（偏好、提示词等）+ TurnLog 快照"""
+        meta = json.dumps({
+            "session_id": self.session_id,
+            "preferences": self.preferences,
+            "system_prompt": self.system_prompt,
+            "last_active": self.last_active,
+        }, ensure_ascii=False).encode("utf-8")
+        return _META_LENGTH.pack(len(meta)) + meta + self.log.to_bytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        (length,) = _META_LENGTH.unpack_from(data, 0)
+        start = _META_LENGTH.size
+        meta = json.loads(data[start:start + length].decode("utf-8"))
+        log = TurnLog.from_bytes(data[start + length:])
+        session = cls(meta["session_id"], meta.get("preferences"), meta.get("system_prompt", ""), log)
+        session.last_active = meta.get("last_active", time.time())
+        return session
+
+
+class SessionManager:
+    def __init__(self, store_dir, max_bytes=64 * 1024 * 1024, max_idle_seconds=30 * 60):
+        self.store_dir = Path(store_dir)
+        self.max_bytes = max_bytes
+        self.max_idle_seconds = max_idle_seconds
+        self._sessions = OrderedDict()
+        self._lock = threading.RLock()
+
+    def _path(self, session_id):
+        name = hashlib.md5(str(session_id).encode()).hexdigest()
+        return self.store_dir / f"{name}.bin"
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, session_id):
+        return session_id in self._sessions or self._path(session_id).exists()
+
+    def get(self, session_id, preferences=None, system_prompt=""):
+        """获取会话：内存中没有则从磁盘恢复，磁盘也没有则新建"""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self._load(session_id)
+            if session is None:
+                session = Session(session_id, preferences, system_prompt)
+                logger.info(f"创建会话: {session_id}")
+            self._sessions[session_id] = session
+            self._sessions.move_to_end(session_id)
+            session.touch()
+            self.enforce_limits()
+            return session
+
+    @contextmanager
+    def use(self, session_id, **kwargs):
+        """在一轮对话期间占用会话，期间不会被换出"""
+        with self._lock:
+            session = self.get(session_id, **kwargs)
+            session.busy += 1
+        try:
+            yield session
+        finally:
+            with self._lock:
+                session.busy -= 1
+                session.touch()
+                self.enforce_limits()
+
+    def memory_usage(self):
+        with self._lock:
+            return sum(session.size_bytes() for session in self._sessions.values())
+
+    def enforce_limits(self):
+        """换出空闲会话，并按 LRU 顺序换出直到满足内存上限"""
+        with self._lock:
+            now = time.time()
+            for session_id, session in list(self._sessions.items()):
+                if not session.busy and now - session.last_active > self.max_idle_seconds:
+                    self.evict(session_id)
+
+            # 最近使用的会话始终保留在内存中
+            total = self.memory_usage()
+            candidates = [(session_id, session) for session_id, session in list(self._sessions.items())[:-1]
+                          if not session.busy]
+            # 先释放消息列表缓存，代价只是下次使用时重新生成
+            for session_id, session in candidates:
+                if total <= self.max_bytes:
+                    return
+                before = session.size_bytes()
+                session.compact()
+                total -= before - session.size_bytes()
+            for session_id, session in candidates:
+                if total <= self.max_bytes:
+                    break
+                total -= session.size_bytes()
+                self.evict(session_id)
+
+    def evict(self, session_id):
+        """把会话写入磁盘并从内存释放"""
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+            if session is None:
+                return
+            try:
+                self.store_dir.mkdir(parents=True, exist_ok=True)
+                with open(self._path(session_id), 'wb') as f:
+                    f.write(session.to_bytes())
+                logger.info(f"会话已换出到磁盘: {session_id}")
+            except Exception as e:
+                # 写盘失败时保留在内存中，避免丢失历史
+                self._sessions[session_id] = session
+                logger.error(f"会话换出失败: {e}", exc_info=True)
+
+    def _load(self, session_id):
+        path = self._path(session_id)
+        if not path.exists():
+            return None
+        try:
+            with open(path, 'rb') as f:
+                session = Session.from_bytes(f.read())
+            path.unlink()
+            logger.info(f"会话已从磁盘恢复: {session_id}")
+            return session
+        except Exception as e:
+            logger.error(f"恢复会话失败: {e}", exc_info=True)
+            return None
+
+    def iter_sessions(self):
+        """依次返回所有会话：先是内存中的，再逐个只读加载磁盘上的（不放回内存、不删除文件）"""
+        with self._lock:
+            in_memory = list(self._sessions.values())
+        yield from in_memory
+        if not self.store_dir.exists():
+            return
+        loaded = {session.session_id for session in in_memory}
+        for path in sorted(self.store_dir.iterdir()):
+            if path.suffix != ".bin":
+                continue
+            try:
+                session = Session.from_bytes(path.read_bytes())
+            except Exception as e:
+                logger.error(f"读取会话文件失败: {path.name}: {e}")
+                continue
+            if session.session_id not in loaded:
+                loaded.add(session.session_id)
+                yield session
+
+    def flush(self):
+        """把所有会话写入磁盘，用于进程退出前保存"""
+        with self._lock:
+            for session_id in list(self._sessions):
+                self.evict(session_id)
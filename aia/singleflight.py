@@ -0,0 +1,105 @@
+"""
+相同请求合并（single-flight）
+
+批量运行或多人共用一个界面时，相同的首轮问题经常在几秒内同时到达。
+同一个键上已有请求在进行时，后到的调用不再单独请求上游，而是等待这次调用：
+- 流式结果按到达顺序转发给每个等待者（先到的分片会补发）
+- 调用结束后所有等待者拿到同一个结果，失败时同样抛出同一个异常；
+  结果是共用的，调用方不能原地修改，需要改动时先复制
+只合并正在进行中的请求，结束后即从表中移除，不做结果缓存。
+
+- sf_flights：消息列表完全相同的 SF 请求
+- tts_flights：（音色, 文本）相同的远程语音合成
+"""
+import hashlib
+import json
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def messages_key(model, messages):
+    payload = json.dumps([model, messages], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+class _Flight:
+    __slots__ = ("cond", "chunks", "done", "result", "error", "waiters")
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.chunks = []
+        self.done = False
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.shared = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, fn, on_delta=None):
+        """执行 fn(on_delta) 或加入进行中的同键调用，返回 (结果, 是否共享)"""
+        with self._lock:
+            self.calls += 1
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self.shared += 1
+                flight.waiters += 1
+        if leader:
+            return self._lead(key, flight, fn, on_delta), False
+        logger.info(f"{self.name} 合并进行中的相同请求（等待者 {flight.waiters} 个，"
+                    f"累计合并 {self.shared}/{self.calls}）")
+        return self._follow(flight, on_delta), True
+
+    def _lead(self, key, flight, fn, on_delta):
+        def publish(chunk):
+            with flight.cond:
+                flight.chunks.append(chunk)
+                flight.cond.notify_all()
+            if on_delta:
+                on_delta(chunk)
+
+        try:
+            flight.result = fn(publish)
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            with flight.cond:
+                flight.done = True
+                flight.cond.notify_all()
+
+    def _follow(self, flight, on_delta):
+        seen = 0
+        while True:
+            with flight.cond:
+                while not flight.done and len(flight.chunks) <= seen:
+                    flight.cond.wait()
+                chunks = flight.chunks[seen:]
+                done = flight.done
+            seen += len(chunks)
+            if on_delta:
+                for chunk in chunks:
+                    on_delta(chunk)
+            if done:
+                break
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+
+sf_flights = SingleFlight("SF")
+tts_flights = SingleFlight("TTS")
@@ -0,0 +1,134 @@
+"""
+输入时预判分析
+
+用户停顿输入时，用当前草稿在后台先发起 SF 分析；按下发送时：
+- 提交的文本与草稿相同或只差空白、标点、大小写，且 SF 历史没有变化：直接使用预判结果
+  （预判仍在进行时等它完成，只需等待剩余的时间）
+- 否则取消预判，照常发起分析
+每次命中记录节省的等待时间，并在日志中输出命中率。
+"""
+import logging
+import re
+import threading
+import time
+import unicodedata
+
+from aia.pipeline import StageCancelled, analyze
+
+logger = logging.getLogger(__name__)
+
+# 停顿多久后开始预判（毫秒）
+PAUSE_MS = 800
+# 草稿少于该长度时不预判
+MIN_CHARS = 4
+
+TRIVIAL = re.compile(r"[\s。．.!！?？~～…,，、;；:：\"'“”‘’]+")
+
+
+def normalize(text):
+    """去掉空白和标点、统一全半角和大小写，用于判断两段文本是否只有细微差别"""
+    return TRIVIAL.sub("", unicodedata.normalize("NFKC", text).lower())
+
+
+def buffer_state(buffer_sf):
+    """SF 历史的状态标识，历史变化后预判结果不再适用"""
+    return (buffer_sf.log.version, buffer_sf.turn_count, buffer_sf.system_prompt)
+
+
+class Speculation:
+    __slots__ = ("draft", "state", "started", "finished", "cancel", "done", "result")
+
+    def __init__(self, draft, state):
+        self.draft = draft
+        self.state = state
+        self.started = time.perf_counter()
+        self.finished = None
+        self.cancel = threading.Event()
+        self.done = threading.Event()
+        self.result = None
+
+
+class Speculator:
+    def __init__(self):
+        self.current = None
+        self.started = 0
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def matches(self, draft):
+        """当前预判是否已经覆盖这段草稿"""
+        current = self.current
+        return current is not None and not current.cancel.is_set() and normalize(current.draft) == normalize(draft)
+
+    def start(self, client_sf, buffer_sf, draft, build_request):
+        """用草稿在后台发起SF分析
+
+        build_request() 在后台线程中调用，返回 (实际发送的请求内容, 插件耗时)；
+        长期记忆检索和 pre_sf 插件都在这里完成，不占用界面线程。
+        采用预判结果时不再重复执行 pre_sf，插件耗时随结果一起计入阶段日志。
+        """
+        self.cancel("草稿已变化")
+        speculation = Speculation(draft, buffer_state(buffer_sf))
+        history = list(buffer_sf.messages)
+
+        def worker():
+            try:
+                request, timings = build_request()
+                if speculation.cancel.is_set():
+                    return
+                messages = history + [{"role": "user", "content": request}]
+                result = analyze(client_sf, messages, cancel=speculation.cancel)
+                result.hooks.update(timings)
+                speculation.result = result
+            except StageCancelled:
+                pass
+            except Exception as e:
+                logger.warning(f"预判分析失败: {e}")
+            finally:
+                speculation.finished = time.perf_counter()
+                speculation.done.set()
+
+        with self._lock:
+            self.current = speculation
+            self.started += 1
+        threading.Thread(target=worker, daemon=True).start()
+        logger.debug(f"开始预判分析: {draft[:30]}")
+
+    def cancel(self, reason=""):
+        with self._lock:
+            speculation, self.current = self.current, None
+        if speculation is not None and not speculation.done.is_set():
+            speculation.cancel.set()
+            logger.debug(f"取消预判分析（{reason}）")
+
+    def take(self, display_text, buffer_sf):
+        """提交时取出可用的预判结果，不可用时返回 None"""
+        with self._lock:
+            speculation, self.current = self.current, None
+        if speculation is None:
+            return None
+
+        submitted = time.perf_counter()
+        if normalize(speculation.draft) != normalize(display_text) or speculation.state != buffer_state(buffer_sf):
+            speculation.cancel.set()
+            return self._miss("提交内容或对话历史与预判时不同")
+        speculation.done.wait()
+        result = speculation.result
+        if result is None:
+            return self._miss("预判分析未完成")
+
+        # 提交前已经完成的部分都是节省下来的等待
+        remaining = max(0.0, speculation.finished - submitted)
+        saved = max(0.0, result.duration - remaining)
+        self.hits += 1
+        self.saved_seconds += saved
+        logger.info(f"预判分析命中：节省约 {saved:.2f}秒，命中率 {self.hits}/{self.hits + self.misses}，"
+                    f"累计节省 {self.saved_seconds:.2f}秒（共预判 {self.started} 次）")
+        return result
+
+    def _miss(self, reason):
+        self.misses += 1
+        logger.info(f"预判分析未命中（{reason}），命中率 {self.hits}/{self.hits + self.misses}")
+        return None
@@ -0,0 +1,119 @@
+"""
+语音合成前的文本精简
+
+GPT-4o 的回复通常带有 Markdown 标记、代码块、表格、链接和表情符号，
+这些内容念出来没有意义，还会拉长合成耗时和音频长度。
+reduce_for_speech 把回复转换成适合朗读的纯文本：
+- 去掉标题、列表、引用、强调等标记，保留文字
+- 代码块替换为一句简短提示
+- 表格按行朗读，单元格之间用逗号分隔
+- 链接只保留链接文字，裸链接替换为“链接”
+- 去掉表情符号，把百分号、货币和常见单位转换为中文读法
+"""
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+CODE_PLACEHOLDER = "这里有一段代码，请查看文字回复。"
+
+CODE_BLOCK = re.compile(r"^[ \t]*(```|~~~).*?^[ \t]*\1[^\n]*$", re.MULTILINE | re.DOTALL)
+UNCLOSED_CODE_BLOCK = re.compile(r"^[ \t]*(```|~~~).*\Z", re.MULTILINE | re.DOTALL)
+INLINE_CODE = re.compile(r"`([^`\n]+)`")
+IMAGE = re.compile(r"!\[([^\]]*)\]\([^)]*\)")
+LINK = re.compile(r"\[([^\]]+)\]\([^)]*\)")
+BARE_URL = re.compile(r"https?://[^\s)）\]】>，。]+")
+HEADING = re.compile(r"^[ \t]*#{1,6}[ \t]+(.*?)[ \t#]*$", re.MULTILINE)
+BLOCKQUOTE = re.compile(r"^[ \t]*>+[ \t]?", re.MULTILINE)
+HORIZONTAL_RULE = re.compile(r"^[ \t]*([-*_])([ \t]*\1){2,}[ \t]*$", re.MULTILINE)
+BULLET = re.compile(r"^[ \t]*[-*+•][ \t]+(\[[ xX]\][ \t]+)?", re.MULTILINE)
+NUMBERED = re.compile(r"^[ \t]*(\d+)[.)][ \t]+", re.MULTILINE)
+TABLE_SEPARATOR = re.compile(r"^[ \t]*\|?[ \t]*:?-{3,}:?[ \t]*(\|[ \t]*:?-{3,}:?[ \t]*)*\|?[ \t]*$", re.MULTILINE)
+TABLE_ROW = re.compile(r"^[ \t]*\|(.*)\|[ \t]*$", re.MULTILINE)
+# __ 只在单词边界处作为强调，纯英文标识符（如 __init__）按代码原样保留
+EMPHASIS = re.compile(
+    r"(\*\*|~~)(.+?)\1"
+    r"|(?<!\w)__(?![A-Za-z0-9_]+__)(?!\s)(.+?)(?<!\s)__(?!\w)"
+    r"|(?<![\w*])\*(?!\s)(.+?)(?<!\s)\*(?![\w*])"
+)
+HTML_TAG = re.compile(r"</?[a-zA-Z][^>]*>")
+EMOJI = re.compile(
+    "[\U0001F000-\U0001FAFF\U00002600-\U000027BF\U0001F900-\U0001F9FF"
+    "\U00002B00-\U00002BFF\U0000FE0F\U0000200D\U000020E3]"
+)
+
+PERCENT = re.compile(r"(\d+(?:\.\d+)?)\s*[%％]")
+CURRENCY_PREFIX = re.compile(r"([$¥￥€£])\s*(\d+(?:[.,]\d+)*)")
+RANGE = re.compile(r"(\d)\s*[~～]\s*(\d)")
+CURRENCY_NAMES = {"$": "美元", "¥": "元", "￥": "元", "€": "欧元", "£": "英镑"}
+UNITS = {
+    "km/h": "公里每小时", "km": "公里", "cm": "厘米", "mm": "毫米", "m²": "平方米", "m³": "立方米",
+    "kg": "千克", "mg": "毫克", "ml": "毫升", "mL": "毫升",
+    "°C": "摄氏度", "℃": "摄氏度", "°F": "华氏度",
+    "KB": "千字节", "MB": "兆字节", "GB": "吉字节", "TB": "太字节", "ms": "毫秒",
+}
+UNIT = re.compile(
+    r"(\d)\s*(" + "|".join(re.escape(unit) for unit in sorted(UNITS, key=len, reverse=True)) + r")(?![A-Za-z])"
+)
+# 单个字母的单位容易误读（“4g网络”“1990s”），只在数字和单位之间有空格时转换
+SHORT_UNITS = {"g": "克", "s": "秒"}
+SHORT_UNIT = re.compile(r"(\d)[ \t]+(" + "|".join(SHORT_UNITS) + r")(?![A-Za-z])")
+
+SENTENCE_END = "。！？!?.;；:：，,"
+
+
+def _table_row(match):
+    cells = [cell.strip() for cell in match.group(1).split("|")]
+    return "，".join(cell for cell in cells if cell) + "。"
+
+
+def _heading(match):
+    title = match.group(1).strip()
+    if title and title[-1] not in SENTENCE_END:
+        title += "。"
+    return title
+
+
+def _emphasis(match):
+    return next(group for group in match.groups()[1:] if group is not None)
+
+
+def normalize_numbers(text):
+    """把百分号、货币符号、范围和常见单位转换为中文读法"""
+    text = PERCENT.sub(r"百分之\1", text)
+    text = CURRENCY_PREFIX.sub(lambda m: f"{m.group(2)}{CURRENCY_NAMES[m.group(1)]}", text)
+    text = RANGE.sub(r"\1到\2", text)
+    text = UNIT.sub(lambda m: f"{m.group(1)}{UNITS[m.group(2)]}", text)
+    text = SHORT_UNIT.sub(lambda m: f"{m.group(1)}{SHORT_UNITS[m.group(2)]}", text)
+    return text
+
+
+def reduce_for_speech(text):
+    """返回 (适合朗读的文本, 减少的字符数)"""
+    original_length = len(text)
+
+    spoken = CODE_BLOCK.sub(CODE_PLACEHOLDER, text)
+    spoken = UNCLOSED_CODE_BLOCK.sub(CODE_PLACEHOLDER, spoken)
+    spoken = EMOJI.sub("", spoken)
+    spoken = INLINE_CODE.sub(r"\1", spoken)
+    spoken = IMAGE.sub(r"\1", spoken)
+    spoken = LINK.sub(r"\1", spoken)
+    spoken = BARE_URL.sub("链接", spoken)
+    spoken = TABLE_SEPARATOR.sub("", spoken)
+    spoken = TABLE_ROW.sub(_table_row, spoken)
+    spoken = HORIZONTAL_RULE.sub("", spoken)
+    spoken = HEADING.sub(_heading, spoken)
+    spoken = BLOCKQUOTE.sub("", spoken)
+    spoken = BULLET.sub("", spoken)
+    spoken = NUMBERED.sub(r"\1、", spoken)
+    spoken = EMPHASIS.sub(_emphasis, spoken)
+    spoken = HTML_TAG.sub("", spoken)
+    spoken = normalize_numbers(spoken)
+
+    # 合并空白：段落之间保留一个换行
+    spoken = re.sub(r"[ \t]+", " ", spoken)
+    spoken = re.sub(r"\s*\n\s*", "\n", spoken).strip()
+
+    removed = original_length - len(spoken)
+    logger.info(f"语音文本精简: {original_length} -> {len(spoken)} 字符，减少 {removed} 字符")
+    return spoken, removed
@@ -0,0 +1,21 @@
+"""
+token 数粗略估算
+
+不依赖分词器：中日韩字符按每字1个token，其余文本按每4个字符1个token。
+用于摘要预算、限流预估等不需要精确值的场景。
+"""
+import re
+
+CJK = re.compile(r"[　-〿぀-ヿ㐀-䶿一-鿿＀-￯]")
+
+
+def estimate_tokens(text):
+    if not text:
+        return 0
+    cjk = len(CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def estimate_messages_tokens(messages):
+    """估算消息列表的输入token数（每条消息额外计4个token的格式开销）"""
+    return sum(estimate_tokens(message["content"]) + 4 for message in messages)
@@ -0,0 +1,180 @@
+"""
+语音合成后端
+
+- RemoteTTSBackend：SiliconFlow CosyVoice2（默认）
+- LocalTTSBackend：本地离线引擎，优先使用 Piper，其次 espeak-ng
+
+TTSRouter 按策略选择后端：
+- 文本很短（简短确认、问候）时直接用本地引擎，省去一次网络往返
+- 远程最近的中位耗时超过阈值时改用本地引擎，并每隔几次仍试探一次远程，
+  以便远程恢复后切换回来
+- 远程合成失败时回退到本地引擎
+- 安装了自定义语音合成插件（aia.tts）时优先使用插件，失败时同样回退到本地引擎
+
+环境变量：
+- AIA_TTS_LOCAL_MAX_CHARS：不超过该长度的文本使用本地引擎（默认12，0表示关闭）
+- AIA_TTS_REMOTE_MAX_SECONDS：远程中位耗时超过该值时改用本地引擎（默认8秒）
+- AIA_PIPER_MODEL：Piper 模型文件路径
+"""
+import logging
+import os
+import shutil
+import subprocess
+import time
+from pathlib import Path
+
+from aia.metrics import LatencyStats
+from aia.plugins import plugins
+from aia.ratelimit import limiter_for
+from aia.singleflight import tts_flights
+
+logger = logging.getLogger(__name__)
+
+TTS_MODEL = "FunAudioLLM/CosyVoice2-0.5B"
+
+LOCAL_MAX_CHARS = int(os.environ.get("AIA_TTS_LOCAL_MAX_CHARS", "12"))
+REMOTE_MAX_SECONDS = float(os.environ.get("AIA_TTS_REMOTE_MAX_SECONDS", "8"))
+# 远程较慢时每隔多少次请求试探一次远程
+REMOTE_PROBE_EVERY = 5
+
+
+def turn_speech_path(directory, session_id, started, part=None):
+    """某一轮回复的语音文件路径
+
+    按会话和该轮的开始时间命名，每轮单独一个文件：导出的对话记录链接到的语音不会被之后的轮次覆盖。
+    part 为同一轮追加的语音片段名（如补充回复），另存一个文件。
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    suffix = f"_{part}" if part else ""
+    return directory / f"{session_id}_{int(started * 1000)}{suffix}.mp3"
+
+
+class TTSBackend:
+    name = "base"
+    extension = ".wav"
+
+    def available(self):
+        return True
+
+    def synthesize(self, text, output_path, voice=None):
+        """合成语音写入 output_path，失败时抛出异常"""
+        raise NotImplementedError
+
+
+class RemoteTTSBackend(TTSBackend):
+    name = "remote"
+    extension = ".mp3"
+
+    def __init__(self, client_sf, model=TTS_MODEL):
+        self.client_sf = client_sf
+        self.model = model
+
+    def available(self):
+        return self.client_sf is not None
+
+    def synthesize(self, text, output_path, voice=None):
+        if not voice:
+            raise ValueError("远程语音合成需要音色")
+        # 音色和文本相同的并发请求共用一次合成，结果复制到各自的输出路径
+        source, shared = tts_flights.run(
+            (self.model, voice, text),
+            lambda _: self._synthesize(text, output_path, voice)
+        )
+        if shared and Path(source) != Path(output_path):
+            shutil.copyfile(source, output_path)
+
+    def _synthesize(self, text, output_path, voice):
+        limiter = limiter_for("TTS", getattr(self.client_sf, "api_key", ""))
+        limiter.acquire()
+        try:
+            with self.client_sf.audio.speech.with_streaming_response.create(
+                model=self.model,
+                voice=voice,
+                input=text,
+                response_format="mp3"
+            ) as response:
+                response.stream_to_file(output_path)
+        except Exception as e:
+            limiter.report_error(e)
+            raise
+        return output_path
+
+
+class LocalTTSBackend(TTSBackend):
+    name = "local"
+    extension = ".wav"
+
+    def __init__(self, piper_model=None, espeak_voice="cmn"):
+        self.piper_model = piper_model or os.environ.get("AIA_PIPER_MODEL")
+        self.espeak_voice = espeak_voice
+        self.piper = shutil.which("piper") if self.piper_model else None
+        self.espeak = shutil.which("espeak-ng")
+
+    def available(self):
+        return bool(self.piper or self.espeak)
+
+    def synthesize(self, text, output_path, voice=None):
+        if self.piper:
+            command = [self.piper, "--model", self.piper_model, "--output_file", str(output_path)]
+        elif self.espeak:
+            command = [self.espeak, "-v", self.espeak_voice, "-w", str(output_path), "--stdin"]
+        else:
+            raise RuntimeError("未找到本地语音引擎（piper 或 espeak-ng）")
+        subprocess.run(command, input=text.encode("utf-8"), check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+
+class TTSRouter:
+    def __init__(self, remote, local=None, local_max_chars=LOCAL_MAX_CHARS,
+                 remote_max_seconds=REMOTE_MAX_SECONDS):
+        self.remote = remote
+        self.local = local if local is not None and local.available() else None
+        self.local_max_chars = local_max_chars
+        self.remote_max_seconds = remote_max_seconds
+        self.latency = {"remote": LatencyStats(window=20), "local": LatencyStats(window=20)}
+        self._slow_skips = 0
+
+    def choose(self, text):
+        """返回 (后端, 原因)"""
+        custom = plugins.tts_backend()
+        if custom is not None:
+            return custom, "插件"
+        if self.local is None:
+            return self.remote, "无本地引擎"
+        if self.remote is None or not self.remote.available():
+            return self.local, "远程不可用"
+        if len(text) <= self.local_max_chars:
+            return self.local, f"短文本（{len(text)}字符）"
+
+        median = self.latency["remote"].median()
+        if median is not None and median > self.remote_max_seconds:
+            self._slow_skips += 1
+            if self._slow_skips % REMOTE_PROBE_EVERY:
+                return self.local, f"远程较慢（中位耗时{median:.2f}秒）"
+            return self.remote, "试探远程是否恢复"
+        return self.remote, "默认"
+
+    def _run(self, backend, text, output_path, voice):
+        path = Path(output_path).with_suffix(getattr(backend, "extension", TTSBackend.extension))
+        start = time.perf_counter()
+        backend.synthesize(text, path, voice)
+        duration = time.perf_counter() - start
+        self.latency.setdefault(backend.name, LatencyStats(window=20)).add(duration)
+        logger.info(f"语音生成成功（{backend.name}），耗时: {duration:.2f}秒，保存到: {path}")
+        return path
+
+    def synthesize(self, text, output_path, voice=None):
+        """合成语音，返回实际的音频文件路径（扩展名取决于所用后端）"""
+        backend, reason = self.choose(text)
+        logger.info(f"语音合成使用 {backend.name} 后端（{reason}）")
+        try:
+            return self._run(backend, text, output_path, voice)
+        except Exception as e:
+            if backend is self.local or self.local is None:
+                raise
+            # 远程失败时记一次超时样本，并回退到本地引擎
+            if backend is self.remote:
+                self.latency["remote"].add(self.remote_max_seconds * 2)
+            logger.warning(f"{backend.name} 语音合成失败，改用本地引擎: {e}")
+            return self._run(self.local, text, output_path, voice)
@@ -2,16 +2,35 @@ import requests
 import json
 import base64
 import os
+import sys
+import csv
+import time
+import argparse
 import mimetypes
+import tempfile
+import threading
+import wave
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-def get_audio_base64(file_path):
+UPLOAD_URL = "https://api.siliconflow.cn/v1/uploads/audio/voice"
+VOICE_MODEL = "FunAudioLLM/CosyVoice2-0.5B"
+
+# CosyVoice2 参考音频要求：单声道、16kHz 即可，时长不超过30秒
+# 超长的音频不裁剪：裁剪后和上传的文字内容对不上，克隆效果会很差
+TARGET_SAMPLE_RATE = 16000
+TARGET_CHANNELS = 1
+MAX_DURATION_MS = 30 * 1000
+
+# 每次编码的原始字节数，必须是3的倍数，保证分块编码拼接后仍是合法的base64
+ENCODE_CHUNK_SIZE = 3 * 64 * 1024
+
+AUDIO_EXTENSIONS = {'.mp3', '.wav', '.m4a', '.aac', '.ogg', '.flac'}
+
+
+def get_mime_type(file_path):
     """
-    读取音频文件并转换为base64编码
+    获取音频文件的MIME类型
     """
-    if not os.path.exists(file_path):
-        raise FileNotFoundError(f"文件不存在: {file_path}")
-    
-    # 获取文件的MIME类型
     mime_type, _ = mimetypes.guess_type(file_path)
     if not mime_type or not mime_type.startswith('audio/'):
         # 如果无法识别MIME类型，根据文件扩展名判断
@@ -25,13 +44,216 @@ def get_audio_base64(file_path):
             '.flac': 'audio/flac'
         }
         mime_type = mime_map.get(ext, 'audio/mpeg')
-    
-    # 读取文件并编码为base64
-    with open(file_path, 'rb') as audio_file:
-        audio_data = audio_file.read()
-        base64_encoded = base64.b64encode(audio_data).decode('utf-8')
-    
-    return f"data:{mime_type};base64,{base64_encoded}"
+    return mime_type
+
+
+def probe_audio(file_path):
+    """
+    只读取文件头，返回 (时长毫秒, 采样率, 声道数)，不解码音频数据
+    WAV 直接读头部，其他格式用 ffprobe（pydub.utils.mediainfo）；无法读取时返回 None
+    """
+    if file_path.lower().endswith(".wav"):
+        try:
+            with wave.open(file_path, 'rb') as wav:
+                rate = wav.getframerate()
+                return wav.getnframes() * 1000 // rate, rate, wav.getnchannels()
+        except (wave.Error, EOFError, ZeroDivisionError):
+            # 非 PCM 编码的 WAV 交给 ffprobe
+            pass
+    try:
+        from pydub.utils import mediainfo
+        info = mediainfo(file_path)
+        return int(float(info["duration"]) * 1000), int(info["sample_rate"]), int(info["channels"])
+    except Exception:
+        return None
+
+
+def check_duration(file_path, duration_ms):
+    """
+    超过时长上限时报错
+    """
+    if duration_ms > MAX_DURATION_MS:
+        raise ValueError(f"{os.path.basename(file_path)} 时长 {duration_ms / 1000:.1f} 秒，"
+                         f"超过 {MAX_DURATION_MS // 1000} 秒上限，请剪辑后连同对应的文字内容一起重新提供")
+
+
+def prepare_audio(file_path):
+    """
+    按CosyVoice2的要求检查时长并重采样，返回 (音频文件路径, MIME类型, 是否为临时文件)
+    - 先读取文件头：已符合要求时不解码，直接使用原文件
+    - 超过30秒时抛出 ValueError，不裁剪
+    未安装 pydub 时只能检查 WAV 的时长，其余直接使用原文件
+    """
+    probed = probe_audio(file_path)
+    if probed is not None:
+        duration_ms, sample_rate, channels = probed
+        check_duration(file_path, duration_ms)
+        if sample_rate == TARGET_SAMPLE_RATE and channels == TARGET_CHANNELS:
+            return file_path, get_mime_type(file_path), False
+
+    try:
+        from pydub import AudioSegment
+    except ImportError:
+        return file_path, get_mime_type(file_path), False
+
+    sound = AudioSegment.from_file(file_path)
+    check_duration(file_path, len(sound))
+    if sound.frame_rate == TARGET_SAMPLE_RATE and sound.channels == TARGET_CHANNELS:
+        return file_path, get_mime_type(file_path), False
+
+    sound = sound.set_frame_rate(TARGET_SAMPLE_RATE).set_channels(TARGET_CHANNELS)
+    fd, temp_path = tempfile.mkstemp(suffix=".wav")
+    os.close(fd)
+    sound.export(temp_path, format="wav")
+    return temp_path, 'audio/wav', True
+
+
+class StreamingVoiceBody:
+    """
+    流式生成上传请求体：音频分块读取并编码，不在内存中保留完整的base64字符串
+    提供 __len__ 以便 requests 设置 Content-Length
+    """
+
+    def __init__(self, file_path, mime_type, voice_name, text_content):
+        self.file_path = file_path
+        fields = json.dumps({
+            "model": VOICE_MODEL,
+            "customName": voice_name,
+            "text": text_content
+        }, ensure_ascii=False)
+        # 在JSON对象末尾拼接 audio 字段
+        self.head = (fields[:-1] + f', "audio": "data:{mime_type};base64,').encode('utf-8')
+        self.tail = b'"}'
+        size = os.path.getsize(file_path)
+        self.length = len(self.head) + 4 * ((size + 2) // 3) + len(self.tail)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        yield self.head
+        with open(self.file_path, 'rb') as audio_file:
+            while True:
+                chunk = audio_file.read(ENCODE_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield base64.b64encode(chunk)
+        yield self.tail
+
+
+def upload_voice(session, api_key, file_path, voice_name, text_content):
+    """
+    上传单个音频文件，返回 (状态码, 响应内容)
+    """
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"文件不存在: {file_path}")
+
+    audio_path, mime_type, is_temp = prepare_audio(file_path)
+    try:
+        headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        }
+        body = StreamingVoiceBody(audio_path, mime_type, voice_name, text_content)
+        response = session.post(UPLOAD_URL, headers=headers, data=body)
+        try:
+            content = response.json()
+        except ValueError:
+            content = response.text
+        return response.status_code, content
+    finally:
+        if is_temp:
+            os.remove(audio_path)
+
+
+def sanitize_voice_name(name):
+    """
+    自定义音色名称只保留字母、数字、下划线和连字符
+    """
+    cleaned = "".join(c if c.isascii() and (c.isalnum() or c in "_-") else "_" for c in name)
+    return cleaned[:64] or "voice"
+
+
+def load_manifest(path):
+    """
+    读取清单，支持目录、CSV 和 JSONL，返回 [(文件, 名称, 文字内容)]
+    - 目录：每个音频文件配一个同名 .txt 作为文字内容
+    - CSV：表头包含 file, customName, transcript
+    - JSONL：每行一个对象，字段同上
+    """
+    entries = []
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            stem, ext = os.path.splitext(name)
+            if ext.lower() not in AUDIO_EXTENSIONS:
+                continue
+            transcript_path = os.path.join(path, stem + ".txt")
+            if not os.path.exists(transcript_path):
+                print(f"跳过 {name}: 缺少文字内容文件 {stem}.txt")
+                continue
+            with open(transcript_path, 'r', encoding='utf-8') as f:
+                transcript = f.read().strip()
+            entries.append((os.path.join(path, name), sanitize_voice_name(stem), transcript))
+        return entries
+
+    base_dir = os.path.dirname(os.path.abspath(path))
+    with open(path, 'r', encoding='utf-8') as f:
+        if path.lower().endswith(".jsonl"):
+            rows = [json.loads(line) for line in f if line.strip()]
+        else:
+            rows = list(csv.DictReader(f))
+
+    for row in rows:
+        file_path = os.path.join(base_dir, row['file'])
+        voice_name = row.get('customName') or os.path.splitext(os.path.basename(row['file']))[0]
+        entries.append((file_path, sanitize_voice_name(voice_name), row['transcript'].strip()))
+    return entries
+
+
+def bulk_upload(path, api_key, workers=4):
+    """
+    批量上传，限制并发数并实时输出进度
+    """
+    entries = load_manifest(path)
+    if not entries:
+        print("没有可上传的音频")
+        return []
+
+    local = threading.local()
+
+    def task(entry):
+        # 每个线程复用自己的连接
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        file_path, voice_name, text_content = entry
+        start = time.perf_counter()
+        status, content = upload_voice(local.session, api_key, file_path, voice_name, text_content)
+        return status, content, time.perf_counter() - start
+
+    total = len(entries)
+    done = 0
+    results = []
+    start_time = time.perf_counter()
+    print(f"开始上传 {total} 个音频，并发数: {workers}")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(task, entry): entry for entry in entries}
+        for future in as_completed(futures):
+            file_path, voice_name, _ = futures[future]
+            done += 1
+            try:
+                status, content, duration = future.result()
+                ok = status == 200
+                mark = "✅" if ok else f"❌ ({status}: {content})"
+            except Exception as e:
+                ok, duration = False, 0.0
+                mark = f"❌ ({e})"
+            results.append((voice_name, ok))
+            print(f"[{done}/{total}] {voice_name} {mark} 耗时: {duration:.2f}秒")
+
+    succeeded = sum(1 for _, ok in results if ok)
+    print(f"\n上传完成: 成功 {succeeded}/{total}，总耗时: {time.perf_counter() - start_time:.2f}秒")
+    return results
+
 
 def upload_audio_voice():
     """
@@ -39,59 +261,63 @@ def upload_audio_voice():
     """
     # 获取用户输入
     file_path = input("请输入音频文件路径: ").strip()
-    
+
     # 去除可能的引号
     if file_path.startswith('"') and file_path.endswith('"'):
         file_path = file_path[1:-1]
     elif file_path.startswith("'") and file_path.endswith("'"):
         file_path = file_path[1:-1]
-    
+
     try:
-        # 获取音频的base64编码
-        audio_base64 = get_audio_base64(file_path)
+        if not os.path.exists(file_path):
+            raise FileNotFoundError(f"文件不存在: {file_path}")
         print("音频文件读取成功!")
-        
+
         # 获取其他必要信息
         api_key = input("请输入你的API密钥: ").strip()
         voice_name = input("请输入自定义音频名称: ").strip()
         text_content = input("请输入音频对应的文字内容: ").strip()
-        
-        # API配置
-        url = "https://api.siliconflow.cn/v1/uploads/audio/voice"
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        }
-        
-        data = {
-            "model": "FunAudioLLM/CosyVoice2-0.5B",
-            "customName": voice_name,
-            "audio": audio_base64,
-            "text": text_content
-        }
-        
+
         print("正在上传音频文件...")
-        response = requests.post(url, headers=headers, data=json.dumps(data))
-        
+        status, content = upload_voice(requests.Session(), api_key, file_path, voice_name, text_content)
+
         # 打印响应结果
-        print(f"\n响应状态码: {response.status_code}")
-        
-        if response.status_code == 200:
+        print(f"\n响应状态码: {status}")
+
+        if status == 200:
             print("上传成功!")
             print("响应内容:")
-            print(json.dumps(response.json(), indent=2, ensure_ascii=False))
+            print(json.dumps(content, indent=2, ensure_ascii=False))
         else:
             print("上传失败!")
             print("错误信息:")
-            try:
-                print(json.dumps(response.json(), indent=2, ensure_ascii=False))
-            except:
-                print(response.text)
-                
+            if isinstance(content, str):
+                print(content)
+            else:
+                print(json.dumps(content, indent=2, ensure_ascii=False))
+
     except FileNotFoundError as e:
         print(f"错误: {e}")
     except Exception as e:
         print(f"发生错误: {e}")
 
+
+def main():
+    parser = argparse.ArgumentParser(description="上传参考音频到SiliconFlow，生成自定义音色")
+    parser.add_argument("--bulk", metavar="PATH", help="批量上传：音频目录或 CSV/JSONL 清单")
+    parser.add_argument("--api-key", help="SiliconFlow API密钥（默认读取 SILICONFLOW_API_KEY）")
+    parser.add_argument("--workers", type=int, default=4, help="并发上传数（默认4）")
+    args = parser.parse_args()
+
+    if not args.bulk:
+        upload_audio_voice()
+        return
+
+    api_key = args.api_key or os.environ.get("SILICONFLOW_API_KEY") or input("请输入你的API密钥: ").strip()
+    results = bulk_upload(args.bulk, api_key, max(1, args.workers))
+    if not all(ok for _, ok in results):
+        sys.exit(1)
+
+
 if __name__ == "__main__":
-    upload_audio_voice()
\ No newline at end of file
+    main()
@@ -0,0 +1,228 @@
+"""
+批量把聊天软件语音（SILK / AMR / OGG）转换为 WAV 参考音频，供 add_voice.py 使用
+
+- SILK：使用同目录的 silk_v3_decoder 解码为 PCM，直接按目标采样率输出
+- AMR / OGG 等：使用 ffmpeg 解码
+- 输出统一为单声道 16bit WAV，采样率可配置
+- 按文件内容哈希跳过已转换过的文件（包括内容相同但文件名不同的重复语音），哈希用线程池并行计算
+- 同一目录下只有扩展名不同的文件（如 a.silk 和 a.amr）会输出为同一个 WAV，视为冲突报错，不互相覆盖
+- 使用进程池并行转换，默认占满所有CPU核心（Windows 上进程池最多 61 个进程）
+
+用法: python main.py 输入目录 输出目录 [--rate 16000] [--workers N]
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+TOOLS_DIR = Path(__file__).parent
+INDEX_FILE = ".transcode_index.json"
+SILK_HEADER = b"#!SILK_V3"
+INPUT_EXTENSIONS = {'.silk', '.slk', '.amr', '.ogg', '.opus', '.aud', '.m4a', '.mp3'}
+# Windows 上 ProcessPoolExecutor 的 max_workers 不能超过 61
+WINDOWS_MAX_WORKERS = 61
+
+
+def find_tool(name):
+    """查找工具：优先使用本目录附带的程序，其次在 PATH 中查找"""
+    exe = f"{name}.exe" if platform.system() == "Windows" else name
+    local = TOOLS_DIR / exe
+    if local.exists():
+        return str(local)
+    return shutil.which(name)
+
+
+def file_hash(path):
+    """计算文件内容哈希"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def is_silk(path):
+    """根据文件头判断是否为SILK编码（微信语音前面多一个0x02字节）"""
+    with open(path, 'rb') as f:
+        header = f.read(10)
+    return header.startswith(SILK_HEADER) or header[1:].startswith(SILK_HEADER)
+
+
+def decode_silk(src, dst, rate):
+    """SILK -> PCM -> WAV"""
+    decoder = find_tool("silk_v3_decoder")
+    if not decoder:
+        raise RuntimeError("未找到 silk_v3_decoder")
+
+    fd, pcm_path = tempfile.mkstemp(suffix=".pcm")
+    os.close(fd)
+    try:
+        subprocess.run(
+            [decoder, str(src), pcm_path, "-Fs_API", str(rate), "-quiet"],
+            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+        )
+        with open(pcm_path, 'rb') as pcm, wave.open(str(dst), 'wb') as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(rate)
+            for block in iter(lambda: pcm.read(1024 * 1024), b""):
+                wav.writeframes(block)
+    finally:
+        os.remove(pcm_path)
+
+
+def decode_ffmpeg(src, dst, rate):
+    """其他格式交给 ffmpeg，同时完成重采样和声道归一
+
+    输出先写到 .part 临时文件，ffmpeg 无法从扩展名判断格式，需要用 -f 指定。
+    """
+    ffmpeg = find_tool("ffmpeg")
+    if not ffmpeg:
+        raise RuntimeError("未找到 ffmpeg")
+    subprocess.run(
+        [ffmpeg, "-nostdin", "-loglevel", "error", "-y", "-i", str(src),
+         "-ac", "1", "-ar", str(rate), "-sample_fmt", "s16", "-f", "wav", str(dst)],
+        check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+    )
+
+
+def transcode(src, dst, rate):
+    """在子进程中执行：转换单个文件，返回 (源文件, 输出文件, 耗时, 错误信息)"""
+    start = time.perf_counter()
+    try:
+        Path(dst).parent.mkdir(parents=True, exist_ok=True)
+        # 先写临时文件，避免中断时留下不完整的输出
+        partial = f"{dst}.part"
+        if is_silk(src):
+            decode_silk(src, partial, rate)
+        else:
+            decode_ffmpeg(src, partial, rate)
+        os.replace(partial, dst)
+        return src, dst, time.perf_counter() - start, None
+    except subprocess.CalledProcessError as e:
+        message = e.stderr.decode(errors="replace").strip() if e.stderr else str(e)
+        return src, dst, time.perf_counter() - start, message or str(e)
+    except Exception as e:
+        return src, dst, time.perf_counter() - start, str(e)
+
+
+def load_index(output_dir):
+    path = Path(output_dir) / INDEX_FILE
+    if path.exists():
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    return {}
+
+
+def save_index(output_dir, index):
+    path = Path(output_dir) / INDEX_FILE
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False, indent=2)
+
+
+def collect_jobs(input_dir, output_dir, rate, index, workers=1):
+    """遍历输入目录，按内容哈希过滤已转换和重复的文件
+
+    哈希主要耗在读文件上，用 workers 个线程并行计算（hashlib 计算时释放 GIL）。
+    返回 (待转换任务, 跳过数, 冲突列表)。冲突为 (源文件, 占用同一输出的源文件, 输出文件)：
+    已转换过的文件先占用各自的输出，其余按遍历顺序先到先得。
+    """
+    sources = [Path(root) / name
+               for root, _, files in os.walk(input_dir)
+               for name in sorted(files)
+               if Path(name).suffix.lower() in INPUT_EXTENSIONS]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        hashes = list(executor.map(file_hash, sources))
+
+    pending = []
+    skipped = 0
+    seen = set()
+    # 输出文件 -> 占用它的源文件
+    claimed = {}
+    for src, digest in zip(sources, hashes):
+        # 采样率不同视为不同的转换结果
+        key = f"{digest}:{rate}"
+        done = index.get(key)
+        if done and (Path(output_dir) / done).exists():
+            claimed.setdefault(str(Path(output_dir) / done), str(src))
+            skipped += 1
+            continue
+        if key in seen:
+            skipped += 1
+            continue
+        seen.add(key)
+        dst = Path(output_dir) / src.relative_to(input_dir).with_suffix(".wav")
+        pending.append((key, str(src), str(dst)))
+
+    jobs = []
+    clashes = []
+    for key, src, dst in pending:
+        if dst in claimed:
+            clashes.append((src, claimed[dst], dst))
+            continue
+        claimed[dst] = src
+        jobs.append((key, src, dst))
+    return jobs, skipped, clashes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批量转换聊天语音为WAV参考音频")
+    parser.add_argument("input_dir", help="输入目录（递归查找）")
+    parser.add_argument("output_dir", help="输出目录")
+    parser.add_argument("--rate", type=int, default=16000, help="输出采样率（默认16000）")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="并行进程数（默认CPU核心数）")
+    args = parser.parse_args()
+    args.workers = max(1, args.workers or 1)
+    if platform.system() == "Windows":
+        args.workers = min(args.workers, WINDOWS_MAX_WORKERS)
+
+    Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+    index = load_index(args.output_dir)
+    jobs, skipped, clashes = collect_jobs(args.input_dir, args.output_dir, args.rate, index, args.workers)
+    total = len(jobs)
+    print(f"待转换: {total}，已跳过: {skipped}，并行进程: {args.workers}")
+    for src, owner, dst in clashes:
+        print(f"❌ {src}: 与 {owner} 输出为同一个文件 {dst}，已跳过（请重命名其中一个）")
+    if not jobs:
+        if clashes:
+            sys.exit(1)
+        return
+
+    failed = 0
+    start = time.perf_counter()
+    keys = {src: key for key, src, _ in jobs}
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(transcode, src, dst, args.rate) for _, src, dst in jobs]
+        for done, future in enumerate(as_completed(futures), 1):
+            src, dst, duration, error = future.result()
+            if error:
+                failed += 1
+                print(f"[{done}/{total}] ❌ {src}: {error}")
+                continue
+            index[keys[src]] = os.path.relpath(dst, args.output_dir)
+            print(f"[{done}/{total}] ✅ {src} ({duration:.2f}秒)")
+            # 定期保存索引，中断后可以继续
+            if done % 100 == 0:
+                save_index(args.output_dir, index)
+
+    save_index(args.output_dir, index)
+    elapsed = time.perf_counter() - start
+    print(f"\n完成: 成功 {total - failed}/{total}，总耗时: {elapsed:.2f}秒，"
+          f"吞吐: {total / elapsed:.1f} 个/秒")
+    if clashes:
+        print(f"另有 {len(clashes)} 个文件因输出文件名冲突未转换")
+    if failed or clashes:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+长会话内存压测
+
+用本地替身客户端（或录制文件回放）驱动对话管线连续运行数千轮，
+定期采样进程 RSS 和 tracemalloc 快照，输出增长最多的代码位置。
+每轮平均增长超过预算时以非零状态退出，可用于 CI。
+
+用法:
+    python dev/soak.py --turns 5000 --sessions 4 --budget 4096
+    AIA_CASSETTE_MODE=replay AIA_CASSETTE_SPEED=0 python dev/soak.py --replay
+"""
+import argparse
+import itertools
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from aia.pipeline import run_sf_stage, run_ba_stage  # noqa: E402
+from aia.routing import AutoRouter  # noqa: E402
+from aia.sessions import SessionManager  # noqa: E402
+from aia.speech_text import reduce_for_speech  # noqa: E402
+
+QUESTIONS = [
+    "你好", "谢谢", "为什么天空是蓝色的？", "帮我比较一下两种方案的优缺点",
+    "如何优化Python程序的内存占用？", "好的", "解释一下TCP三次握手", "今天适合跑步吗",
+]
+
+REPLY_TEMPLATE = (
+    "## 结论\n这是第 {n} 轮的回复，内容用于压测。\n\n"
+    "- 要点一：**保持** 稳定\n- 要点二：参考 [文档](https://example.com)\n\n"
+    "| 项目 | 数值 |\n|---|---|\n| 延迟 | {n}ms |\n\n```python\nprint({n})\n```\n"
+)
+
+
+class StandInClient:
+    """本地替身：按流式接口返回合成回复，不访问网络"""
+
+    def __init__(self, reply_chars=400, chunk_chars=20):
+        self.reply_chars = reply_chars
+        self.chunk_chars = chunk_chars
+        self.counter = itertools.count(1)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, messages, stream=False, **kwargs):
+        n = next(self.counter)
+        text = (REPLY_TEMPLATE.format(n=n) * (self.reply_chars // len(REPLY_TEMPLATE) + 1))[:self.reply_chars]
+
+        def chunks():
+            for i in range(0, len(text), self.chunk_chars):
+                delta = SimpleNamespace(content=text[i:i + self.chunk_chars], reasoning_content=None)
+                yield SimpleNamespace(choices=[SimpleNamespace(delta=delta)], usage=None)
+            usage = SimpleNamespace(prompt_tokens=sum(len(m["content"]) for m in messages) // 2)
+            yield SimpleNamespace(choices=[], usage=usage)
+
+        return chunks()
+
+
+def current_rss():
+    """当前常驻内存（字节）；无法获取时返回峰值"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+    except ImportError:
+        return 0
+
+
+def make_clients(args):
+    if args.replay:
+        from aia.cassette import active_cassette, ReplayClient
+        cassette = active_cassette()
+        if cassette is None or cassette.mode != "replay":
+            sys.exit("回放模式需要设置 AIA_CASSETTE_MODE=replay")
+        return ReplayClient(cassette, "SF"), ReplayClient(cassette, "BA")
+    return StandInClient(args.reply_chars), StandInClient(args.reply_chars)
+
+
+def run_turn(manager, session_id, client_sf, client_ba, router, text):
+    with manager.use(session_id, system_prompt="压测系统提示词") as session:
+        sf_analysis = None
+        turn = session.log.begin_turn()
+        if not router.decide(text).skip_sf:
+            sf_analysis = run_sf_stage(client_sf, session.buffer_sf, text, turn=turn).digest
+        reply = run_ba_stage(client_ba, session.buffer_ba, text, sf_analysis, turn=turn).content
+        reduce_for_speech(reply)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="长会话内存压测")
+    parser.add_argument("--turns", type=int, default=3000, help="总轮数")
+    parser.add_argument("--sessions", type=int, default=1, help="并存的会话数（轮流使用）")
+    parser.add_argument("--sample-every", type=int, default=500, help="采样间隔（轮）")
+    parser.add_argument("--warmup", type=int, default=100, help="预热轮数，不计入增长")
+    parser.add_argument("--budget", type=float, default=4096, help="每轮允许的平均内存增长（字节）")
+    parser.add_argument("--reply-chars", type=int, default=400, help="替身回复长度")
+    parser.add_argument("--max-session-bytes", type=int, default=64 * 1024 * 1024, help="会话内存上限")
+    parser.add_argument("--top", type=int, default=10, help="输出增长最多的代码位置数")
+    parser.add_argument("--replay", action="store_true", help="使用录制文件回放代替替身客户端")
+    args = parser.parse_args()
+
+    # 压测期间只输出警告，避免日志本身成为瓶颈
+    logging.getLogger("aia").setLevel(logging.WARNING)
+    logging.basicConfig(level=logging.WARNING)
+
+    client_sf, client_ba = make_clients(args)
+    router = AutoRouter()
+    manager = SessionManager(tempfile.mkdtemp(prefix="aia_soak_"), max_bytes=args.max_session_bytes)
+    rng = random.Random(0)
+
+    def turn(i):
+        run_turn(manager, f"soak-{i % args.sessions}", client_sf, client_ba, router, rng.choice(QUESTIONS))
+
+    for i in range(args.warmup):
+        turn(i)
+
+    tracemalloc.start()
+    baseline = tracemalloc.take_snapshot()
+    base_traced = tracemalloc.get_traced_memory()[0]
+    base_rss = current_rss()
+    start = time.perf_counter()
+    print(f"{'轮数':>8} {'RSS(MB)':>10} {'追踪(MB)':>10} {'每轮增长(B)':>12} {'会话内存(MB)':>12}")
+
+    turns = args.turns - args.warmup
+    previous = baseline
+    for i in range(turns):
+        turn(args.warmup + i)
+        if (i + 1) % args.sample_every == 0 or i + 1 == turns:
+            traced = tracemalloc.get_traced_memory()[0]
+            per_turn = (traced - base_traced) / (i + 1)
+            print(f"{args.warmup + i + 1:>8} {current_rss() / 2**20:>10.1f} {traced / 2**20:>10.1f} "
+                  f"{per_turn:>12.0f} {manager.memory_usage() / 2**20:>12.1f}")
+            # 与上一次采样相比增长最多的位置
+            current = tracemalloc.take_snapshot()
+            for stat in current.compare_to(previous, "lineno")[:3]:
+                print(f"{'':>10}{stat}")
+            previous = current
+
+    elapsed = time.perf_counter() - start
+    snapshot = tracemalloc.take_snapshot()
+    traced = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    per_turn = (traced - base_traced) / max(1, turns)
+
+    print(f"\n增长最多的 {args.top} 个位置:")
+    for stat in snapshot.compare_to(baseline, "lineno")[:args.top]:
+        print(f"  {stat}")
+
+    print(f"\n共 {turns} 轮，耗时 {elapsed:.2f}秒（{turns / elapsed:.0f} 轮/秒）")
+    print(f"RSS 增长: {(current_rss() - base_rss) / 2**20:.1f} MB，"
+          f"追踪内存每轮增长: {per_turn:.0f} 字节（预算 {args.budget:.0f} 字节）")
+    if per_turn > args.budget:
+        print("❌ 每轮内存增长超过预算")
+        sys.exit(1)
+    print("✅ 内存增长在预算内")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,28 @@
-from openai import OpenAI
 import logging
-import requests
+import argparse
+from contextlib import nullcontext
 from pathlib import Path
 import os
 import platform
 import subprocess
 import json
 import hashlib
+import queue
+import threading
+from concurrent import futures
 from datetime import datetime
+from aia.clients import create_clients, fetch_voice_list
+from aia.export import write_export, format_for
+from aia.memory import create_memory, format_recalled, HISTORY_MAX_TURNS
+from aia.pipeline import run_sf_stage, run_ba_stage, start_sf_stage, refine_reply, restyle_reply
+from aia.plugins import plugins
+from aia.prewarm import Prewarmer
+from aia.profiling import TurnProfiler
+from aia.ratelimit import is_rate_limit_error
+from aia.sessions import SessionManager
+from aia.speech_text import reduce_for_speech
+from aia.tts import TTSRouter, RemoteTTSBackend, LocalTTSBackend, turn_speech_path
+from aia.routing import AutoRouter, parse_prefix, mode_prefix, MODE_DIRECT, MODE_ANALYSIS, MODE_BOTH
 
 # 创建一个 Logger
 logger = logging.getLogger(__name__)
@@ -32,9 +47,40 @@ console_handler.setFormatter(formatter)
 logger.addHandler(file_handler)
 logger.addHandler(console_handler)
 
+# 共享管线模块使用同样的Handler
+aia_logger = logging.getLogger("aia")
+aia_logger.setLevel(logging.DEBUG)
+aia_logger.addHandler(file_handler)
+aia_logger.addHandler(console_handler)
+
 # 缓存文件路径
 CACHE_FILE = Path(__file__).parent / "user_cache.json"
 
+# 会话管理（换出的会话保存在 sessions 目录）
+SESSION_DIR = Path(__file__).parent / "sessions"
+CLI_SESSION_ID = "cli"
+session_manager = SessionManager(SESSION_DIR)
+
+# 导出的对话记录默认保存在 exports 目录
+EXPORT_DIR = Path(__file__).parent / "exports"
+
+# 长期记忆（索引保存在 memory 目录，在 main 中创建）
+MEMORY_DIR = Path(__file__).parent / "memory"
+long_term_memory = None
+
+# 启动预热与语音合成后端（在 main 中创建）
+prewarmer = None
+tts_router = None
+
+# 单轮性能分析（--profile 开启）
+profiler = None
+
+# 后台语音任务：合成和播放不阻塞下一轮输入，按提交顺序逐个处理
+speech_queue = queue.Queue()
+speech_thread = None
+# 每轮回复的语音单独保存在 speech 目录，导出的对话记录可以链接到对应的语音
+SPEECH_DIR = Path(__file__).parent / "speech"
+
 def get_cache_key():
     """生成缓存键，基于机器和用户信息"""
     machine_info = platform.uname()
@@ -101,17 +147,7 @@ def get_api_clients():
         cached_data = {'api_keys': {'sf': apikey_sf, 'ba': apikey_ba}}
     save_to_cache(cached_data)
     
-    client_sf = OpenAI(
-        api_key=apikey_sf,
-        base_url="https://api.siliconflow.cn/v1"
-    )
-    
-    client_ba = OpenAI(
-        api_key=apikey_ba,
-        base_url="https://api2.aigcbest.top/v1"
-    )
-    
-    return client_sf, client_ba
+    return create_clients(apikey_sf, apikey_ba)
 
 def get_user_preferences():
     """获取用户偏好设置"""
@@ -168,20 +204,17 @@ def create_system_prompt(preferences):
 def get_voice_list(api_key):
     """获取可用音色列表"""
     try:
-        logger.info("请求音色列表API")
-        url = "https://api.siliconflow.cn/v1/audio/voice/list"
-        headers = {
-            "Authorization": f"Bearer {api_key}"
-        }
-        response = requests.get(url, headers=headers)
+        # 首次使用预热阶段预取的音色列表，之后实时获取（可能有新上传的音色）
+        if prewarmer is not None:
+            voice_list = prewarmer.get_voice_list()
+            if voice_list:
+                logger.info(f"使用预取的 {len(voice_list)} 个音色")
+                return voice_list
         
-        if response.status_code == 200:
-            voice_data = response.json()
-            logger.info(f"获取到 {len(voice_data.get('result', []))} 个音色")
-            return voice_data.get('result', [])
-        else:
-            logger.error(f"获取音色列表失败，状态码: {response.status_code}, 响应: {response.text}")
-            return []
+        logger.info("请求音色列表API")
+        voice_list = fetch_voice_list(api_key)
+        logger.info(f"获取到 {len(voice_list)} 个音色")
+        return voice_list
     except Exception as e:
         logger.error(f"获取音色列表出错: {str(e)}", exc_info=True)
         return []
@@ -222,25 +255,22 @@ def select_voice(voice_list):
             print("请输入有效数字")
 
 def generate_speech(client_sf, text, voice_uri, output_path):
-    """生成语音文件"""
+    """生成语音文件，返回实际保存的文件路径（本地引擎输出wav），失败返回None"""
+    global tts_router
     try:
+        # 去掉Markdown等不适合朗读的内容
+        text, _ = reduce_for_speech(text)
+        if not text:
+            logger.warning("精简后没有可朗读的内容，跳过语音生成")
+            return None
         logger.info(f"开始生成语音，文本长度: {len(text)} 字符")
         
-        start_time = datetime.now()
-        with client_sf.audio.speech.with_streaming_response.create(
-            model="FunAudioLLM/CosyVoice2-0.5B",
-            voice=voice_uri,
-            input=text,
-            response_format="mp3"
-        ) as response:
-            response.stream_to_file(output_path)
-        
-        duration = (datetime.now() - start_time).total_seconds()
-        logger.info(f"语音生成成功，耗时: {duration:.2f}秒，保存到: {output_path}")
-        return True
+        if tts_router is None:
+            tts_router = TTSRouter(RemoteTTSBackend(client_sf), LocalTTSBackend())
+        return tts_router.synthesize(text, output_path, voice_uri)
     except Exception as e:
         logger.error(f"语音生成失败: {str(e)}", exc_info=True)
-        return False
+        return None
 
 def play_audio(file_path):
     """播放音频文件"""
@@ -259,7 +289,41 @@ def play_audio(file_path):
         logger.error(f"播放音频失败: {str(e)}", exc_info=True)
         return False
 
-def show_menu():
+def speech_worker():
+    """后台语音线程：依次合成并播放队列中的回复"""
+    while True:
+        client_sf, text, voice_uri, output_path, log, node, generation = speech_queue.get()
+        try:
+            speech_file_path = generate_speech(client_sf, text, voice_uri, output_path)
+            if speech_file_path:
+                if node is not None:
+                    log.set_audio(speech_file_path, node, generation)
+                logger.info("🔊 正在播放语音回复...")
+                play_audio(speech_file_path)
+            else:
+                logger.warning("⚠️ 语音生成失败，仅显示文字回复")
+        except Exception as e:
+            logger.error(f"后台语音任务出错: {str(e)}", exc_info=True)
+        finally:
+            speech_queue.task_done()
+
+def speak_in_background(client_sf, text, voice_uri, log, part=None):
+    """把本轮回复交给后台语音线程，立即返回
+
+    part 为同一轮追加的语音片段（如并行模式的补充回复），单独保存，不替换该轮记录的语音文件。
+    """
+    global speech_thread
+    if speech_thread is None:
+        speech_thread = threading.Thread(target=speech_worker, name="speech", daemon=True)
+        speech_thread.start()
+    output_path = turn_speech_path(SPEECH_DIR, CLI_SESSION_ID, log.started[log.head], part)
+    # 记下本轮位置，语音完成时对话可能已经进入下一轮
+    node = log.head if part is None else None
+    speech_queue.put((client_sf, text, voice_uri, output_path, log, node, log.generation))
+    if speech_queue.qsize() > 1:
+        logger.info(f"语音任务排队中（前面还有 {speech_queue.qsize() - 1} 个）")
+
+def show_menu(auto_route=False):
     """显示主菜单"""
     print("\n" + "="*50)
     print("           AI 双模式对话系统")
@@ -268,127 +332,145 @@ def show_menu():
     print("2. 开始对话 (文字 + 语音)")
     print("3. 选择语音音色")
     print("4. 更新用户偏好")
-    print("5. 退出程序")
+    print(f"5. 切换自动模式 (当前: {'开启' if auto_route else '关闭'})")
+    print("6. 导出对话记录")
+    print("7. 退出程序")
     print("="*50)
     print("💡 对话技巧:")
     print("   ！开头 - 跳过逻辑分析，直接人性化回复")
     print("   #开头 - 仅逻辑分析，不进行人性化回复")
+    print("   &开头 - 先直接回复，同时进行逻辑分析，分析完成后补充")
+    print("   /命令 - 执行插件提供的自定义命令")
+    print("   自动模式 - 无前缀时自动判断是否需要逻辑分析")
     print("="*50)
 
 def get_menu_choice():
     """获取用户菜单选择"""
     while True:
         try:
-            choice = input("请选择功能 (1-5): ").strip()
-            if choice in ['1', '2', '3', '4', '5']:
+            choice = input("请选择功能 (1-7): ").strip()
+            if choice in ['1', '2', '3', '4', '5', '6', '7']:
                 return int(choice)
             else:
-                print("请输入1-5之间的数字")
+                print("请输入1-7之间的数字")
         except ValueError:
             print("请输入有效数字")
 
-def handle_conversation(user_input, client_sf, client_ba, system_prompt, history_sf, history_ba, voice_enabled=False, selected_voice=None):
+def export_conversations():
+    """导出对话记录（当前会话或全部会话）"""
+    default_path = EXPORT_DIR / f"conversation_{datetime.now().strftime('%Y%m%d_%H%M%S')}.md"
+    path = input(f"导出文件路径（.md / .jsonl / .html，回车使用 {default_path}）: ").strip()
+    path = Path(path) if path else default_path
+    if format_for(path) is None:
+        print("❌ 不支持的文件格式，请使用 .md、.jsonl 或 .html")
+        return
+    scope = input("导出范围：1. 当前会话  2. 全部会话（默认1）: ").strip()
+    if scope == '2':
+        sessions = session_manager.iter_sessions()
+    elif CLI_SESSION_ID in session_manager:
+        sessions = [session_manager.get(CLI_SESSION_ID)]
+    else:
+        print("❌ 当前没有对话记录")
+        return
+    try:
+        write_export(path, sessions)
+        print(f"✅ 对话记录已导出: {path}")
+    except Exception as e:
+        logger.error(f"导出对话记录失败: {str(e)}", exc_info=True)
+        print("❌ 导出失败，请检查日志文件")
+
+def handle_conversation(user_input, client_sf, client_ba, buffer_sf, buffer_ba, voice_enabled=False, selected_voice=None, auto_router=None):
     """
     处理对话逻辑：
     - 普通输入：SF进行逻辑性分析 + BA进行人性化回复
     - ！开头：跳过SF，直接BA人性化回复
     - #开头：仅SF逻辑分析，不进行BA回复
+    - &开头：BA先直接回复，SF同时分析，分析完成后显示并由BA简短补充
+    - 自动模式（auto_router）：无前缀时由本地分类器决定是否跳过SF
+    - /开头：执行插件注册的自定义命令
     """
     
+    # 插件注册的“/命令”直接执行，不经过SF/BA
+    command = plugins.match_command(user_input)
+    if command is not None:
+        reply = plugins.run_command(*command)
+        print(f"AI: {reply}")
+        return reply, None
+    
     # 检查特殊前缀
-    skip_sf = False
-    skip_ba = False
-    display_text = user_input
+    mode, display_text, explicit = parse_prefix(user_input)
+    skip_sf = mode == MODE_DIRECT
+    skip_ba = mode == MODE_ANALYSIS
+    both = mode == MODE_BOTH
     
-    if user_input.startswith('！'):
-        skip_sf = True
-        display_text = user_input[1:].strip()
+    if skip_sf:
         logger.info("用户选择跳过SF逻辑分析")
-        
-    elif user_input.startswith('#'):
-        skip_ba = True
-        display_text = user_input[1:].strip()
+    elif skip_ba:
         logger.info("用户选择跳过BA人性化回复")
+    elif both:
+        logger.info("用户选择并行模式：直接回复与逻辑分析同时进行")
     
     if not display_text:
         return "请输入有效内容（特殊前缀后需要有实际内容）", None
     
+    # 显式前缀优先，否则交给自动模式判断
+    if not explicit and auto_router is not None:
+        skip_sf = auto_router.decide(display_text).skip_sf
+    
     try:
         sf_analysis = None
+        sf_digest = None
         ba_reply = None
         
-        # Step 1: SF逻辑分析（除非被跳过）
-        if not skip_sf:
-            # SF固定提示词 - 专注于逻辑分析
-            sf_prompt = (
-                "你是一个逻辑分析助手。请对用户的问题进行深入的逻辑分析，包括：\n"
-                "1. 问题的核心要点\n"
-                "2. 可能的解决思路\n"
-                "3. 需要考虑的关键因素\n"
-                "4. 逻辑推理过程\n"
-                "请提供结构化的分析结果，不需要人性化的表达，专注于逻辑和事实。"
-            )
-            
-            logger.info("SF正在进行逻辑分析...")
-            
-            # 构建SF的对话历史
-            sf_messages = [{"role": "system", "content": sf_prompt}] + history_sf + [{"role": "user", "content": display_text}]
-            
-            logger.debug(f"SF请求消息: {sf_messages}")
-            start_time = datetime.now()
-            
-            sf_response = client_sf.chat.completions.create(
-                model="deepseek-ai/DeepSeek-R1",
-                messages=sf_messages,
-                temperature=0.3
-            )
-            
-            duration = (datetime.now() - start_time).total_seconds()
-            logger.info(f"SF分析完成，耗时: {duration:.2f}秒")
-            
-            sf_analysis = sf_response.choices[0].message.content
-            logger.debug(f"SF分析结果: {sf_analysis[:200]}...")
-            
-            # 更新SF历史记录
-            history_sf.append({"role": "user", "content": display_text})
-            history_sf.append({"role": "assistant", "content": sf_analysis})
+        # 从长期记忆检索相关的早期对话（仍在实时历史中的轮次除外）
+        recalled = None
+        if long_term_memory is not None:
+            recalled = format_recalled(long_term_memory.recall(display_text, buffer_ba.log.memory_rows()))
+        
+        # 两个阶段用同一个标识提交，记为同一轮
+        turn = buffer_ba.log.begin_turn(mode_prefix(mode) if explicit else None)
         
-        # Step 2: BA人性化回复（除非被跳过）
+        # Step 1: SF逻辑分析（除非被跳过；并行模式下在后台进行）
+        sf_future = None
+        if both:
+            sf_future = start_sf_stage(client_sf, buffer_sf, display_text, recalled, turn)
+        elif not skip_sf:
+            sf_result = run_sf_stage(client_sf, buffer_sf, display_text, recalled=recalled, turn=turn)
+            sf_analysis, sf_digest = sf_result.content, sf_result.digest
+        
+        # Step 2: BA人性化回复（除非被跳过），使用压缩后的分析摘要
         if not skip_ba:
-            logger.info("BA正在生成人性化回复...")
-            
-            if skip_sf:
-                # 直接回复用户问题
-                ba_input = display_text
-            else:
-                # 基于SF分析进行回复
-                ba_input = (
-                    f"基于以下逻辑分析结果，请给用户一个人性化、温暖的回复：\n\n"
-                    f"【逻辑分析(deepseek分析)】\n{sf_analysis}\n\n"
-                    f"【用户原问题】\n{display_text}\n\n"
-                    f"请结合分析结果，用符合用户偏好的方式进行回复。"
-                )
-            
-            # 构建BA的对话历史
-            ba_messages = [{"role": "system", "content": system_prompt}] + history_ba + [{"role": "user", "content": ba_input}]
-            logger.debug(f"BA请求消息: {ba_messages}")
-            
-            start_time = datetime.now()
-            ba_response = client_ba.chat.completions.create(
-                model="gpt-4o",
-                messages=ba_messages,
-                temperature=0.7
-            )
-            
-            duration = (datetime.now() - start_time).total_seconds()
-            logger.info(f"BA回复生成完成，耗时: {duration:.2f}秒")
-            
-            ba_reply = ba_response.choices[0].message.content
-            logger.debug(f"BA回复: {ba_reply[:200]}...")
-            
-            # 更新BA历史记录（存储原始用户输入和BA回复）
-            history_ba.append({"role": "user", "content": display_text})
-            history_ba.append({"role": "assistant", "content": ba_reply})
+            try:
+                ba_reply = run_ba_stage(client_ba, buffer_ba, display_text, sf_digest, recalled=recalled,
+                                        turn=turn).content
+            except Exception:
+                if sf_future is not None:
+                    # 后台分析仍会写入同一份历史，等它结束再返回，避免和下一轮交叉
+                    futures.wait([sf_future])
+                raise
+        
+        # 并行模式：先显示并朗读直接回复，等待分析完成后显示分析结果和补充（补充另排一个语音任务）
+        if sf_future is not None:
+            print(f"AI: {ba_reply}")
+            if voice_enabled and selected_voice and ba_reply:
+                speak_in_background(client_sf, ba_reply, selected_voice['uri'], buffer_ba.log)
+            print("⏳ 逻辑分析进行中...")
+            try:
+                sf_result = sf_future.result()
+                sf_analysis, sf_digest = sf_result.content, sf_result.digest
+                print(f"📊 逻辑分析结果：\n{sf_analysis}")
+                refinement = refine_reply(client_ba, buffer_ba, sf_digest)
+                if refinement:
+                    print(f"AI（补充）: {refinement}")
+                    ba_reply = buffer_ba.last_reply()
+                    if voice_enabled and selected_voice:
+                        speak_in_background(client_sf, refinement, selected_voice['uri'], buffer_ba.log, "refine")
+            except Exception as e:
+                logger.error(f"并行模式的逻辑分析或补充失败: {str(e)}", exc_info=True)
+                print("⚠️ 逻辑分析失败，仅保留直接回复")
+        
+        if long_term_memory is not None:
+            buffer_ba.log.set_memory(long_term_memory.add(display_text, ba_reply or sf_analysis), turn.node)
         
         # Step 3: 显示结果
         if skip_ba:
@@ -402,32 +484,121 @@ def handle_conversation(user_input, client_sf, client_ba, system_prompt, history
             # 显示BA回复（SF分析不直接显示给用户）
             final_reply = ba_reply
         
-        # Step 4: 可选生成语音（仅当有BA回复时）
-        if not skip_ba and voice_enabled and selected_voice and ba_reply:
-            speech_file_path = Path(__file__).parent / "ai_reply.mp3"
-            if generate_speech(client_sf, ba_reply, selected_voice['uri'], speech_file_path):
-                print(f"AI: {final_reply}")
-                print("🔊 正在播放语音回复...")
-                play_audio(speech_file_path)
-            else:
-                print(f"AI: {final_reply}")
-                print("⚠️ 语音生成失败，仅显示文字回复")
-        elif not skip_ba:
+        # Step 4: 先显示文字，再把语音交给后台线程合成和播放，不阻塞下一轮输入
+        if not both:
             print(f"AI: {final_reply}")
+        if not both and voice_enabled and selected_voice and ba_reply:
+            speak_in_background(client_sf, ba_reply, selected_voice['uri'], buffer_ba.log)
         
         return final_reply if not skip_ba else sf_analysis, sf_analysis
         
     except Exception as e:
         logger.error(f"对话处理出错: {str(e)}", exc_info=True)
+        if is_rate_limit_error(e):
+            return "请求过于频繁，已自动降速，请稍后再试。", None
         return "抱歉，处理您的请求时出现了错误，请稍后再试。", None
 
-def conversation_loop(client_sf, client_ba, system_prompt, voice_enabled=False, selected_voice=None):
-    """对话循环"""
-    # 初始化独立的对话历史
-    history_sf = []  # SF的对话历史
-    history_ba = []  # BA的对话历史
+def branch_command(user_input, session):
+    """处理对话分支命令
+
+    返回需要重新发送的用户输入；命令已处理完毕时返回空字符串，不是分支命令时返回 None。
+    分支命令优先于同名的插件命令。
+    """
+    command, _, args = user_input.partition(" ")
+    args = args.strip()
+    log = session.log
+    if command == "/regen":
+        if not len(log):
+            print("还没有可以重新生成的回复")
+            return ""
+        return session.rewind(len(log))
+    if command == "/edit":
+        turn, _, new_text = args.partition(" ")
+        if not turn.isdigit() or not 1 <= int(turn) <= len(log) or not new_text.strip():
+            print(f"用法: /edit 轮次 新内容（轮次 1-{len(log)}，/history 查看当前分支）")
+            return ""
+        session.rewind(int(turn))
+        return new_text.strip()
+    if command == "/history":
+        if not len(log):
+            print("当前分支还没有对话")
+        for turn, node in enumerate(log.path(), 1):
+            print(f"   {turn}. {log.user[node]}")
+        return ""
+    if command in ("/branches", "/switch"):
+        branches = session.branches()
+        if command == "/switch":
+            if not args.isdigit() or not 1 <= int(args) <= len(branches):
+                print(f"用法: /switch 分支序号（1-{len(branches)}，/branches 查看所有分支）")
+                return ""
+            node = branches[int(args) - 1][0]
+            session.switch_branch(node)
+            print(f"已切换到分支 {args}（共 {len(log)} 轮）")
+            if log.ba[node] is not None:
+                print(f"AI: {log.ba[node]}")
+            return ""
+        if not branches:
+            print("还没有对话分支")
+        for i, (node, turns, last_user, current) in enumerate(branches, 1):
+            print(f"{'*' if current else ' '} {i}. {turns}轮 | {last_user[:40]}")
+        return ""
+    return None
+
+def restyle_command(user_input, session, client_sf, client_ba, voice_enabled=False, selected_voice=None):
+    """处理重新润色命令，不是这类命令时返回 False
+
+    /restyle [轮次]：沿用该轮已有的逻辑分析，只按当前偏好重新生成BA回复（默认上一轮）
+    /prefs：在对话中更新用户偏好，可选择立即按新偏好重新生成上一轮回复
+    """
+    command, _, args = user_input.partition(" ")
+    if command not in ("/restyle", "/prefs"):
+        return False
+    args = args.strip()
+    log = session.log
+    if command == "/prefs":
+        session.set_system_prompt(create_system_prompt(get_user_preferences()))
+        print("✅ 用户偏好已更新")
+        if not len(log) or input("是否按新偏好重新生成上一轮回复？(y/n): ").strip().lower() != 'y':
+            return True
+        args = ""
+    if not len(log):
+        print("还没有可以重新生成的回复")
+        return True
+    turn = int(args) if args.isdigit() else len(log)
+    if (args and not args.isdigit()) or not 1 <= turn <= len(log):
+        print(f"用法: /restyle [轮次]（轮次 1-{len(log)}，默认上一轮）")
+        return True
+    if log.ba[log.path()[turn - 1]] is None:
+        print(f"第 {turn} 轮只有逻辑分析，没有可以重新润色的回复")
+        return True
+    
+    try:
+        result, saved_seconds, saved_tokens = restyle_reply(
+            client_ba, session.buffer_sf, session.buffer_ba, log.path()[turn - 1])
+    except Exception as e:
+        logger.error(f"重新生成回复失败: {str(e)}", exc_info=True)
+        print("抱歉，重新生成回复时出现了错误，请稍后再试。")
+        return True
+    print(f"AI: {result.content}")
+    if saved_tokens:
+        print(f"⚡ 沿用已有分析，节省约 {saved_seconds:.1f} 秒、约 {saved_tokens} token")
+    if voice_enabled and selected_voice and result.content:
+        speak_in_background(client_sf, result.content, selected_voice['uri'], log)
+    return True
+
+def conversation_loop(client_sf, client_ba, system_prompt, voice_enabled=False, selected_voice=None, auto_router=None):
+    """对话循环，返回结束时使用的系统提示词（对话中可能用 /prefs 更新）"""
+    # 初始化独立的对话历史（原地追加，保持提示词前缀稳定）
+    session = session_manager.get(CLI_SESSION_ID, system_prompt=system_prompt)
+    session.set_system_prompt(system_prompt)
+    session.clear()
+    # 新对话不再检索被清空的内容
+    if long_term_memory is not None:
+        long_term_memory.clear()
     
     mode_text = "文字 + 语音模式" if voice_enabled else "纯文字模式"
+    if auto_router is not None:
+        mode_text += "，自动模式"
     print(f"\n=== 对话开始 ({mode_text}) ===")
     if voice_enabled and selected_voice:
         print(f"当前音色: {selected_voice.get('customName', 'Unknown')}")
@@ -435,6 +606,10 @@ def conversation_loop(client_sf, client_ba, system_prompt, voice_enabled=False,
     print("   输入 'quit' 或 'exit' 返回主菜单")
     print("   ！开头 - 跳过逻辑分析，直接人性化回复")
     print("   #开头 - 仅逻辑分析，不进行人性化回复")
+    print("   &开头 - 先直接回复，同时进行逻辑分析，分析完成后补充")
+    print("   /regen - 重新生成上一轮回复；/edit 轮次 新内容 - 修改早先的输入并从那里重新对话")
+    print("   /history - 查看当前分支；/branches - 列出所有分支；/switch 序号 - 切换分支")
+    print("   /restyle [轮次] - 沿用已有分析，按当前偏好重新生成回复；/prefs - 更新用户偏好")
     print()
     
     while True:
@@ -449,18 +624,35 @@ def conversation_loop(client_sf, client_ba, system_prompt, voice_enabled=False,
                 print("请输入有效内容")
                 continue
             
+            # 分支命令：回到早先的轮次后按普通输入重新发送
+            with session_manager.use(CLI_SESSION_ID) as session:
+                if restyle_command(user_input, session, client_sf, client_ba, voice_enabled, selected_voice):
+                    continue
+                rerun = branch_command(user_input, session)
+            if rerun == "":
+                continue
+            if rerun is not None:
+                user_input = rerun
+                print(f"用户: {user_input}")
+            
             # 记录对话开始时间
             start_time = datetime.now()
             
             # 处理对话
-            ba_reply, sf_analysis = handle_conversation(
-                user_input, client_sf, client_ba, system_prompt, 
-                history_sf, history_ba, voice_enabled, selected_voice
-            )
+            with session_manager.use(CLI_SESSION_ID) as session, \
+                    (profiler.profile() if profiler else nullcontext()):
+                ba_reply, sf_analysis = handle_conversation(
+                    user_input, client_sf, client_ba,
+                    session.buffer_sf, session.buffer_ba, voice_enabled, selected_voice, auto_router
+                )
+                if long_term_memory is not None:
+                    session.trim_history(HISTORY_MAX_TURNS)
             
             # 记录对话完成时间
             duration = (datetime.now() - start_time).total_seconds()
             logger.info(f"完整对话处理耗时: {duration:.2f}秒")
+            if prewarmer is not None:
+                prewarmer.report_first_turn(duration)
             
             # 如果没有启用语音且不是特殊命令，显示分隔符
             if not voice_enabled and not user_input.startswith(('#', '！')):
@@ -474,15 +666,35 @@ def conversation_loop(client_sf, client_ba, system_prompt, voice_enabled=False,
         except Exception as e:
             logger.error(f"对话循环出错: {str(e)}", exc_info=True)
             print("发生错误，请重试。")
+    
+    return session_manager.get(CLI_SESSION_ID).system_prompt
+
+def parse_args():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="AI 双模式对话系统（命令行版）")
+    parser.add_argument("--profile", nargs="?", const="profiles", metavar="DIR",
+                        help="对每轮对话进行性能分析，结果保存到 DIR（默认 profiles）")
+    return parser.parse_args()
 
 def main():
     """主函数"""
+    global prewarmer, tts_router, profiler, long_term_memory
+    args = parse_args()
     logger.info("程序启动")
     
+    if args.profile:
+        profiler = TurnProfiler(Path(args.profile))
+        logger.info(f"性能分析已开启，结果保存到: {args.profile}")
+    
     try:
         # 初始化API客户端
         client_sf, client_ba = get_api_clients()
         
+        # 后台预热连接并预取音色列表
+        prewarmer = Prewarmer({"SF": client_sf, "BA": client_ba}, client_sf.api_key).start()
+        tts_router = TTSRouter(RemoteTTSBackend(client_sf), LocalTTSBackend())
+        long_term_memory = create_memory(MEMORY_DIR / CLI_SESSION_ID)
+        
         # 获取用户偏好
         user_preferences = get_user_preferences()
         
@@ -497,14 +709,19 @@ def main():
         if selected_voice:
             logger.info(f"从缓存加载音色: {selected_voice.get('customName', 'Unknown')}")
         
+        # 自动模式设置
+        auto_route = cached_data.get('auto_route', False) if cached_data else False
+        router = AutoRouter()
+        
         while True:
             try:
-                show_menu()
+                show_menu(auto_route)
                 choice = get_menu_choice()
+                auto_router = router if auto_route else None
                 
                 if choice == 1:
                     # 纯文字对话
-                    conversation_loop(client_sf, client_ba, system_prompt, False, None)
+                    system_prompt = conversation_loop(client_sf, client_ba, system_prompt, False, None, auto_router)
                     
                 elif choice == 2:
                     # 文字 + 语音对话
@@ -519,14 +736,14 @@ def main():
                             selected_voice = select_voice(voice_list)
                             if not selected_voice:
                                 print("未选择音色，将使用纯文字模式")
-                                conversation_loop(client_sf, client_ba, system_prompt, False, None)
+                                system_prompt = conversation_loop(client_sf, client_ba, system_prompt, False, None, auto_router)
                             else:
-                                conversation_loop(client_sf, client_ba, system_prompt, True, selected_voice)
+                                system_prompt = conversation_loop(client_sf, client_ba, system_prompt, True, selected_voice, auto_router)
                         else:
                             print("无法获取音色列表，将使用纯文字模式")
-                            conversation_loop(client_sf, client_ba, system_prompt, False, None)
+                            system_prompt = conversation_loop(client_sf, client_ba, system_prompt, False, None, auto_router)
                     else:
-                        conversation_loop(client_sf, client_ba, system_prompt, True, selected_voice)
+                        system_prompt = conversation_loop(client_sf, client_ba, system_prompt, True, selected_voice, auto_router)
                         
                 elif choice == 3:
                     # 选择语音音色
@@ -549,6 +766,19 @@ def main():
                     print("✅ 用户偏好已更新")
                     
                 elif choice == 5:
+                    # 切换自动模式
+                    auto_route = not auto_route
+                    cached_data = load_cached_data() or {}
+                    cached_data['auto_route'] = auto_route
+                    save_to_cache(cached_data)
+                    logger.info(f"自动模式已{'开启' if auto_route else '关闭'}")
+                    print(f"✅ 自动模式已{'开启' if auto_route else '关闭'}")
+                    
+                elif choice == 6:
+                    # 导出对话记录
+                    export_conversations()
+                    
+                elif choice == 7:
                     # 退出程序
                     logger.info("用户选择退出程序")
                     print("感谢使用，再见！")
@@ -561,6 +791,9 @@ def main():
             except Exception as e:
                 logger.error(f"主程序出错: {str(e)}", exc_info=True)
                 print("发生错误，请重试。")
+        
+        # 退出前把内存中的会话写入磁盘，下次启动仍可导出
+        session_manager.flush()
     except Exception as e:
         logger.error(f"程序初始化失败: {str(e)}", exc_info=True)
         print("程序初始化失败，请检查日志文件。")
@@ -1,7 +1,8 @@
 import tkinter as tk
-from tkinter import ttk, messagebox, scrolledtext, filedialog
+from tkinter import ttk, messagebox, scrolledtext, filedialog, simpledialog
 from tkinter import font as tkFont
 import threading
+from concurrent import futures
 import queue
 import json
 import hashlib
@@ -11,10 +12,25 @@ import subprocess
 from pathlib import Path
 from datetime import datetime
 import logging
-from openai import OpenAI
-import requests
+import argparse
+from contextlib import contextmanager, nullcontext
 from pydub import AudioSegment
 import simpleaudio as sa
+from aia.clients import create_clients, fetch_voice_list
+from aia.digest import ReasoningFilter
+from aia.export import write_export, format_for
+from aia.markdown_stream import MarkdownStream, render
+from aia.memory import create_memory, format_recalled, HISTORY_MAX_TURNS
+from aia.pipeline import run_sf_stage, run_ba_stage, finish_sf_stage, sf_request, start_sf_stage, refine_reply, restyle_reply
+from aia.plugins import plugins
+from aia.prewarm import Prewarmer
+from aia.profiling import TurnProfiler
+from aia.ratelimit import is_rate_limit_error
+from aia.sessions import SessionManager
+from aia.speech_text import reduce_for_speech
+from aia.tts import TTSRouter, RemoteTTSBackend, LocalTTSBackend, turn_speech_path
+from aia.routing import AutoRouter, analysis_score, parse_prefix, mode_prefix, MODE_DIRECT, MODE_ANALYSIS, MODE_BOTH
+from aia.speculation import Speculator, PAUSE_MS, MIN_CHARS
 
 # 创建一个 Logger
 logger = logging.getLogger(__name__)
@@ -39,9 +55,16 @@ console_handler.setFormatter(formatter)
 logger.addHandler(file_handler)
 logger.addHandler(console_handler)
 
+# 共享管线模块使用同样的Handler
+aia_logger = logging.getLogger("aia")
+aia_logger.setLevel(logging.DEBUG)
+aia_logger.addHandler(file_handler)
+aia_logger.addHandler(console_handler)
+
 class AIChat:
-    def __init__(self, root):
+    def __init__(self, root, profiler=None):
         self.root = root
+        self.profiler = profiler
         self.root.title("AI 双模式对话系统")
         self.root.geometry("1000x700")
         self.root.minsize(800, 600)
@@ -52,22 +75,36 @@ class AIChat:
         # 初始化变量
         self.client_sf = None
         self.client_ba = None
+        self.prewarmer = None
+        self.tts_router = None
         self.system_prompt = ""
-        self.history_sf = []
-        self.history_ba = []
         self.voice_list = []
         self.selected_voice = None
         self.user_preferences = {}
         self.voice_enabled = tk.BooleanVar()
+        self.auto_route = tk.BooleanVar()
+        self.auto_router = AutoRouter()
+        self.speculative = tk.BooleanVar()
+        self.speculator = Speculator()
+        self.speculate_job = None
         self.message_queue = queue.Queue()
         
         # 缓存设置
         self.CACHE_DIR = Path(__file__).parent
         self.CACHE_FILE = self.CACHE_DIR / "user_cache.json"
         
+        # 会话管理
+        self.session_id = "gui"
+        self.session_manager = SessionManager(self.CACHE_DIR / "sessions")
+        self.session = self.session_manager.get(self.session_id)
+        self.session.clear()
+        
         # 设置日志
         self.setup_logging()
         
+        # 长期记忆
+        self.memory = create_memory(self.CACHE_DIR / "memory" / self.session_id)
+        
         # 创建界面
         self.create_widgets()
         
@@ -142,10 +179,27 @@ class AIChat:
         ttk.Label(mode_frame, text="特殊前缀:", font=('Arial', 9, 'bold')).pack(anchor=tk.W)
         ttk.Label(mode_frame, text="！- 直接人性化回复", style='Status.TLabel').pack(anchor=tk.W)
         ttk.Label(mode_frame, text="#- 仅逻辑分析", style='Status.TLabel').pack(anchor=tk.W)
+        ttk.Label(mode_frame, text="&- 先直接回复，同时分析", style='Status.TLabel').pack(anchor=tk.W)
+        ttk.Checkbutton(mode_frame, text="自动模式（简单问题跳过分析）", variable=self.auto_route,
+                        command=self.toggle_auto_route).pack(anchor=tk.W, pady=(5, 0))
+        ttk.Checkbutton(mode_frame, text="输入停顿时预先分析", variable=self.speculative,
+                        command=self.toggle_speculative).pack(anchor=tk.W)
         
         # 清空对话按钮
         ttk.Button(control_frame, text="清空对话历史", command=self.clear_chat).pack(fill=tk.X, pady=(10, 0))
         
+        # 导出对话
+        ttk.Button(control_frame, text="导出对话", command=self.export_chat).pack(fill=tk.X, pady=2)
+        
+        # 对话分支：重新生成、编辑早先的消息都会另起一个分支，原来的分支可以切换回去
+        ttk.Button(control_frame, text="重新生成", command=self.regenerate_reply).pack(fill=tk.X, pady=(10, 2))
+        ttk.Button(control_frame, text="编辑消息", command=self.edit_message).pack(fill=tk.X, pady=2)
+        ttk.Button(control_frame, text="按当前偏好重新润色", command=self.restyle_turn).pack(fill=tk.X, pady=2)
+        branch_frame = ttk.Frame(control_frame)
+        branch_frame.pack(fill=tk.X, pady=2)
+        ttk.Button(branch_frame, text="◀ 上一分支", command=lambda: self.switch_branch(-1)).pack(side=tk.LEFT, expand=True, fill=tk.X)
+        ttk.Button(branch_frame, text="下一分支 ▶", command=lambda: self.switch_branch(1)).pack(side=tk.LEFT, expand=True, fill=tk.X)
+        
         # 状态标签
         self.status_label = ttk.Label(main_frame, text="正在初始化...", style='Status.TLabel')
         self.status_label.grid(row=1, column=1, sticky=(tk.W, tk.E), pady=(0, 5))
@@ -172,6 +226,16 @@ class AIChat:
         self.chat_display.tag_configure("system", foreground="gray", font=('Arial', 9, 'italic'))
         self.chat_display.tag_configure("analysis", foreground="purple")
         
+        # Markdown 格式（见 aia.markdown_stream）
+        self.chat_display.tag_configure("md_h1", font=('Arial', 15, 'bold'), spacing1=6, spacing3=2)
+        self.chat_display.tag_configure("md_h2", font=('Arial', 13, 'bold'), spacing1=4, spacing3=2)
+        self.chat_display.tag_configure("md_h3", font=('Arial', 11, 'bold'), spacing1=2)
+        self.chat_display.tag_configure("md_list", lmargin1=12, lmargin2=28)
+        self.chat_display.tag_configure("md_quote", foreground="gray", lmargin1=16, lmargin2=16)
+        self.chat_display.tag_configure("md_bold", font=('Arial', 10, 'bold'))
+        self.chat_display.tag_configure("md_code", font=('Courier', 10), background="#f3f3f3")
+        self.chat_display.tag_configure("md_hr", foreground="lightgray")
+        
         # 输入区域
         input_frame = ttk.Frame(main_frame)
         input_frame.grid(row=3, column=1, columnspan=2, sticky=(tk.W, tk.E), pady=(5, 0))
@@ -181,6 +245,7 @@ class AIChat:
         self.input_text.grid(row=0, column=0, sticky=(tk.W, tk.E), padx=(0, 5))
         self.input_text.bind('<Return>', self.on_enter)
         self.input_text.bind('<Control-Return>', self.insert_newline)
+        self.input_text.bind('<KeyRelease>', self.on_key_release)
         
         send_button = ttk.Button(input_frame, text="发送", command=self.send_message)
         send_button.grid(row=0, column=1, sticky=(tk.N, tk.S))
@@ -197,6 +262,45 @@ class AIChat:
         self.send_message()
         return "break"
     
+    def on_key_release(self, event):
+        """输入停顿后预判分析草稿"""
+        if not self.speculative.get():
+            return
+        if self.speculate_job is not None:
+            self.root.after_cancel(self.speculate_job)
+        self.speculate_job = self.root.after(PAUSE_MS, self.speculate_draft)
+    
+    def speculate_draft(self):
+        """用当前草稿在后台发起SF分析"""
+        self.speculate_job = None
+        if not self.client_sf or not self.system_prompt or self.session.busy:
+            return
+        draft = self.input_text.get(1.0, tk.END).strip()
+        if self.speculator.matches(draft):
+            return
+        if plugins.match_command(draft) is not None:
+            self.speculator.cancel("草稿是插件命令")
+            return
+        mode, display_text, explicit = parse_prefix(draft)
+        if len(display_text) < MIN_CHARS or mode == MODE_DIRECT:
+            self.speculator.cancel("草稿不需要分析")
+            return
+        # 自动模式会跳过分析的草稿不预判（只打分，不计入自动模式统计）
+        if not explicit and self.auto_route.get() and analysis_score(display_text)[0] < self.auto_router.skip_below:
+            self.speculator.cancel("草稿不需要分析")
+            return
+        memory, live_rows = self.memory, self.session.log.memory_rows()
+        
+        def build_request():
+            # 在预判线程中检索长期记忆并构建请求，pre_sf 插件只在这里执行一次
+            recalled = None
+            if memory is not None:
+                recalled = format_recalled(memory.recall(display_text, live_rows))
+            timings = {}
+            return sf_request(display_text, recalled, timings), timings
+        
+        self.speculator.start(self.client_sf, self.session.buffer_sf, display_text, build_request)
+    
     def get_cache_key(self):
         """生成缓存键"""
         machine_info = platform.uname()
@@ -243,14 +347,10 @@ class AIChat:
             # 如果有缓存的API密钥，自动初始化客户端
             if cached_data and 'api_keys' in cached_data:
                 try:
-                    self.client_sf = OpenAI(
-                        api_key=cached_data['api_keys']['sf'],
-                        base_url="https://api.siliconflow.cn/v1"
-                    )
-                    self.client_ba = OpenAI(
-                        api_key=cached_data['api_keys']['ba'],
-                        base_url="https://api2.aigcbest.top/v1"
+                    self.client_sf, self.client_ba = create_clients(
+                        cached_data['api_keys']['sf'], cached_data['api_keys']['ba']
                     )
+                    self.on_clients_ready()
                     self.message_queue.put(("status", "API客户端已就绪"))
                 except Exception as e:
                     self.message_queue.put(("status", f"API初始化失败: {str(e)}"))
@@ -259,8 +359,15 @@ class AIChat:
             if cached_data and 'preferences' in cached_data:
                 self.user_preferences = cached_data['preferences']
                 self.system_prompt = self.create_system_prompt(self.user_preferences)
+                self.session.set_preferences(self.user_preferences, self.system_prompt)
                 self.message_queue.put(("status", "用户偏好已加载"))
             
+            # 加载自动模式设置
+            if cached_data and cached_data.get('auto_route'):
+                self.root.after(0, self.auto_route.set, True)
+            if cached_data and cached_data.get('speculative_sf'):
+                self.root.after(0, self.speculative.set, True)
+            
             # 加载语音设置
             if cached_data and 'selected_voice' in cached_data:
                 self.selected_voice = cached_data['selected_voice']
@@ -276,6 +383,15 @@ class AIChat:
         
         threading.Thread(target=init_thread, daemon=True).start()
     
+    def on_clients_ready(self):
+        """客户端创建后：后台预热连接、预取音色列表，并准备语音合成后端"""
+        if self.prewarmer is not None:
+            self.prewarmer.stop()
+        self.prewarmer = Prewarmer(
+            {"SF": self.client_sf, "BA": self.client_ba}, self.client_sf.api_key
+        ).start()
+        self.tts_router = TTSRouter(RemoteTTSBackend(self.client_sf), LocalTTSBackend())
+    
     def process_queue(self):
         """处理消息队列"""
         try:
@@ -288,6 +404,8 @@ class AIChat:
                     self.voice_status_label.config(text=content)
                 elif msg_type == "chat":
                     self.append_to_chat(*content)
+                elif msg_type == "segments":
+                    self.insert_segments(*content)
                 elif msg_type == "error":
                     messagebox.showerror("错误", content)
         except queue.Empty:
@@ -303,14 +421,8 @@ class AIChat:
         if dialog.result:
             sf_key, ba_key = dialog.result
             try:
-                self.client_sf = OpenAI(
-                    api_key=sf_key,
-                    base_url="https://api.siliconflow.cn/v1"
-                )
-                self.client_ba = OpenAI(
-                    api_key=ba_key,
-                    base_url="https://api2.aigcbest.top/v1"
-                )
+                self.client_sf, self.client_ba = create_clients(sf_key, ba_key)
+                self.on_clients_ready()
                 
                 # 保存到缓存
                 cached_data = self.load_cached_data() or {}
@@ -330,6 +442,7 @@ class AIChat:
         if dialog.result:
             self.user_preferences = dialog.result
             self.system_prompt = self.create_system_prompt(self.user_preferences)
+            self.session.set_preferences(self.user_preferences, self.system_prompt)
             
             # 保存到缓存
             cached_data = self.load_cached_data() or {}
@@ -337,7 +450,31 @@ class AIChat:
             self.save_to_cache(cached_data)
             
             self.status_label.config(text="用户偏好设置成功")
-            messagebox.showinfo("成功", "用户偏好设置成功！")
+            if len(self.session.log) and not self.session.busy and messagebox.askyesno(
+                    "成功", "用户偏好设置成功！\n是否按新偏好重新生成上一轮回复？（沿用已有的逻辑分析）"):
+                self.restyle_turn(len(self.session.log))
+            else:
+                messagebox.showinfo("成功", "用户偏好设置成功！")
+    
+    def toggle_auto_route(self):
+        """切换自动模式并保存设置"""
+        enabled = self.auto_route.get()
+        cached_data = self.load_cached_data() or {}
+        cached_data['auto_route'] = enabled
+        self.save_to_cache(cached_data)
+        self.logger.info(f"自动模式已{'开启' if enabled else '关闭'}")
+        self.status_label.config(text=f"自动模式已{'开启' if enabled else '关闭'}")
+    
+    def toggle_speculative(self):
+        """切换输入时预判分析并保存设置"""
+        enabled = self.speculative.get()
+        if not enabled:
+            self.speculator.cancel("已关闭预判")
+        cached_data = self.load_cached_data() or {}
+        cached_data['speculative_sf'] = enabled
+        self.save_to_cache(cached_data)
+        self.logger.info(f"预判分析已{'开启' if enabled else '关闭'}")
+        self.status_label.config(text=f"预判分析已{'开启' if enabled else '关闭'}")
     
     def create_system_prompt(self, preferences):
         """创建系统提示词"""
@@ -377,14 +514,12 @@ class AIChat:
     def get_voice_list(self):
         """获取音色列表"""
         try:
-            url = "https://api.siliconflow.cn/v1/audio/voice/list"
-            headers = {"Authorization": f"Bearer {self.client_sf.api_key}"}
-            response = requests.get(url, headers=headers)
-            
-            if response.status_code == 200:
-                voice_data = response.json()
-                return voice_data.get('result', [])
-            return []
+            # 首次使用预热阶段预取的音色列表，之后实时获取（可能有新上传的音色）
+            if self.prewarmer is not None:
+                voice_list = self.prewarmer.get_voice_list()
+                if voice_list:
+                    return voice_list
+            return fetch_voice_list(self.client_sf.api_key)
         except Exception as e:
             self.logger.error(f"获取音色列表失败: {e}")
             return []
@@ -407,14 +542,163 @@ class AIChat:
             messagebox.showinfo("成功", f"音色设置成功: {voice_name}")
     
     def clear_chat(self):
-        """清空对话历史"""
-        self.history_sf.clear()
-        self.history_ba.clear()
+        """清空对话历史，同时清空长期记忆，之后不会再检索到被清空的对话"""
+        self.session.clear()
+        if self.memory is not None:
+            self.memory.clear()
         self.chat_display.config(state=tk.NORMAL)
         self.chat_display.delete(1.0, tk.END)
         self.chat_display.config(state=tk.DISABLED)
         self.status_label.config(text="对话历史已清空")
     
+    def branch_ready(self):
+        """分支操作只能在没有对话进行时执行"""
+        if not self.client_sf or not self.client_ba or not self.system_prompt:
+            messagebox.showwarning("警告", "请先配置API密钥并设置用户偏好")
+            return False
+        if self.session.busy:
+            self.status_label.config(text="请等待当前回复完成")
+            return False
+        return True
+    
+    def regenerate_reply(self):
+        """重新生成上一轮回复，原来的回复保留在另一个分支中"""
+        if not self.branch_ready():
+            return
+        with self.session_manager.use(self.session_id) as session:
+            if not len(session.log):
+                self.status_label.config(text="还没有可以重新生成的回复")
+                return
+            message = session.rewind(len(session.log))
+        self.submit_message(message, self.redraw_chat())
+    
+    def edit_message(self):
+        """修改当前分支中早先的一条输入，从那一轮起另开一个分支重新对话"""
+        if not self.branch_ready():
+            return
+        with self.session_manager.use(self.session_id) as session:
+            path = session.log.path()
+            if not path:
+                self.status_label.config(text="还没有可以编辑的消息")
+                return
+            turn = simpledialog.askinteger("编辑消息", f"要修改第几轮的输入？（1-{len(path)}）", parent=self.root,
+                                           initialvalue=len(path), minvalue=1, maxvalue=len(path))
+            if turn is None:
+                return
+            message = simpledialog.askstring("编辑消息", "新的输入：", parent=self.root,
+                                             initialvalue=session.log.input(path[turn - 1]))
+            if not message or not message.strip():
+                return
+            session.rewind(turn)
+        self.submit_message(message.strip(), self.redraw_chat())
+    
+    def switch_branch(self, step):
+        """按创建顺序切换到上一个或下一个分支"""
+        if not self.branch_ready():
+            return
+        with self.session_manager.use(self.session_id) as session:
+            branches = session.branches()
+            if len(branches) < 2:
+                self.status_label.config(text="当前只有一个分支")
+                return
+            current = next((i for i, branch in enumerate(branches) if branch[3]), -1 if step > 0 else 0)
+            index = (current + step) % len(branches)
+            session.switch_branch(branches[index][0])
+        self.redraw_chat()
+        self.status_label.config(text=f"分支 {index + 1}/{len(branches)}")
+    
+    def restyle_turn(self, turn=None):
+        """沿用某一轮已有的逻辑分析，只按当前偏好重新生成BA回复（另起一个分支）"""
+        if not self.branch_ready():
+            return
+        log = self.session.log
+        path = log.path()
+        if not path:
+            self.status_label.config(text="还没有可以重新润色的回复")
+            return
+        if turn is None:
+            turn = simpledialog.askinteger("重新润色", f"按当前偏好重新生成第几轮的回复？（1-{len(path)}）",
+                                           parent=self.root, initialvalue=len(path), minvalue=1, maxvalue=len(path))
+            if turn is None:
+                return
+        node = path[turn - 1]
+        if log.ba[node] is None:
+            self.status_label.config(text=f"第 {turn} 轮只有逻辑分析，没有可以重新润色的回复")
+            return
+        user_text = log.user[node]
+        # 聊天区只保留该轮之前的内容和该轮的输入，新回复随后流式显示
+        renderer = self.redraw_chat(path[:turn - 1])
+        voice_enabled = self.voice_enabled.get()
+        
+        def restyle():
+            try:
+                renderer.join()
+                self.message_queue.put(("chat", (f"用户: {user_text}", "user")))
+                self.message_queue.put(("status", "AI正在按当前偏好重新生成回复..."))
+                with self.session_manager.use(self.session_id) as session:
+                    with self.chat_stream("ai", "AI: ", "post_ba") as on_delta:
+                        result, saved_seconds, saved_tokens = restyle_reply(
+                            self.client_ba, session.buffer_sf, session.buffer_ba, node, on_delta)
+                    if on_delta is None:
+                        self.show_markdown("AI: ", result.content, "ai")
+                if saved_tokens:
+                    self.message_queue.put(("status", f"沿用已有分析，节省约 {saved_seconds:.1f} 秒、约 {saved_tokens} token"))
+                else:
+                    self.message_queue.put(("status", "系统就绪"))
+                if voice_enabled and self.selected_voice and result.content:
+                    self.generate_and_play_speech(result.content, session.log)
+            except Exception as e:
+                self.logger.error(f"重新生成回复失败: {e}")
+                self.message_queue.put(("error", f"重新生成回复失败: {str(e)}"))
+        
+        threading.Thread(target=restyle, daemon=True).start()
+    
+    def redraw_chat(self, nodes=None):
+        """按当前分支（或给定的节点）重新显示聊天区，Markdown 在工作线程中解析，返回该线程"""
+        self.chat_display.config(state=tk.NORMAL)
+        self.chat_display.delete(1.0, tk.END)
+        self.chat_display.config(state=tk.DISABLED)
+        log = self.session.log
+        turns = [(log.user[node], log.sf[node], log.ba[node]) for node in (log.path() if nodes is None else nodes)]
+        
+        def render_turns():
+            for user, analysis, reply in turns:
+                self.message_queue.put(("chat", (f"用户: {user}", "user")))
+                if analysis is not None and reply is None:
+                    self.show_markdown("📊 逻辑分析结果：\n", analysis, "analysis")
+                if reply is not None:
+                    self.show_markdown("AI: ", reply, "ai")
+        
+        renderer = threading.Thread(target=render_turns, daemon=True)
+        renderer.start()
+        return renderer
+    
+    def export_chat(self):
+        """导出当前会话的对话记录"""
+        path = filedialog.asksaveasfilename(
+            title="导出对话",
+            defaultextension=".md",
+            initialfile=f"conversation_{datetime.now().strftime('%Y%m%d_%H%M%S')}.md",
+            filetypes=[("Markdown", "*.md"), ("JSON Lines", "*.jsonl"), ("HTML", "*.html")]
+        )
+        if not path:
+            return
+        if format_for(path) is None:
+            messagebox.showwarning("警告", "不支持的文件格式，请使用 .md、.jsonl 或 .html")
+            return
+        
+        self.status_label.config(text="正在导出对话...")
+        
+        def export():
+            try:
+                write_export(path, [self.session_manager.get(self.session_id)])
+                self.root.after(0, lambda: self.status_label.config(text=f"对话已导出: {Path(path).name}"))
+            except Exception as e:
+                logger.error(f"导出对话失败: {str(e)}", exc_info=True)
+                self.root.after(0, lambda: messagebox.showerror("错误", f"导出对话失败: {str(e)}"))
+        
+        threading.Thread(target=export, daemon=True).start()
+    
     def append_to_chat(self, text, tag=None):
         """添加文本到聊天区域"""
         self.chat_display.config(state=tk.NORMAL)
@@ -426,6 +710,43 @@ class AIChat:
         self.chat_display.see(tk.END)
         self.chat_display.config(state=tk.DISABLED)
     
+    def insert_segments(self, tag, segments):
+        """插入已解析好的 Markdown 片段（Tk 线程中只做插入）"""
+        self.chat_display.config(state=tk.NORMAL)
+        for text, tags in segments:
+            self.chat_display.insert(tk.END, text, (tag,) + tags)
+        self.chat_display.see(tk.END)
+        self.chat_display.config(state=tk.DISABLED)
+    
+    def show_markdown(self, prefix, text, tag):
+        """在工作线程中解析完整回复，交给 Tk 线程插入"""
+        self.message_queue.put(("segments", (tag, [(prefix, ())] + render(text) + [("\n", ())])))
+    
+    @contextmanager
+    def chat_stream(self, tag, prefix, hook):
+        """
+        在聊天区流式显示一段回复，产出传给管线的 on_delta：
+        分片在调用方（工作）线程中去掉 <think> 推理内容后增量解析，Tk 线程只插入新片段。
+        该阶段有后处理插件（hook）时结果可能被改写，产出 None，由调用方在完成后整段显示。
+        """
+        if plugins.entry_points(hook):
+            yield None
+            return
+        parser = MarkdownStream()
+        reasoning = ReasoningFilter()
+        self.message_queue.put(("segments", (tag, [(prefix, ())])))
+        
+        def on_delta(text):
+            segments = parser.feed(reasoning.feed(text))
+            if segments:
+                self.message_queue.put(("segments", (tag, segments)))
+        
+        try:
+            yield on_delta
+        finally:
+            segments = parser.feed(reasoning.close())
+            self.message_queue.put(("segments", (tag, segments + parser.close() + [("\n", ())])))
+    
     def send_message(self):
         """发送消息"""
         if not self.client_sf or not self.client_ba:
@@ -442,128 +763,184 @@ class AIChat:
         
         # 清空输入框
         self.input_text.delete(1.0, tk.END)
-        
+        if self.speculate_job is not None:
+            self.root.after_cancel(self.speculate_job)
+            self.speculate_job = None
+        self.submit_message(message)
+    
+    def submit_message(self, message, after=None):
+        """显示用户消息并在后台处理对话；after 为需要先完成的聊天区重绘线程"""
         # 显示用户消息
-        self.append_to_chat(f"用户: {message}", "user")
+        if after is None:
+            self.append_to_chat(f"用户: {message}", "user")
+        
+        # Tk 变量只能在界面线程中读取，先取好当前设置
+        auto_route, voice_enabled = self.auto_route.get(), self.voice_enabled.get()
         
         # 在后台处理对话
         def process_message():
             try:
+                if after is not None:
+                    after.join()
+                    self.message_queue.put(("chat", (f"用户: {message}", "user")))
                 self.message_queue.put(("status", "AI正在思考..."))
                 
                 # 处理对话逻辑
-                result = self.handle_conversation(message)
+                start_time = datetime.now()
+                with self.profiler.profile() if self.profiler else nullcontext():
+                    result = self.handle_conversation(message, auto_route, voice_enabled)
+                if self.prewarmer is not None:
+                    self.prewarmer.report_first_turn((datetime.now() - start_time).total_seconds())
                 
                 self.message_queue.put(("status", "系统就绪"))
                 
             except Exception as e:
                 self.logger.error(f"处理消息失败: {e}")
-                self.message_queue.put(("error", f"处理消息失败: {str(e)}"))
+                if is_rate_limit_error(e):
+                    self.message_queue.put(("error", "请求过于频繁，已自动降速，请稍后再试。"))
+                else:
+                    self.message_queue.put(("error", f"处理消息失败: {str(e)}"))
         
         threading.Thread(target=process_message, daemon=True).start()
     
-    def handle_conversation(self, user_input):
-        """处理对话逻辑"""
-        # 检查特殊前缀
-        skip_sf = False
-        skip_ba = False
-        display_text = user_input
+    def handle_conversation(self, user_input, auto_route=False, voice_enabled=False):
+        """处理对话逻辑（在工作线程中执行）；auto_route / voice_enabled 为提交时界面上的设置"""
+        # 插件注册的“/命令”直接执行，不经过SF/BA
+        command = plugins.match_command(user_input)
+        if command is not None:
+            self.speculator.cancel("插件命令")
+            self.show_markdown("AI: ", plugins.run_command(*command), "ai")
+            return
         
-        if user_input.startswith('！'):
-            skip_sf = True
-            display_text = user_input[1:].strip()
-        elif user_input.startswith('#'):
-            skip_ba = True
-            display_text = user_input[1:].strip()
+        # 检查特殊前缀
+        mode, display_text, explicit = parse_prefix(user_input)
+        skip_sf = mode == MODE_DIRECT
+        skip_ba = mode == MODE_ANALYSIS
+        both = mode == MODE_BOTH
         
         if not display_text:
             self.message_queue.put(("chat", ("请输入有效内容", "system")))
             return
         
+        # 显式前缀优先，否则交给自动模式判断
+        if not explicit and auto_route:
+            skip_sf = self.auto_router.decide(display_text).skip_sf
+        
         sf_analysis = None
+        sf_digest = None
         ba_reply = None
+        streamed = False
+        sf_future = None
         
-        # SF逻辑分析
-        if not skip_sf:
-            sf_prompt = (
-                "你是一个逻辑分析助手。请对用户的问题进行深入的逻辑分析，包括：\n"
-                "1. 问题的核心要点\n"
-                "2. 可能的解决思路\n"
-                "3. 需要考虑的关键因素\n"
-                "4. 逻辑推理过程\n"
-                "请提供结构化的分析结果，不需要人性化的表达，专注于逻辑和事实。"
-            )
+        with self.session_manager.use(self.session_id) as session:
+            self.session = session
             
-            sf_messages = [{"role": "system", "content": sf_prompt}] + self.history_sf + [{"role": "user", "content": display_text}]
+            # 从长期记忆检索相关的早期对话（仍在实时历史中的轮次除外）
+            recalled = None
+            if self.memory is not None:
+                recalled = format_recalled(self.memory.recall(display_text, session.log.memory_rows()))
             
-            sf_response = self.client_sf.chat.completions.create(
-                model="deepseek-ai/DeepSeek-R1",
-                messages=sf_messages,
-                temperature=0.3
-            )
+            # 两个阶段用同一个标识提交，记为同一轮
+            turn = session.log.begin_turn(mode_prefix(mode) if explicit else None)
             
-            sf_analysis = sf_response.choices[0].message.content
-            
-            # 更新SF历史
-            self.history_sf.append({"role": "user", "content": display_text})
-            self.history_sf.append({"role": "assistant", "content": sf_analysis})
-        
-        # BA人性化回复
-        if not skip_ba:
+            # SF逻辑分析：优先使用输入时的预判结果
             if skip_sf:
-                ba_input = display_text
+                self.speculator.cancel("本轮跳过分析")
             else:
-                ba_input = (
-                    f"基于以下逻辑分析结果，请给用户一个人性化、温暖的回复：\n\n"
-                    f"【逻辑分析(deepseek分析)】\n{sf_analysis}\n\n"
-                    f"【用户原问题】\n{display_text}\n\n"
-                    f"请结合分析结果，用符合用户偏好的方式进行回复。"
-                )
-            
-            ba_messages = [{"role": "system", "content": self.system_prompt}] + self.history_ba + [{"role": "user", "content": ba_input}]
+                sf_result = self.speculator.take(display_text, session.buffer_sf)
+                if sf_result is not None:
+                    finish_sf_stage(session.buffer_sf, display_text, sf_result, "SF分析（预判）", turn)
+                elif both:
+                    # 并行模式：分析在后台进行，先给出直接回复
+                    sf_future = start_sf_stage(self.client_sf, session.buffer_sf, display_text, recalled, turn)
+                elif skip_ba:
+                    # 仅分析时边生成边显示分析结果
+                    with self.chat_stream("analysis", "📊 逻辑分析结果：\n", "post_sf") as on_delta:
+                        streamed = on_delta is not None
+                        sf_result = run_sf_stage(self.client_sf, session.buffer_sf, display_text,
+                                                 on_delta=on_delta, recalled=recalled, turn=turn)
+                else:
+                    sf_result = run_sf_stage(self.client_sf, session.buffer_sf, display_text, recalled=recalled,
+                                             turn=turn)
+                if sf_result is not None:
+                    sf_analysis, sf_digest = sf_result.content, sf_result.digest
             
-            ba_response = self.client_ba.chat.completions.create(
-                model="gpt-4o",
-                messages=ba_messages,
-                temperature=0.7
-            )
+            # BA人性化回复，使用压缩后的分析摘要，边生成边显示
+            if not skip_ba:
+                try:
+                    with self.chat_stream("ai", "AI: ", "post_ba") as on_delta:
+                        streamed = on_delta is not None
+                        ba_reply = run_ba_stage(self.client_ba, session.buffer_ba, display_text, sf_digest,
+                                                on_delta=on_delta, recalled=recalled, turn=turn).content
+                except Exception:
+                    if sf_future is not None:
+                        # 后台分析仍会写入同一份历史，等它结束再释放会话，避免和下一轮交叉
+                        futures.wait([sf_future])
+                    raise
             
-            ba_reply = ba_response.choices[0].message.content
+            # 并行模式：直接回复之后显示分析结果，并按需补充
+            if sf_future is not None:
+                if not streamed:
+                    self.show_markdown("AI: ", ba_reply, "ai")
+                    streamed = True
+                self.message_queue.put(("status", "逻辑分析进行中..."))
+                try:
+                    sf_result = sf_future.result()
+                    sf_analysis, sf_digest = sf_result.content, sf_result.digest
+                    self.show_markdown("📊 逻辑分析结果：\n", sf_analysis, "analysis")
+                    refinement = refine_reply(self.client_ba, session.buffer_ba, sf_digest)
+                    if refinement:
+                        self.show_markdown("AI（补充）: ", refinement, "ai")
+                        ba_reply = session.buffer_ba.last_reply()
+                except Exception as e:
+                    self.logger.error(f"并行模式的逻辑分析或补充失败: {e}")
+                    self.message_queue.put(("chat", ("⚠️ 逻辑分析失败，仅保留直接回复", "system")))
             
-            # 更新BA历史
-            self.history_ba.append({"role": "user", "content": display_text})
-            self.history_ba.append({"role": "assistant", "content": ba_reply})
+            if self.memory is not None:
+                session.log.set_memory(self.memory.add(display_text, ba_reply or sf_analysis), turn.node)
+                session.trim_history(HISTORY_MAX_TURNS)
         
         # 显示结果
         if skip_ba:
-            self.message_queue.put(("chat", (f"📊 逻辑分析结果：\n{sf_analysis}", "analysis")))
+            if not streamed:
+                self.show_markdown("📊 逻辑分析结果：\n", sf_analysis, "analysis")
         else:
-            self.message_queue.put(("chat", (f"AI: {ba_reply}", "ai")))
+            if not streamed:
+                self.show_markdown("AI: ", ba_reply, "ai")
             
             # 语音合成
-            if self.voice_enabled.get() and self.selected_voice and ba_reply:
-                self.generate_and_play_speech(ba_reply)
+            if voice_enabled and self.selected_voice and ba_reply:
+                self.generate_and_play_speech(ba_reply, session.log)
     
-    def generate_and_play_speech(self, text):
-        """生成并播放语音"""
+    def generate_and_play_speech(self, text, log=None):
+        """生成并播放语音；log 为本轮所在的对话记录，用于记下语音文件"""
+        # 记下本轮位置，语音完成时对话可能已经进入下一轮
+        node, generation = (log.head, log.generation) if log is not None else (None, None)
+        # 每轮回复的语音单独保存，导出的对话记录可以链接到对应的语音
+        if log is not None:
+            output_path = turn_speech_path(self.CACHE_DIR / "speech", self.session_id, log.started[node])
+        else:
+            output_path = self.CACHE_DIR / "ai_reply.mp3"
+        
         def generate_speech():
             try:
-                speech_file_path = Path(__file__).parent / "ai_reply.mp3"
+                # 去掉Markdown等不适合朗读的内容
+                spoken_text, _ = reduce_for_speech(text)
+                if not spoken_text:
+                    return
                 
-                with self.client_sf.audio.speech.with_streaming_response.create(
-                    model="FunAudioLLM/CosyVoice2-0.5B",
-                    voice=self.selected_voice['uri'],
-                    input=text,
-                    response_format="mp3"
-                ) as response:
-                    response.stream_to_file(speech_file_path)
+                speech_file_path = self.tts_router.synthesize(
+                    spoken_text, output_path, self.selected_voice['uri']
+                )
+                if log is not None:
+                    log.set_audio(speech_file_path, node, generation)
                 
                 # 播放音频
                 self.message_queue.put(("chat", ("🔊 语音播放中...", "system")))
                 system = platform.system()
                 if system == "Windows":
                     # 播放音频文件
-                    sound = AudioSegment.from_mp3(str(speech_file_path))
+                    sound = AudioSegment.from_file(str(speech_file_path))
                     play_obj = sa.play_buffer(
                         sound.raw_data,
                         num_channels=sound.channels,
@@ -758,8 +1135,14 @@ class VoiceSelectionDialog:
 
 
 def main():
+    parser = argparse.ArgumentParser(description="AI 双模式对话系统（图形界面版）")
+    parser.add_argument("--profile", nargs="?", const="profiles", metavar="DIR",
+                        help="对每轮对话进行性能分析，结果保存到 DIR（默认 profiles）")
+    args = parser.parse_args()
+    profiler = TurnProfiler(Path(args.profile)) if args.profile else None
+    
     root = tk.Tk()
-    app = AIChat(root)
+    app = AIChat(root, profiler)
     
     # 设置程序图标（如果有的话）
     try:
@@ -771,6 +1154,8 @@ def main():
     # 处理窗口关闭事件
     def on_closing():
         if messagebox.askokcancel("退出", "确定要退出程序吗？"):
+            # 退出前把内存中的会话写入磁盘，下次启动仍可导出
+            app.session_manager.flush()
             root.destroy()
     
     root.protocol("WM_DELETE_WINDOW", on_closing)